@@ -0,0 +1,237 @@
+# Correlation of gene expression with drug response for the BCL2 Drug Response notebook.
+# The notebook merges the DepMap expression data with the GDSC response data
+# once per drug and fits one LinearRegression per gene and drug.  Here the
+# cell line names are normalized once, the two tables are joined once into
+# a cell line x gene matrix and a cell line x drug matrix (cached on disk),
+# and the correlation, slope, R-squared, and p-value of every gene and drug
+# pair are calculated together with matrix products.
+#
+# Usage:
+# from bcl2_correlation import correlate, load_joined
+# expression, response = load_joined("raw_data/new_depmap_exp.csv",
+#                                    "raw_data/new_drug_response.csv", cache_dir="cache")
+# results = correlate(expression, response)                     # Every gene and drug
+# results = correlate(expression[["BCL2", "BCL2L1", "MCL1"]],
+#                     response[["Navitoclax", "TW 37"]], method="spearman")
+#
+# Missing values are allowed.  Each gene and drug pair uses only the cell
+# lines with both an expression value and a response, as if the pair had
+# been merged and fitted on its own.
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+def normalize_cell_lines(names):
+    """
+    names: A pandas Series of cell line names, such as "NCI-H460" or "MC-CAR".
+
+    Returns the names with hyphens removed ("NCIH460", "MCCAR"), the form
+    used by the DepMap expression data, as in the notebook.
+    """
+    return names.astype(str).str.replace("-", "", regex=False)
+
+
+def prepare_expression(expression_df, cell_line_column="cell_line"):
+    """
+    expression_df: The data frame of gene expression with one row per cell line
+    and one column per gene, as in new_depmap_exp.csv.
+
+    Returns a data frame indexed by normalized cell line with only the gene
+    columns.  Duplicate cell lines keep their first row.
+    """
+
+    expression = expression_df.set_index(normalize_cell_lines(expression_df[cell_line_column]))
+    expression = expression.drop(columns=cell_line_column)
+    expression = expression.loc[~expression.index.duplicated()]
+    expression.index.name = "cell_line"
+    return expression.astype(float)
+
+
+def prepare_response(response_df, value="auc", cell_line_column="cell_line_name",
+                     drug_column="drug_name"):
+    """
+    response_df: The data frame of drug response with one row per cell line
+    and drug, as in new_drug_response.csv.
+
+    value: The response column to use, such as auc or ln_ic50.
+
+    Returns a data frame of value indexed by normalized cell line with one
+    column per drug.  Duplicate cell line and drug pairs keep their first row.
+    """
+
+    response = pd.DataFrame({"cell_line": normalize_cell_lines(response_df[cell_line_column]),
+                             "drug": response_df[drug_column].values,
+                             "value": response_df[value].values})
+    response = response.drop_duplicates(subset=["cell_line", "drug"])
+    response = response.pivot(index="cell_line", columns="drug", values="value")
+    response.columns.name = None
+    return response.astype(float)
+
+
+def join_expression_response(expression_df, response_df, value="auc"):
+    """
+    expression_df, response_df: The raw data frames described in
+    prepare_expression() and prepare_response().
+
+    value: The response column to use.
+
+    Returns the expression matrix (cell line x gene) and the response matrix
+    (cell line x drug) for the cell lines found in both, in the same order.
+    """
+
+    expression = prepare_expression(expression_df)
+    response = prepare_response(response_df, value)
+    shared = expression.index.intersection(response.index).sort_values()
+    return expression.loc[shared], response.loc[shared]
+
+
+def load_joined(expression_csv, response_csv, cache_dir=None, value="auc"):
+    """
+    expression_csv, response_csv: Paths to new_depmap_exp.csv and new_drug_response.csv.
+
+    cache_dir: A directory for the joined matrices.  They are read from the
+    cache while neither CSV has changed, and rebuilt otherwise.
+
+    value: The response column to use.
+
+    Returns the expression and response matrices from join_expression_response().
+    """
+
+    if cache_dir is not None:
+        key = hashlib.sha256(repr([value] + [(os.path.abspath(path), os.stat(path).st_size,
+                                              os.stat(path).st_mtime_ns)
+                                             for path in [expression_csv, response_csv]]).encode())
+        cache_path = os.path.join(cache_dir, f"joined_{key.hexdigest()[:16]}.pkl")
+        if os.path.exists(cache_path):
+            return pd.read_pickle(cache_path)
+
+    joined = join_expression_response(pd.read_csv(expression_csv), pd.read_csv(response_csv), value)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        pd.to_pickle(joined, cache_path)
+    return joined
+
+
+def _masked_sums(x, y):
+    """
+    x: An array of cell line x gene with NaN for missing values.
+
+    y: An array of cell line x drug with NaN for missing values.
+
+    Returns the number of cell lines with both values and the sums needed for
+    a least squares fit of every gene and drug pair, each a gene x drug array.
+    """
+
+    x_present = ~np.isnan(x)
+    y_present = ~np.isnan(y)
+    x = np.where(x_present, x, 0.0)
+    y = np.where(y_present, y, 0.0)
+    x_present = x_present.astype(float)
+    y_present = y_present.astype(float)
+
+    n = x_present.T @ y_present
+    sum_x = x.T @ y_present
+    sum_y = x_present.T @ y
+    sum_xx = (x * x).T @ y_present
+    sum_yy = x_present.T @ (y * y)
+    sum_xy = x.T @ y
+    return n, sum_x, sum_y, sum_xx, sum_yy, sum_xy
+
+
+def _pearson(x, y):
+    """Returns n, r, slope, and intercept (gene x drug arrays) of the least
+    squares fit of y on x for every pair of columns."""
+
+    n, sum_x, sum_y, sum_xx, sum_yy, sum_xy = _masked_sums(x, y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariance = sum_xy - sum_x * sum_y / n
+        variance_x = sum_xx - sum_x ** 2 / n
+        variance_y = sum_yy - sum_y ** 2 / n
+        r = covariance / np.sqrt(variance_x * variance_y)
+        slope = covariance / variance_x
+        intercept = (sum_y - slope * sum_x) / n
+    return n, np.clip(r, -1, 1), slope, intercept
+
+
+def _spearman(x, y):
+    """Returns n and the Spearman correlation (gene x drug arrays) for every
+    pair of columns.  Each pair is ranked within the cell lines with both
+    values, so genes missing the same cell lines are ranked together with
+    the drugs missing the same cell lines."""
+
+    n = np.zeros((x.shape[1], y.shape[1]))
+    r = np.full((x.shape[1], y.shape[1]), np.nan)
+    gene_patterns, gene_pattern = np.unique(~np.isnan(x).T, axis=0, return_inverse=True)
+    drug_patterns, drug_pattern = np.unique(~np.isnan(y).T, axis=0, return_inverse=True)
+    for gene_number, gene_rows in enumerate(gene_patterns):
+        genes = np.flatnonzero(gene_pattern.ravel() == gene_number)
+        for drug_number, drug_rows in enumerate(drug_patterns):
+            rows = gene_rows & drug_rows
+            if not rows.any():
+                continue
+            drugs = np.flatnonzero(drug_pattern.ravel() == drug_number)
+            x_ranks = pd.DataFrame(x[rows][:, genes]).rank().values
+            y_ranks = pd.DataFrame(y[rows][:, drugs]).rank().values
+            pairs = np.ix_(genes, drugs)
+            n[pairs], r[pairs], _, _ = _pearson(x_ranks, y_ranks)
+    return n, r
+
+
+def correlate(expression, response, method="pearson", min_samples=3, chunk_size=2000):
+    """
+    expression: The expression matrix (cell line x gene) from join_expression_response().
+
+    response: The response matrix (cell line x drug) with the same cell lines.
+
+    method: "pearson" or "spearman" for the correlation and its p-value.  The
+    slope and intercept are always the least squares fit of response on
+    expression, as drawn by plot_linear_regression() in the notebook.
+
+    min_samples: Pairs with fewer cell lines than this are left out.
+
+    chunk_size: Genes calculated at once, which limits memory use when every
+    gene is scanned.
+
+    Returns a data frame with one row per gene and drug: gene, drug, n, r,
+    slope, intercept, r_squared, and p_value (two-sided, from the t
+    distribution with n - 2 degrees of freedom), sorted by p_value.
+    """
+
+    if method not in ["pearson", "spearman"]:
+        raise ValueError(f"method must be 'pearson' or 'spearman', not {method}")
+    if not expression.index.equals(response.index):
+        raise ValueError("expression and response must have the same cell lines in the same order.")
+
+    y = response.values.astype(float)
+    results = []
+    for start in range(0, expression.shape[1], chunk_size):
+        genes = expression.columns[start:start + chunk_size]
+        x = expression[genes].values.astype(float)
+        n, r, slope, intercept = _pearson(x, y)
+        if method == "spearman":
+            n, r = _spearman(x, y)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            degrees = n - 2
+            t = r * np.sqrt(degrees / (1 - r ** 2))
+            p_value = 2 * stats.t.sf(np.abs(t), np.maximum(degrees, 1))
+
+        keep = (n >= min_samples) & ~np.isnan(r)
+        gene_index, drug_index = np.nonzero(keep)
+        results.append(pd.DataFrame({"gene": genes[gene_index],
+                                     "drug": response.columns[drug_index],
+                                     "n": n[keep].astype(int),
+                                     "r": r[keep],
+                                     "slope": slope[keep],
+                                     "intercept": intercept[keep],
+                                     "r_squared": r[keep] ** 2,
+                                     "p_value": p_value[keep]}))
+
+    results = pd.concat(results, ignore_index=True)
+    return results.sort_values("p_value", kind="mergesort", ignore_index=True)
@@ -0,0 +1,175 @@
+# Loading of the raw_data CSV files used by the BCL2 Drug Response notebook.
+# Each CSV is converted once to a compressed Parquet file in a cache
+# directory, with the cell line, drug, tissue, and cancer type columns
+# stored as categories.  Later loads read only the requested columns and
+# skip row groups that cannot match the filters, instead of reading the
+# whole CSV with pd.read_csv.  The size and modification time of the CSV are
+# kept in the Parquet file, and a changed CSV is converted again.  Without
+# pyarrow, the CSV is read directly with the same column and row selection.
+#
+# Usage:
+# from bcl2_data import load
+# drug_list = load("drug_list")
+# dm_exp = load("expression", columns=["cell_line", "BCL2", "BCL2L1", "MCL1"])
+# bcl2_drug_response = load("drug_response",
+#                           filters=[("drug_name", "in", ["Navitoclax", "TW 37"])])
+#
+# Filters are (column, operator, value) tuples that must all match, with the
+# operators =, ==, !=, <, <=, >, >=, in, and "not in".
+
+import json
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+RAW_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "raw_data")
+CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+# The CSV files and their columns stored as categories
+SOURCES = {
+    "drug_list": {"file": "gdsc_drug_list.csv", "categories": ["Target pathway"]},
+    "drug_response": {"file": "new_drug_response.csv",
+                      "categories": ["cell_line_name", "tissue_type", "cancer_type",
+                                     "drug_name", "putative_target"]},
+    "expression": {"file": "new_depmap_exp.csv", "categories": []},
+}
+
+# Rows per row group.  Smaller groups let filters skip more of the file.
+ROW_GROUP_SIZE = 50000
+
+# Bytes of CSV read at a time when converting
+BLOCK_SIZE = 64 << 20
+
+
+def source_signature(csv_path):
+    """Returns the size and modification time of the CSV, which are stored in
+    its cache file to detect a changed CSV."""
+    stat = os.stat(csv_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def cache_is_current(cache_path, csv_path):
+    """Returns True if the cache file exists and was made from the CSV as it is now."""
+    if not os.path.exists(cache_path):
+        return False
+    metadata = pq.read_schema(cache_path).metadata or {}
+    stored = metadata.get(b"source_signature")
+    return stored is not None and json.loads(stored) == source_signature(csv_path)
+
+
+def convert(csv_path, cache_path, categories=()):
+    """
+    csv_path: The CSV file to convert.
+
+    cache_path: The Parquet file to write.
+
+    categories: Columns to store as categories (dictionary encoded).
+
+    Streams the CSV into a zstd compressed Parquet file in blocks, so the
+    whole CSV is never held in memory.  pyarrow infers the column types from
+    the first block, so if a later block does not fit them (e.g. text in a
+    column of numbers), the CSV is read again whole with pd.read_csv instead.
+    """
+
+    signature = json.dumps(source_signature(csv_path)).encode()
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Written under a temporary name so a reader never sees a partial file
+    temporary = cache_path + ".tmp"
+    try:
+        try:
+            stream_csv(csv_path, temporary, categories, signature)
+        except pa.ArrowInvalid:
+            df = pd.read_csv(csv_path, dtype={column: "category" for column in categories})
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            table = table.replace_schema_metadata({**table.schema.metadata, b"source_signature": signature})
+            pq.write_table(table, temporary, row_group_size=ROW_GROUP_SIZE, compression="zstd")
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    os.replace(temporary, cache_path)
+
+
+def stream_csv(csv_path, parquet_path, categories, signature):
+    """Writes the CSV to parquet_path one block at a time (see convert())."""
+
+    column_types = {column: pa.dictionary(pa.int32(), pa.string()) for column in categories}
+    reader = pa_csv.open_csv(csv_path, convert_options=pa_csv.ConvertOptions(column_types=column_types),
+                             read_options=pa_csv.ReadOptions(block_size=BLOCK_SIZE))
+    schema = reader.schema.with_metadata({b"source_signature": signature})
+    with pq.ParquetWriter(parquet_path, schema, compression="zstd") as writer:
+        for batch in reader:
+            writer.write_table(pa.Table.from_batches([batch]).replace_schema_metadata(schema.metadata),
+                               row_group_size=ROW_GROUP_SIZE)
+
+
+def apply_filters(df, filters):
+    """Returns the rows of df matching every (column, operator, value) filter."""
+
+    keep = pd.Series(True, index=df.index)
+    for column, operator, value in filters or []:
+        values = df[column]
+        if operator in ["=", "=="]:
+            keep &= values == value
+        elif operator == "!=":
+            keep &= values != value
+        elif operator == "<":
+            keep &= values < value
+        elif operator == "<=":
+            keep &= values <= value
+        elif operator == ">":
+            keep &= values > value
+        elif operator == ">=":
+            keep &= values >= value
+        elif operator == "in":
+            keep &= values.isin(value)
+        elif operator == "not in":
+            keep &= ~values.isin(value)
+        else:
+            raise ValueError(f"Unknown filter operator: {operator}")
+    return df.loc[keep]
+
+
+def load(name, columns=None, filters=None, raw_data=RAW_DATA, cache_dir=CACHE):
+    """
+    name: drug_list, drug_response, or expression (see SOURCES).
+
+    columns: The columns to read.  Defaults to every column.
+
+    filters: Row filters (see the top of this file).
+
+    raw_data: The directory with the CSV files.
+
+    cache_dir: The directory for the Parquet files.
+
+    Returns the selected columns and rows as a data frame, converting the CSV
+    first if it has no current cache file.
+    """
+
+    source = SOURCES[name]
+    csv_path = os.path.join(raw_data, source["file"])
+    if pa is None:
+        # No pyarrow, so read the CSV with the same selection
+        needed = None if columns is None else list(dict.fromkeys(
+            list(columns) + [column for column, _, _ in filters or []]))
+        df = pd.read_csv(csv_path, usecols=needed,
+                         dtype={column: "category" for column in source["categories"]
+                                if needed is None or column in needed})
+        df = apply_filters(df, filters)
+        return df.reset_index(drop=True) if columns is None else df.loc[:, list(columns)].reset_index(drop=True)
+
+    cache_path = os.path.join(cache_dir, os.path.splitext(source["file"])[0] + ".parquet")
+    if not cache_is_current(cache_path, csv_path):
+        convert(csv_path, cache_path, source["categories"])
+    table = pq.read_table(cache_path, columns=list(columns) if columns is not None else None,
+                          filters=[(column, "==" if operator == "=" else operator, value)
+                                   for column, operator, value in filters] if filters else None,
+                          memory_map=True)
+    return table.to_pandas()
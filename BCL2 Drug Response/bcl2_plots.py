@@ -0,0 +1,174 @@
+# Interactive AUC scatter plots for the BCL2 Drug Response notebook that
+# stay responsive with the full GDSC response table.
+# Figures 2 and 3 put every row of the response data frame into a
+# ColumnDataSource embedded in the page.  Here the plot runs as a Bokeh
+# server application: the data stays in Python, and after every pan or zoom
+# only the current view is sent to the browser.
+# - If the view holds at most max_points points, those points are sent with
+#   the columns shown when hovering, so hover details are only sent for
+#   points that can be seen.
+# - Otherwise the view is binned into a grid and drawn as an image of the
+#   number of cell lines in each bin, so the page never holds more than
+#   one grid of counts.
+#
+# Usage in the notebook (output_notebook() already called):
+# from bcl2_plots import auc_scatter_app
+# show(auc_scatter_app(drug_response, title="AUC of Every GDSC Drug"))
+#
+# Or as a stand-alone server: bokeh serve --show bcl2_plots.py --args drug_response.csv
+
+import sys
+
+import numpy as np
+import pandas as pd
+from bokeh import events
+from bokeh.models import (ColumnDataSource, FactorRange, HoverTool, LogColorMapper,
+                          NumeralTickFormatter, Range1d)
+from bokeh.palettes import Blues256
+from bokeh.plotting import figure
+
+# The hover information of Figures 2 and 3
+HOVER_TOOLTIPS = [("Cell Line", "@cell_line_name"),
+                  ("Cancer Type", "@cancer_type"),
+                  ("AUC", "@auc{0.00}"),
+                  ("RMSE", "@rmse{0.000}"),
+                  ("Z-Score", "@z_score{0.00}"),
+                  ("Min Drug Conc", "@min_conc_micromolar{0.00000} µM"),
+                  ("Max Drug Conc", "@max_conc_micromolar{0.00} µM")]
+
+
+class ScatterData:
+    """The positions and hover columns of every point, kept in Python.
+    view() returns what the browser needs to draw one view."""
+
+    def __init__(self, response, x="drug_name", y="auc", factors=None, tooltips=HOVER_TOOLTIPS,
+                 jitter_width=0.3, max_points=5000, bins=(200, 150), seed=0):
+        """
+        response: The drug response data frame, one row per cell line and drug.
+
+        x: The categorical column on the x-axis.
+
+        y: The numerical column on the y-axis.
+
+        factors: The order of the categories on the x-axis.  Defaults to sorted order.
+
+        tooltips: The hover tooltips.  The columns they use are sent with each point.
+
+        jitter_width: The width of the random horizontal spread of each category,
+        as in bokeh.transform.jitter().
+
+        max_points: The most points sent for one view.  Views with more points are binned.
+
+        bins: The number of bins across and up the plot when binning.
+        """
+
+        response = response.loc[response[y].notna()]
+        self.factors = list(factors) if factors is not None else sorted(response[x].dropna().unique())
+        codes = pd.Categorical(response[x], categories=self.factors).codes
+        keep = codes >= 0
+        response = response.loc[keep]
+
+        # Categories are drawn at 0.5, 1.5, ... on a categorical axis, so the
+        # jitter is added to those positions once instead of in the browser
+        rng = np.random.default_rng(seed)
+        self.x = codes[keep] + 0.5 + rng.uniform(-jitter_width / 2, jitter_width / 2, keep.sum())
+        self.y = response[y].values.astype(float)
+        self.tooltips = tooltips
+        hover_columns = {field.split("@")[1].split("{")[0] for _, field in tooltips}
+        self.hover = {column: response[column].values for column in hover_columns
+                      if column in response.columns}
+        self.max_points = max_points
+        self.bins = bins
+
+    def bounds(self):
+        """Returns the x and y limits that show every point."""
+        margin = 0.05 * (self.y.max() - self.y.min() or 1)
+        return (0, len(self.factors)), (self.y.min() - margin, self.y.max() + margin)
+
+    def view(self, x_start, x_end, y_start, y_end):
+        """
+        x_start, x_end, y_start, y_end: The current limits of the plot.
+
+        Returns the data for the point source and the image source.  One of
+        the two is empty, depending on whether the view holds more than
+        max_points points.
+        """
+
+        in_view = (self.x >= x_start) & (self.x <= x_end) & (self.y >= y_start) & (self.y <= y_end)
+        points = {"x": [], "y": [], **{column: [] for column in self.hover}}
+        image = {"image": [], "x": [], "y": [], "dw": [], "dh": []}
+
+        if in_view.sum() <= self.max_points:
+            points = {"x": self.x[in_view], "y": self.y[in_view],
+                      **{column: values[in_view] for column, values in self.hover.items()}}
+        else:
+            counts, _, _ = np.histogram2d(self.x[in_view], self.y[in_view], bins=self.bins,
+                                          range=[[x_start, x_end], [y_start, y_end]])
+            # Empty bins are transparent
+            counts[counts == 0] = np.nan
+            image = {"image": [counts.T], "x": [x_start], "y": [y_start],
+                     "dw": [x_end - x_start], "dh": [y_end - y_start]}
+
+        return points, image
+
+
+def auc_scatter_app(response, title="AUC After Anti-Apoptotic Inhibition", x="drug_name", y="auc",
+                    x_label="Drug", y_label="AUC", width=900, height=500, **options):
+    """
+    response: The drug response data frame.
+
+    title, x_label, y_label, width, height: Text and size of the figure.
+
+    x, y, and options: Passed to ScatterData.
+
+    Returns a function that builds the plot in a Bokeh document, for use with
+    show() in a notebook or with bokeh serve.
+    """
+
+    data = ScatterData(response, x, y, **options)
+
+    def make_document(doc):
+        (x_start, x_end), (y_start, y_end) = data.bounds()
+        points, image = data.view(x_start, x_end, y_start, y_end)
+        point_source = ColumnDataSource(points)
+        image_source = ColumnDataSource(image)
+
+        # Fixed ranges, so new data does not rescale the plot while panning
+        fig = figure(title=title, x_range=FactorRange(*data.factors), y_range=Range1d(y_start, y_end),
+                     x_axis_label=x_label, y_axis_label=y_label, width=width, height=height,
+                     tools="save,reset,pan,wheel_zoom,box_zoom")
+        counts = fig.image(source=image_source, image="image", x="x", y="y", dw="dw", dh="dh",
+                           color_mapper=LogColorMapper(palette=Blues256[::-1][32:], low=1,
+                                                       nan_color=(0, 0, 0, 0)))
+        scatter = fig.scatter(source=point_source, x="x", y="y")
+        fig.add_tools(HoverTool(renderers=[scatter], tooltips=data.tooltips),
+                      HoverTool(renderers=[counts], tooltips=[("Cell Lines", "@image{0,0}")]))
+
+        # Same formatting as Figures 2 and 3
+        fig.xgrid.grid_line_color = None
+        fig.title.align = "center"
+        fig.title.text_font_size = "14pt"
+        fig.xaxis.major_label_orientation = .7
+        fig.xaxis.major_label_text_font_size = "10pt"
+        fig.xaxis.axis_label_text_font_size = "14pt"
+        fig.yaxis.major_label_text_font_size = "10pt"
+        fig.yaxis.axis_label_text_font_size = "14pt"
+        fig.yaxis.formatter = NumeralTickFormatter(format="0.00")
+
+        def update(event):
+            # Sent once a pan or zoom finishes, with the new limits
+            points, image = data.view(event.x0, event.x1, event.y0, event.y1)
+            point_source.data = points
+            image_source.data = image
+
+        fig.on_event(events.RangesUpdate, update)
+        doc.add_root(fig)
+        doc.title = title
+
+    return make_document
+
+
+if __name__.startswith("bokeh_app"):
+    # bokeh serve bcl2_plots.py --args drug_response.csv
+    from bokeh.io import curdoc
+    auc_scatter_app(pd.read_csv(sys.argv[1]))(curdoc())
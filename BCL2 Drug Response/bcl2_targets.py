@@ -0,0 +1,173 @@
+# Index of GDSC drugs by target for the BCL2 Drug Response notebook.
+# The notebook finds drugs for a target family by lower casing and
+# splitting the Targets column of every drug on every query.  Here the
+# targets of gdsc_drug_list.csv are normalized once into an index from
+# target to drug IDs, which is saved next to the Parquet cache of bcl2_data.py
+# and rebuilt only when the CSV changes.  A query returns the drugs hitting
+# any or all of a list of targets, and can go straight on to the matching
+# rows of the drug response data.
+#
+# Usage:
+# from bcl2_targets import load_index, target_responses
+# index = load_index()
+# index.drug_names(["BCL2", "MCL1", "BCL-XL"])               # Drugs hitting any of them
+# index.drug_names(["BCL2", "BCL-XL"], match="all")          # Drugs hitting both
+# bcl2_drug_response = index.responses(["BCL2", "MCL1", "BCL-XL"])
+# families = target_responses(index, {"MCL1": ["MCL1"], "BCL2": ["BCL2"],
+#                                     "BCL-XL": ["BCL2L1"], "BFL-1": ["BCL2A1"]})
+#
+# Targets are compared in upper case without hyphens or spaces, and protein
+# names are mapped to their gene names (TARGET_SYNONYMS), so "Bcl-xL",
+# "BCL-XL", and "BCL2L1" are the same target.
+
+import json
+import os
+
+import pandas as pd
+
+from bcl2_data import CACHE, RAW_DATA, SOURCES, load, source_signature
+
+# Normalized protein names: gene name
+TARGET_SYNONYMS = {"BCLXL": "BCL2L1", "BCLW": "BCL2L2", "BFL1": "BCL2A1", "A1": "BCL2A1",
+                   "BCL2A1": "BCL2A1", "MCL1": "MCL1", "BCL2": "BCL2"}
+
+
+def normalize_target(target):
+    """Returns the target in upper case without hyphens or spaces, mapped to
+    its gene name if it is a known protein name."""
+    target = str(target).upper().replace("-", "").replace(" ", "")
+    return TARGET_SYNONYMS.get(target, target)
+
+
+class TargetIndex:
+    """Drug IDs of the GDSC drug list by normalized target."""
+
+    def __init__(self, targets, names, signature=None):
+        # Normalized target: sorted list of drug IDs
+        self.targets = targets
+        # Drug ID: drug name
+        self.names = names
+        self.signature = signature
+
+    @classmethod
+    def build(cls, drug_list, signature=None):
+        """
+        drug_list: The data frame of gdsc_drug_list.csv, with the original
+        (drug_id, Name, Targets) or notebook (drug_id, name, targets) column names.
+
+        Returns a TargetIndex of every drug in drug_list.
+        """
+
+        columns = {column.replace(" ", "_").lower(): column for column in drug_list.columns}
+        drug_ids = drug_list[columns["drug_id"]].astype(int).tolist()
+        names = dict(zip(drug_ids, drug_list[columns["name"]].astype(str)))
+
+        targets = {}
+        for drug_id, drug_targets in zip(drug_ids, drug_list[columns["targets"]].fillna("")):
+            for target in str(drug_targets).split(","):
+                if target.strip():
+                    targets.setdefault(normalize_target(target), set()).add(drug_id)
+
+        return cls({target: sorted(ids) for target, ids in targets.items()}, names, signature)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "w") as index_file:
+            json.dump({"signature": self.signature, "targets": self.targets,
+                       "names": {str(drug_id): name for drug_id, name in self.names.items()}},
+                      index_file)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def read(cls, path):
+        with open(path) as index_file:
+            contents = json.load(index_file)
+        return cls(contents["targets"], {int(drug_id): name for drug_id, name in contents["names"].items()},
+                   contents["signature"])
+
+    def drugs(self, targets, match="any"):
+        """
+        targets: A target name or a list of target names.
+
+        match: "any" for drugs hitting at least one of the targets, or "all"
+        for drugs hitting every one of them.
+
+        Returns the sorted drug IDs.
+        """
+
+        if isinstance(targets, str):
+            targets = [targets]
+        if match not in ["any", "all"]:
+            raise ValueError(f"match must be 'any' or 'all', not {match}")
+        hits = [set(self.targets.get(normalize_target(target), [])) for target in targets]
+        if not hits:
+            return []
+        drug_ids = set.union(*hits) if match == "any" else set.intersection(*hits)
+        return sorted(drug_ids)
+
+    def drug_names(self, targets, match="any"):
+        """Returns the names of the drugs from drugs(), in alphabetical order."""
+        return sorted(self.names[drug_id] for drug_id in self.drugs(targets, match))
+
+    def responses(self, targets, match="any", columns=None, **load_options):
+        """
+        targets, match: See drugs().
+
+        columns: Columns of the drug response data to return.  Defaults to every column.
+
+        Returns the rows of new_drug_response.csv for the drugs from drugs(),
+        read with bcl2_data.load() so only those rows are loaded.
+        """
+        return load("drug_response", columns=columns,
+                    filters=[("drug_id", "in", self.drugs(targets, match))], **load_options)
+
+
+def load_index(raw_data=RAW_DATA, cache_dir=CACHE):
+    """
+    raw_data: The directory with gdsc_drug_list.csv.
+
+    cache_dir: The directory the index is saved in.
+
+    Returns the TargetIndex of the drug list, building and saving it only if
+    there is no saved index or the CSV changed since it was built.
+    """
+
+    csv_path = os.path.join(raw_data, SOURCES["drug_list"]["file"])
+    index_path = os.path.join(cache_dir, "drug_targets.json")
+    signature = source_signature(csv_path)
+    if os.path.exists(index_path):
+        index = TargetIndex.read(index_path)
+        if index.signature == signature:
+            return index
+
+    index = TargetIndex.build(load("drug_list", raw_data=raw_data, cache_dir=cache_dir), signature)
+    index.save(index_path)
+    return index
+
+
+def target_responses(index, families, match="any", columns=None, **load_options):
+    """
+    index: A TargetIndex.
+
+    families: A dictionary of family name to a list of targets, such as
+    {"BCL-2 family": ["BCL2", "BCL2L1", "MCL1"], "MCL1": ["MCL1"]}.
+
+    match, columns: See TargetIndex.responses().
+
+    Reads the drug response rows of every family's drugs in a single load
+    and returns a dictionary of family name to its rows.
+    """
+
+    family_drugs = {family: index.drugs(targets, match) for family, targets in families.items()}
+    every_drug = sorted(set().union(*family_drugs.values())) if family_drugs else []
+    if columns is not None and "drug_id" not in columns:
+        read_columns = list(columns) + ["drug_id"]
+    else:
+        read_columns = columns
+    response = load("drug_response", columns=read_columns,
+                    filters=[("drug_id", "in", every_drug)], **load_options)
+
+    return {family: response.loc[response["drug_id"].isin(drug_ids),
+                                 list(columns) if columns is not None else response.columns]
+                            .reset_index(drop=True)
+            for family, drug_ids in family_drugs.items()}
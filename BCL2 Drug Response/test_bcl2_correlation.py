@@ -0,0 +1,41 @@
+# Tests for bcl2_correlation.py.  Run with python -m pytest from this directory.
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from bcl2_correlation import correlate, normalize_cell_lines
+
+
+def matrices(seed=0, cell_lines=40, genes=6, drugs=4):
+    random = np.random.default_rng(seed)
+    index = pd.Index([f"LINE{number}" for number in range(cell_lines)], name="cell_line")
+    expression = pd.DataFrame(random.normal(size=(cell_lines, genes)), index=index,
+                              columns=[f"GENE{number}" for number in range(genes)])
+    response = pd.DataFrame(random.normal(size=(cell_lines, drugs)) + expression.values[:, :drugs],
+                            index=index, columns=[f"Drug {number}" for number in range(drugs)])
+    # Ties, and cell lines missing from some genes and some drugs
+    expression.iloc[:, 0] = expression.iloc[:, 0].round(0)
+    expression = expression.mask(random.random(expression.shape) < 0.15)
+    response = response.mask(random.random(response.shape) < 0.25)
+    return expression, response
+
+
+def test_matches_scipy_with_missing_values():
+    expression, response = matrices()
+    for method, scipy_method in [("pearson", stats.pearsonr), ("spearman", stats.spearmanr)]:
+        results = correlate(expression, response, method=method).set_index(["gene", "drug"])
+        assert len(results) == expression.shape[1] * response.shape[1]
+        for gene in expression.columns:
+            for drug in response.columns:
+                both = expression[gene].notna() & response[drug].notna()
+                expected = scipy_method(expression[gene][both], response[drug][both])
+                row = results.loc[(gene, drug)]
+                assert row["n"] == both.sum()
+                assert np.isclose(row["r"], expected[0])
+                assert np.isclose(row["p_value"], expected[1])
+
+
+def test_normalize_cell_lines_removes_hyphens():
+    names = pd.Series(["NCI-H460", "MC-CAR", "KMS-12-BM"])
+    assert list(normalize_cell_lines(names)) == ["NCIH460", "MCCAR", "KMS12BM"]
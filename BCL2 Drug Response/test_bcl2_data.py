@@ -0,0 +1,74 @@
+# Tests for bcl2_data.py.  Run with python -m pytest from this directory.
+
+import os
+
+import pandas as pd
+import pytest
+
+import bcl2_data
+from bcl2_data import load
+
+
+def write_responses(raw_data, rows):
+    df = pd.DataFrame({"cell_line_name": [f"LINE{n % 7}" for n in range(rows)],
+                       "tissue_type": "blood", "cancer_type": "MM",
+                       "drug_id": [n % 5 for n in range(rows)],
+                       "drug_name": [f"Drug {n % 5}" for n in range(rows)],
+                       "putative_target": "BCL2",
+                       "auc": [n / rows for n in range(rows)]})
+    df.to_csv(os.path.join(raw_data, "new_drug_response.csv"), index=False)
+    return df
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    raw_data, cache_dir = tmp_path / "raw_data", tmp_path / "cache"
+    raw_data.mkdir()
+    return str(raw_data), str(cache_dir)
+
+
+def test_filters_and_columns(dirs):
+    raw_data, cache_dir = dirs
+    df = write_responses(raw_data, 200)
+    filters = [("drug_name", "in", ["Drug 1", "Drug 3"]), ("auc", ">=", 0.5)]
+    result = load("drug_response", columns=["cell_line_name", "drug_name", "auc"], filters=filters,
+                  raw_data=raw_data, cache_dir=cache_dir)
+    expected = df.loc[df["drug_name"].isin(["Drug 1", "Drug 3"]) & (df["auc"] >= 0.5),
+                      ["cell_line_name", "drug_name", "auc"]]
+    assert list(result.columns) == ["cell_line_name", "drug_name", "auc"]
+    assert isinstance(result["drug_name"].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(result.astype({"cell_line_name": str, "drug_name": str}),
+                                  expected.reset_index(drop=True))
+    assert load("drug_response", filters=[("drug_id", "=", 2)], raw_data=raw_data,
+                cache_dir=cache_dir)["drug_id"].tolist() == [2] * 40
+
+
+def test_changed_csv_is_converted_again(dirs):
+    raw_data, cache_dir = dirs
+    write_responses(raw_data, 100)
+    assert len(load("drug_response", raw_data=raw_data, cache_dir=cache_dir)) == 100
+    cache_path = os.path.join(cache_dir, "new_drug_response.parquet")
+    converted = os.stat(cache_path).st_mtime_ns
+
+    # An unchanged CSV reuses the cache file
+    assert len(load("drug_response", raw_data=raw_data, cache_dir=cache_dir)) == 100
+    assert os.stat(cache_path).st_mtime_ns == converted
+
+    write_responses(raw_data, 120)
+    assert len(load("drug_response", raw_data=raw_data, cache_dir=cache_dir)) == 120
+
+
+def test_types_changing_after_the_first_block(dirs, monkeypatch):
+    # drug_id is a number in the first block and text further down, which
+    # the streaming conversion cannot write
+    raw_data, cache_dir = dirs
+    df = write_responses(raw_data, 2000)
+    df["drug_id"] = df["drug_id"].astype(object)
+    df.loc[1900:, "drug_id"] = "unknown"
+    df.to_csv(os.path.join(raw_data, "new_drug_response.csv"), index=False)
+    monkeypatch.setattr(bcl2_data, "BLOCK_SIZE", 4096)
+
+    result = load("drug_response", raw_data=raw_data, cache_dir=cache_dir)
+    assert len(result) == 2000
+    assert result["drug_id"].tolist()[-1] == "unknown"
+    assert os.listdir(cache_dir) == ["new_drug_response.parquet"]
@@ -0,0 +1,36 @@
+# Tests for bcl2_plots.py.  Run with python -m pytest from this directory.
+
+import numpy as np
+import pandas as pd
+
+from bcl2_plots import ScatterData
+
+
+def responses(rows=1000):
+    return pd.DataFrame({"drug_name": [f"Drug {n % 4}" for n in range(rows)],
+                         "auc": np.linspace(0, 1, rows),
+                         "cell_line_name": [f"LINE{n}" for n in range(rows)],
+                         "cancer_type": "MM"})
+
+
+def test_points_or_counts():
+    response = responses()
+    response.loc[0, "auc"] = None
+    data = ScatterData(response, max_points=100, bins=(4, 10))
+    assert data.factors == ["Drug 0", "Drug 1", "Drug 2", "Drug 3"]
+    (x_start, x_end), (y_start, y_end) = data.bounds()
+
+    # Every point is binned, and only the counts are sent
+    points, image = data.view(x_start, x_end, y_start, y_end)
+    assert len(points["x"]) == 0
+    assert np.nansum(image["image"][0]) == 999
+    assert image["image"][0].shape == (10, 4)
+
+    # A zoomed view with few points sends them with their hover columns
+    points, image = data.view(0, 1, 0.5, 0.6)
+    assert image["image"] == []
+    assert set(points) == {"x", "y", "cell_line_name", "cancer_type", "auc"}
+    assert 0 < len(points["x"]) <= 100
+    assert (points["y"] >= 0.5).all() and (points["y"] <= 0.6).all()
+    expected = response.loc[(response["drug_name"] == "Drug 0") & response["auc"].between(0.5, 0.6)]
+    assert sorted(points["cell_line_name"]) == sorted(expected["cell_line_name"])
@@ -0,0 +1,59 @@
+# Tests for bcl2_targets.py.  Run with python -m pytest from this directory.
+
+import os
+
+import pandas as pd
+import pytest
+
+from bcl2_targets import TargetIndex, load_index, normalize_target, target_responses
+
+DRUG_LIST = pd.DataFrame({"drug_id": [1, 2, 3, 4, 5],
+                          "Name": ["Navitoclax", "Venetoclax", "WEHI-539", "AZD5991", "Cisplatin"],
+                          "Targets": ["BCL2, Bcl-xL, BCL-W", "BCL2", "BCL-XL", "MCL1", None]})
+
+
+def test_normalize_target():
+    assert normalize_target(" Bcl-xL") == normalize_target("BCL2L1") == "BCL2L1"
+    assert normalize_target("bfl-1") == normalize_target("A1") == "BCL2A1"
+    assert normalize_target("DNA crosslinker") == "DNACROSSLINKER"
+
+
+def test_any_and_all():
+    index = TargetIndex.build(DRUG_LIST)
+    assert index.drugs(["BCL2", "MCL1"]) == [1, 2, 4]
+    assert index.drugs(["BCL2", "BCL-XL"], match="all") == [1]
+    assert index.drug_names("bcl-xl") == ["Navitoclax", "WEHI-539"]
+    assert index.drug_names(["BCL2", "BCL2L2"], match="all") == ["Navitoclax"]
+    assert index.drugs(["BCL2", "NOXA"], match="all") == []
+    assert index.drugs([]) == []
+    with pytest.raises(ValueError):
+        index.drugs("BCL2", match="some")
+
+
+def write_csvs(raw_data, drug_list):
+    drug_list.to_csv(os.path.join(raw_data, "gdsc_drug_list.csv"), index=False)
+    pd.DataFrame({"cell_line_name": ["A", "B"] * 5, "tissue_type": "blood", "cancer_type": "MM",
+                  "drug_id": [1, 2, 3, 4, 5] * 2, "drug_name": list(drug_list["Name"]) * 2,
+                  "putative_target": "BCL2", "auc": [n / 10 for n in range(10)]}
+                 ).to_csv(os.path.join(raw_data, "new_drug_response.csv"), index=False)
+
+
+def test_saved_index_and_responses(tmp_path):
+    raw_data, cache_dir = str(tmp_path / "raw_data"), str(tmp_path / "cache")
+    os.mkdir(raw_data)
+    write_csvs(raw_data, DRUG_LIST)
+    index = load_index(raw_data, cache_dir)
+    assert os.path.exists(os.path.join(cache_dir, "drug_targets.json"))
+    assert load_index(raw_data, cache_dir).targets == index.targets
+
+    families = target_responses(index, {"MCL1": ["MCL1"], "BCL-XL": ["BCL2L1"]}, columns=["auc"],
+                                raw_data=raw_data, cache_dir=cache_dir)
+    assert families["MCL1"]["auc"].tolist() == [0.3, 0.8]
+    assert families["BCL-XL"]["auc"].tolist() == [0.0, 0.2, 0.5, 0.7]
+    assert index.responses("BCL2", match="all", raw_data=raw_data,
+                           cache_dir=cache_dir)["drug_id"].tolist() == [1, 2, 1, 2]
+
+    # A changed drug list rebuilds the index
+    changed = DRUG_LIST.assign(Targets=["BCL2", "BCL2", "BCL-XL", "MCL1, BCL2", None])
+    write_csvs(raw_data, changed)
+    assert load_index(raw_data, cache_dir).drugs("BCL2") == [1, 2, 4]
@@ -1,5 +1,6 @@
-# Version 3.1
-# This script was designed to work with a single DMSO control and 9 drug doses.
+# Version 3.3
+# The drugs, dose series, and sheet name suffixes are read from drugs.json
+# (see ctg_registry.py).  The first dose of each series is the DMSO control.
 # Takes an .xls from a CellTiter-Glo assay analyzed on a plate reader
 # and outputs graphs for each sheet in the .xls.  Raw data and processed data
 # are stored in separate tables of a PostgreSQL database.  
@@ -21,14 +22,39 @@
 # tornado==6.0.3
 # xlrd==1.2.0
 
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
+import importlib.util
 import os
 import sys
 import argparse
 import re
-import psycopg2
+
+from ctg_registry import load_registry
+from ctg_storage import open_store
+from ctg_trace import NULL_SPAN, NULL_TRACER
+
+
+def lazy_import(name):
+    """Returns the module called name, which is only loaded when one of its
+    attributes is first used.  Keeps commands that never touch pandas or
+    numpy, such as ctg_cli.py validate, from paying for importing them."""
+
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+
+# Part of the cache key in ctg_cache.py, so change it when results would change
+VERSION = "3.3"
+
 
 # Set a loop or option to analyze all files in directory if desired
 def file_selection(input_path=os.getcwd()):
@@ -97,7 +123,7 @@ def experimental_parameter_check():
     """Sets variables for drug, doses, and units depending on the drug used for the experiment."""
 
     drug = None
-    drug_list = ["A-1155463", "AMG-176", "Venetoclax"]
+    drug_list = sorted(load_registry().drugs)
 
     while True:
         # Set up options for choosing drug used in experiment
@@ -111,21 +137,17 @@ def experimental_parameter_check():
         if drug_number.isnumeric():
             if int(drug_number) in range(0, len(drug_list)):
                 drug = drug_option_dict[int(drug_number)]
-                break
+                # Set doses and unit for proper drug
+                try:
+                    doses, unit = drug_parameters(drug)
+                    break
+                except ValueError as error:
+                    print(error)
 
         elif drug_number.lower() == "exit":
             print("Process aborted")
             sys.exit()
 
-    # Set doses and unit for proper drug
-    if drug in ["AMG-176", "Venetoclax"]:
-        doses = [0, 5, 16, 48, 144, 432, 1296, 3888, 11666, 35000]
-        unit = "nM"
-
-    elif drug == "A-1155463":
-        doses = []
-        unit = "nM"
-
     # Print experimental parameters for final check
     print("\n" + "Experimental Parameters:")
     print("Drug:", drug)
@@ -141,6 +163,27 @@ def experimental_parameter_check():
         sys.exit()
 
 
+def drug_parameters(drug):
+    """drug: The name of the drug used in the experiment.
+
+    Returns the doses and unit registered for the provided drug (see
+    ctg_registry.py).  Shared by experimental_parameter_check() and the
+    non-interactive batch mode.  Raises ValueError if the drug is unknown or
+    has no doses in the registry."""
+
+    return load_registry().parameters(drug)
+
+
+def valid_date(date):
+    """Returns True if date is formatted as yyyy-mm-dd."""
+    return re.search(r'^20\d{2}-\d{2}-\d{2}$', str(date)) is not None
+
+
+def valid_viability(viability):
+    """Returns True if viability is written as two digits or as 100."""
+    return re.search(r"^\d{2}$|^100$", str(viability)) is not None
+
+
 def date_and_experimenter():
     """A simple function that asks for input to determine who generated the data and
     when.  This information will be added to the SQL table for each experiment."""
@@ -148,8 +191,7 @@ def date_and_experimenter():
     # Loop to get correct date
     while True:
         date = input('What date was the plate read?  Format as yyyy-mm-dd.\n')
-        regex_pattern = '^20\d{2}-\d{2}-\d{2}$'
-        if re.search(regex_pattern, date):
+        if valid_date(date):
             break
         else:
             print("""\nThat is not a valid date.\n
@@ -169,6 +211,7 @@ def date_and_experimenter():
 def make_mean_df(means, stdev, cell_line):
     """
     means: The mean luminescence values from an xls document of a CTG experiment.
+    A list, NumPy array, or pandas Series.
 
     stdev: The standard deviation values from an xls document of a CTG experiment.
 
@@ -180,9 +223,10 @@ def make_mean_df(means, stdev, cell_line):
     into a data frame for plotting.
     """
 
-    normalized_mean = pd.Series(means/means[0], name="normalized_mean")
-    mean_df = pd.concat([means, stdev, normalized_mean], axis=1)
-    mean_df.columns = [cell_line, 'stdev', 'normalized_mean']
+    means = np.asarray(means, dtype=float)
+    stdev = np.asarray(stdev, dtype=float)
+    mean_df = pd.DataFrame({cell_line: means, 'stdev': stdev,
+                            'normalized_mean': means/means[0]})
 
     return mean_df
 
@@ -193,20 +237,86 @@ def clean_sheet_name(sheet, drug):
     drug: The name of the drug used in the experiment.
 
     Takes a sheet name and attempts to remove the underscore and
-    drug name if present.  If not present, the sheet name is unchanged.
-    This name will be used in naming of plots and saving data in postgreSQL."""
+    drug name if present, using the drug's aliases in the registry.  If not
+    present, the sheet name is unchanged.  This name will be used in naming
+    of plots and saving data in postgreSQL."""
+
+    return load_registry().cell_line(sheet, drug)
+
+
+def sheet_rows(xls_data, sheet):
+    """xls_data: Data from using pd.ExcelFile(path) on an xls or xlsx file.
+
+    sheet: The name of the sheet to read.
+
+    Reads every cell of the sheet once from the workbook that pandas already
+    opened and returns a list of rows.  Empty cells are None."""
+
+    book = xls_data.book
+    # xlrd workbook (.xls)
+    if hasattr(book, "sheet_by_name"):
+        worksheet = book.sheet_by_name(sheet)
+        return [[None if value == "" else value for value in worksheet.row_values(row)]
+                for row in range(worksheet.nrows)]
+    # openpyxl workbook (.xlsx)
+    return [list(row) for row in book[sheet].iter_rows(values_only=True)]
+
 
-    if drug == 'AMG-176':
-        drug_index = sheet.lower().find('_amg')
-        if drug_index != -1:
-            sheet = sheet[:drug_index]
+def read_sheet(xls_data, sheet, rows=None):
+    """xls_data: Data from using pd.ExcelFile(path) on an xls or xlsx file.
 
-    elif drug == 'Venetoclax':
-        drug_index = sheet.lower().find('_ven')
-        if drug_index != -1:
-            sheet = sheet[:drug_index]
+    sheet: The name of the sheet to read.
 
-    return sheet.lower()
+    rows: The cells of the sheet if sheet_rows() was already called for it.
+
+    Reads the sheet in a single pass and finds the header row by scanning
+    for a cell containing 'Lum', so the table does not need to start at A1.
+    Returns a dictionary with the Lum, Mean, and Std Dev columns as NumPy
+    arrays and the number of replicates from the Count column.
+
+    Raises ValueError if the sheet has no header row, is missing one of the
+    columns, or the number of wells does not match the number of means."""
+
+    if rows is None:
+        rows = sheet_rows(xls_data, sheet)
+
+    # Find the header row and the position of each column
+    for header_index, row in enumerate(rows):
+        header = [str(cell).strip() if cell is not None else None for cell in row]
+        if "Lum" in header:
+            break
+    else:
+        raise ValueError(f"Sheet '{sheet}' has no header row with a 'Lum' column.")
+    missing = [name for name in ["Mean", "Std Dev", "Count"] if name not in header]
+    if missing:
+        raise ValueError(f"Sheet '{sheet}' is missing the column(s): {', '.join(missing)}.")
+
+    def column(name):
+        # Values below the header, with empty cells removed
+        index = header.index(name)
+        values = [row[index] for row in rows[header_index+1:]
+                  if index < len(row) and row[index] is not None]
+        try:
+            return np.array(values, dtype=float)
+        except ValueError:
+            raise ValueError(f"Sheet '{sheet}' has a non-numeric value in the '{name}' column.")
+
+    lum = column("Lum")
+    means = column("Mean")
+    stdev = column("Std Dev")
+    count = column("Count")
+    if len(lum) == 0 or len(means) == 0 or len(count) == 0:
+        raise ValueError(f"Sheet '{sheet}' has no luminescence data below its header.")
+    replicates = int(count[0]) # Number of replicates for each drug dose
+    if replicates < 1 or len(lum) != replicates * len(means) or len(stdev) != len(means):
+        raise ValueError(f"Sheet '{sheet}' has {len(lum)} wells, {len(means)} means, and "
+                         f"{len(stdev)} standard deviations, which does not match "
+                         f"{replicates} replicates per dose.")
+    # Plate readers report whole numbers, so keep them as integers
+    if np.array_equal(lum, np.round(lum)):
+        lum = lum.astype(np.int64)
+
+    return {"lum": lum, "means": means, "stdev": stdev, "replicates": replicates}
 
 
 def parse_luminescence(xls_data, sheet, cell_line, drug, doses, experiment_date, experimenter, viability_dictionary):
@@ -238,19 +348,12 @@ def parse_luminescence(xls_data, sheet, cell_line, drug, doses, experiment_date,
     with other processed data in a separate PostgreSQL table (lum_drug_sens).
     """
 
-    # Parse xls for current sheet
-    # If results do not start at row 1 in xls, skip_rows increments until the header is found
-    skip_rows = 0
-    while True:
-        ctg_results = xls_data.parse(sheet, skiprows=skip_rows)
-        if 'Lum' not in ctg_results.columns:
-            skip_rows += 1
-        else:
-            break
-    lum = list(ctg_results['Lum'])
-    means = ctg_results['Mean'].dropna().reset_index(drop=True)
-    stdev = ctg_results['Std Dev'].dropna().reset_index(drop=True)
-    replicates = int(ctg_results['Count'][0]) # Number of replicates for each drug dose
+    # Parse xls for current sheet with a single read
+    ctg_results = read_sheet(xls_data, sheet)
+    lum = ctg_results['lum']
+    means = ctg_results['means']
+    stdev = ctg_results['stdev']
+    replicates = ctg_results['replicates'] # Number of replicates for each drug dose
 
     # Call make_mean_df to create a data frame for plotting luminescence
     mean_df = make_mean_df(means, stdev, cell_line)
@@ -262,7 +365,7 @@ def parse_luminescence(xls_data, sheet, cell_line, drug, doses, experiment_date,
         # Make a list with experimental parameters
         experimental_parameters = [experiment_date, experimenter, drug, cell_line, 'well_' + str(n+1)]
         # Extend the list with raw luminescence for the respective well (every fourth value usually)
-        experimental_parameters.extend(lum[n::replicates])
+        experimental_parameters.extend(lum[n::replicates].tolist())
         raw_data.append(experimental_parameters)
 
     # Prepare processed_data list for insertion into lum_drug_sens table in PostgreSQL
@@ -275,7 +378,7 @@ def parse_luminescence(xls_data, sheet, cell_line, drug, doses, experiment_date,
     return mean_df, raw_data, processed_data
 
 
-def data_to_sql(raw_data, processed_data):
+def data_to_sql(raw_data, processed_data, store=None):
     """
     raw_data: a list of lists containing raw luminescence values for each well of a CTG experiment
     and some experimental parameters.
@@ -283,24 +386,21 @@ def data_to_sql(raw_data, processed_data):
     processed_data: a list of experimental parameters, area under the curve (AUSC),
     viability of the cell line, and mean luminescence values.
 
+    store: A LuminescenceStore from ctg_storage.open_store().  The rows are added
+    to its buffer and written when the store is flushed, which ctg_analysis()
+    does once per workbook.  If no store is provided, a connection is opened
+    and the rows are written immediately.
+
     Returns nothing.  Inserts raw_data into the raw_lum SQL table, and inserts processed_data
     into the lum_drug_sens SQL table.
     """
+    if store is not None:
+        store.add(raw_data, processed_data)
+        return
+
     # Connect to postgres database
-    with psycopg2.connect('dbname=mcl1 user=blixt007') as conn:
-        cur = conn.cursor()
-        
-        # Insert the raw luminescence data into raw_lum from the nested list
-        for row in raw_data:
-            # Add column names to avoid inserting into first column (auto-increment)
-            cur.execute("""INSERT INTO raw_lum( 
-            created_on, created_by, drug, cell_line_str, well,
-            dose_1, dose_2, dose_3, dose_4, dose_5, dose_6, dose_7, dose_8, dose_9, dose_10)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);""", tuple(row))
-
-        # Insert the processed data into lum_drug_sens
-        cur.execute("""INSERT INTO lum_drug_sens
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);""", tuple(processed_data))
+    with open_store() as store:
+        store.add(raw_data, processed_data)
 
     return
 
@@ -308,6 +408,9 @@ def data_to_sql(raw_data, processed_data):
 def vbar_luminescence_plot(mean_df, doses, drug, unit, path):
     """Creates a vertical bar plot in Matplotlib.pyplot using the
     raw luminescence values from the mean_df.  Saves a PNG file."""
+    # Imported here so only plotting pays for loading pyplot
+    import matplotlib.pyplot as plt
+
     # Create a new series without the drug name but with dose and unit
     x_axis_labels = [str(dose) + ' nM' for dose in doses]
 
@@ -344,6 +447,8 @@ def survival_plot(mean_df, doses, drug, unit, path):
 
     A .png file is saved in the subdirectory with the other data.
     """
+    import matplotlib.pyplot as plt
+
     # Adds one to every value so log scale can be used (log 1 = 0)
     x_axis_labels = [x+1 for x in doses]
 
@@ -405,8 +510,7 @@ def viability_dict(sheets, drug):
             while True:
                 cell_line = clean_sheet_name(sheet, drug)
                 viability = input(f"What is the percent viability from 0-100 for {cell_line}?\n")
-                regex_pattern = "^\d{2}$|^100$"
-                if re.search(regex_pattern, viability):
+                if valid_viability(viability):
                     viability_dictionary[cell_line] = int(viability)
                     break
                 else:
@@ -425,7 +529,10 @@ def viability_dict(sheets, drug):
     return viability_dictionary
 
 
-def ctg_analysis(file, doses, unit, drug, replicates=4):
+def ctg_analysis(file, doses, unit, drug, replicates=None, viability_dictionary=None,
+                 experiment_date=None, experimenter=None, overwrite=None, store=None,
+                 plots="png", plot_executor=None, cache=None, sheets=None, tracer=None, qc=None,
+                 fit_cache=None):
     """Takes the raw luminescence data (Lum column) from a CellTiter-Glo (CTG) .xls
     document located at path/file and saves an individual .csv for
     each sheet in the .xls.  These files will be saved in a new folder
@@ -446,28 +553,140 @@ def ctg_analysis(file, doses, unit, drug, replicates=4):
     Drug is the name of the primary drug used in the dose range provided.  This will
     be provided by experimental_parameter_check().
 
-    Replicates is the number of wells used per dose.  4 is the default.
+    Replicates is the number of wells used per dose, from the drug's plate
+    layout in the registry.  If provided, a sheet with a different number of
+    wells per dose raises ValueError.  Otherwise the Count column is used.
+
+    Sheets limits the analysis to the named sheets, for workbooks holding
+    more than one drug.  The PDF and PNG plots are then named after the drug
+    as well, so the drugs of a workbook do not overwrite each other's plots.
+
+    Viability_dictionary, experiment_date, and experimenter are requested with
+    input() when not provided.  Overwrite decides what happens when the data
+    directory already exists: None asks the user, True continues, and False
+    raises FileExistsError.  Providing all four makes the function
+    non-interactive for use in batch mode (see ctg_batch.py).
+
+    Store is a LuminescenceStore from ctg_storage.py.  All sheets are written
+    to the database in one transaction at the end of the workbook.  If no
+    store is provided, one is opened for this workbook and closed afterwards.
+
+    Plots is "png" for a bar plot and survival plot per cell line, "pdf" for a
+    single multi-page PDF per workbook, or "none" to skip plotting (see
+    ctg_plot.py).  If plot_executor is provided, the plots are rendered there
+    after the database write and the future is returned so the caller can
+    continue with the next workbook.
+
+    Cache is an AnalysisCache from ctg_cache.py.  If the workbook was already
+    analyzed with the same parameters and has not changed, nothing is done
+    and None is returned.  Otherwise only new or changed sheets are analyzed,
+    and their previous rows in the database are replaced.  Using a cache
+    requires viability_dictionary, experiment_date, and experimenter, and
+    implies overwrite=True.
+
+    Qc is "flag" to check every plate for outlier wells and store the
+    verdicts in lum_qc, "drop" to also leave the outliers out of the means
+    used for normalization and AUSC, or None to skip QC (see ctg_qc.py).
+
+    Fit_cache is a FitCache from ctg_fit.py whose previous fits of each cell
+    line and drug are used to warm start the curve fits.  It is updated with
+    the new fits, and saving it is left to the caller.
+
+    Tracer is a Tracer from ctg_trace.py that times each stage of the
+    workbook and each sheet, with the rows written, bytes read, and plots
+    made.  Nothing is recorded if it is None.
+
+    The data table does not need to start at A1 in the provided .xls.  Each
+    sheet is read once by read_sheet(), which raises ValueError for sheets
+    without a recognizable table."""
+
+    if tracer is None:
+        tracer = NULL_TRACER
+    job = workbook_job(file, doses, unit, drug, replicates, viability_dictionary, experiment_date,
+                       experimenter, overwrite, plots, sheets, qc, fit_cache)
+    with tracer.stage("workbook", file=file) as workbook_span:
+        if not read_workbook(job, cache, tracer, workbook_span):
+            return None
+
+        # Open a database connection for this workbook if the caller did not provide one
+        own_store = store is None
+        if own_store:
+            store = open_store()
+        try:
+            compute_workbook(job, tracer)
+            write_workbook(job, store, cache, tracer)
+        finally:
+            if own_store:
+                store.close()
+
+        # Plots are made after the data is safely in the database
+        return plot_workbook(job, plot_executor, tracer)
+
+
+def workbook_job(file, doses, unit, drug, replicates=None, viability_dictionary=None,
+                 experiment_date=None, experimenter=None, overwrite=None, plots="png",
+                 sheets=None, qc=None, fit_cache=None):
+    """Returns a dictionary of the parameters of ctg_analysis() for one
+    workbook, which the stages read_workbook(), compute_workbook(),
+    write_workbook(), and plot_workbook() add their results to.  The stages
+    are run in order by ctg_analysis(), or overlapped across workbooks by
+    ctg_pipeline.py."""
+
+    if qc not in [None, "flag", "drop"]:
+        raise ValueError(f"qc must be 'flag', 'drop', or None, not {qc}")
+    return {"file": file, "doses": doses, "unit": unit, "drug": drug, "replicates": replicates,
+            "viability_dictionary": viability_dictionary, "experiment_date": experiment_date,
+            "experimenter": experimenter, "overwrite": overwrite, "plots": plots,
+            "requested_sheets": sheets, "qc": qc, "fit_cache": fit_cache}
+
+
+def read_workbook(job, cache=None, tracer=NULL_TRACER, span=NULL_SPAN):
+    """
+    job: A dictionary from workbook_job().
+
+    cache: An AnalysisCache, see ctg_analysis().
+
+    span: The span that records the bytes read.
+
+    Opens the workbook, makes its data directory, asks for any parameters
+    not in the job, and reads the cells of each sheet.  Returns False if the
+    cache shows nothing has changed, so the other stages are skipped.
+    """
 
-    Note that this funtion will probably fail if the data table does not
-    start at A1 in the provided .xls.  I plan to fix this in a future version."""
+    file, drug, overwrite = job["file"], job["drug"], job["overwrite"]
+
+    # Skip the workbook before reading it if it has not changed since the last analysis
+    if cache is not None:
+        if (job["viability_dictionary"] is None or job["experiment_date"] is None
+                or job["experimenter"] is None):
+            raise ValueError("A cache requires viability_dictionary, experiment_date, and experimenter.")
+        from ctg_cache import analysis_key
+        job["workbook_key"] = analysis_key(drug, job["unit"], job["doses"], job["experiment_date"],
+                                           job["experimenter"], job["viability_dictionary"], job["qc"])
+        if cache.workbook_unchanged(file, job["workbook_key"], drug):
+            print(f"{file} has not changed since it was last analyzed.")
+            return False
+        overwrite = True
 
     # Load the excel file with the CTG results and list the name of the sheets.
     xls_data = pd.ExcelFile(file)
+    span.add("bytes_read", os.path.getsize(file))
     sheets = xls_data.sheet_names
     # Remove unnamed sheets (Sheet1, Sheet2, etc.)
     sheets = [sheet for sheet in sheets if not sheet.startswith("Sheet")]
+    if job["requested_sheets"] is not None:
+        sheets = [sheet for sheet in sheets if sheet in job["requested_sheets"]]
     # Removes the file extension and adds "_data" for creating the directory name
-    sub_dir = file[:-4] + "_data"
-
+    sub_dir = os.path.splitext(file)[0] + "_data"
 
-#### Change so it asks if the folder should be deleted if present
-#### Make a separate function to call??
     # Make a new directory for storing plots
     try:
         os.mkdir(sub_dir)
     # Asks to overwrite files if directory already exists
     except FileExistsError:
-        while True:
+        if overwrite is False:
+            raise
+        while overwrite is None:
             print("This file has already been analyzed.")
             print("Should the data be overwritten?")
             overwrite_answer = input('Y/N? ')
@@ -479,40 +698,226 @@ def ctg_analysis(file, doses, unit, drug, replicates=4):
                 sys.exit()
 
     # Call the viability_dict function to obtain the viability for each cell line
-    viability_dictionary = viability_dict(sheets, drug)
+    if job["viability_dictionary"] is None:
+        job["viability_dictionary"] = viability_dict(sheets, drug)
 
     # Determine date of creation and experimenter who created the data
-    experiment_date, experimenter = date_and_experimenter()
+    if job["experiment_date"] is None or job["experimenter"] is None:
+        job["experiment_date"], job["experimenter"] = date_and_experimenter()
 
-    # Iterate over the sheets to process raw data and make graphs
+    # Read each sheet once and leave out sheets the cache shows are unchanged
+    rows = {}
     for sheet in sheets:
-        cell_line = clean_sheet_name(sheet, drug)
-        # Functions to process each cell line's data
-        mean_df, raw_data, processed_data = parse_luminescence(
-            xls_data, sheet, cell_line, drug, doses, experiment_date, experimenter, viability_dictionary)
-        data_to_sql(raw_data, processed_data)
-        # SET UP ARGPARSE FLAG TO SKIP GRAPHS IF DESIRED
-        vbar_luminescence_plot(mean_df, doses, drug, unit, sub_dir)
-        survival_plot(mean_df, doses, drug, unit, sub_dir)
+        with tracer.stage("read_sheet", file=file, sheet=sheet):
+            rows[sheet] = sheet_rows(xls_data, sheet)
+    plot_sheets = sheets
+    if cache is not None:
+        from ctg_cache import sheet_key
+        job["sheet_keys"] = {sheet: sheet_key(rows[sheet], job["workbook_key"]) for sheet in sheets}
+        changed = [sheet for sheet in sheets
+                   if not cache.sheet_unchanged(file, sheet, job["sheet_keys"][sheet])]
+        if not changed:
+            cache.record(file, job["workbook_key"], job["sheet_keys"], drug)
+            print(f"No sheets in {file} have changed since it was last analyzed.")
+            return False
+        # The PDF holds every sheet, so it is made again from all of them;
+        # PNG plots are only made again for the changed sheets
+        if job["plots"] != "pdf":
+            plot_sheets = changed
+        sheets = changed
+
+    job.update({"xls_data": xls_data, "sheets": sheets, "plot_sheets": plot_sheets,
+                "sub_dir": sub_dir, "rows": rows})
+    return True
+
+
+def compute_workbook(job, tracer=NULL_TRACER):
+    """
+    job: A dictionary from read_workbook().
 
-    return
+    Normalizes and calculates AUSC for every sheet at once, fits the
+    dose-response curves (warm started from the job's fit_cache, if any),
+    and checks the plates if QC is on.  Adds the
+    mean data frames of each sheet to be plotted and the database rows of
+    each sheet to be written to the job.
+    """
+
+    # Imported here because ctg_engine uses functions from this file
+    from ctg_engine import analyze_plates, long_rows, sheet_results, stack_sheets
+    from ctg_fit import fit_plates, fit_rows
+
+    file, drug, doses, qc = job["file"], job["drug"], job["doses"], job["qc"]
+    experiment_date, experimenter = job["experiment_date"], job["experimenter"]
+    # Sheets that are only plotted are analyzed too, but not written
+    sheets = job["plot_sheets"]
+    written = [n for n, sheet in enumerate(sheets) if sheet in job["sheets"]]
+    with tracer.stage("analyze", file=file, sheets=len(sheets)):
+        plates = stack_sheets(job["xls_data"], sheets, drug, job["rows"])
+        if qc is not None:
+            from ctg_qc import plate_qc, qc_rows
+            qc_results = plate_qc(plates)
+        plates = analyze_plates(plates, doses,
+                                outliers=qc_results["outliers"] if qc == "drop" else None)
+        if job["replicates"] is not None and plates["lum"].shape[1] != job["replicates"]:
+            raise ValueError(f"{file} has {plates['lum'].shape[1]} wells per dose, "
+                             f"but the plate layout of {drug} has {job['replicates']}.")
+        mean_dfs, sheet_data = [], []
+        for index in range(len(sheets)):
+            mean_df, raw_data, processed_data = sheet_results(
+                plates, index, drug, experiment_date, experimenter, job["viability_dictionary"])
+            mean_dfs.append(mean_df)
+            if index not in written:
+                continue
+            # One row per well and dose, for any number of doses and replicates
+            well_rows, response_rows = long_rows(plates, index, drug, experiment_date,
+                                                 experimenter, doses, job["unit"])
+            sheet_data.append((raw_data, processed_data, well_rows, response_rows))
+    # Fit a dose-response curve to every cell line, skipped if no doses are above 0
+    fitted = []
+    if any(dose > 0 for dose in doses):
+        with tracer.stage("fit", file=file):
+            fits = fit_plates(plates, doses, drug, job["fit_cache"])
+            fitted = fit_rows(plates, fits, drug, experiment_date, experimenter)
+    verdicts = []
+    if qc is not None:
+        verdicts = qc_rows(plates, qc_results, drug, experiment_date, experimenter, qc == "drop")
+
+    job.update({"cell_lines": [plates["cell_lines"][n] for n in written], "mean_dfs": mean_dfs,
+                "sheet_data": sheet_data, "fit_rows": [fitted[n] for n in written] if fitted else [],
+                "qc_rows": [verdicts[n] for n in written] if verdicts else []})
+
+
+def write_workbook(job, store, cache=None, tracer=NULL_TRACER):
+    """
+    job: A dictionary from compute_workbook().
 
+    store: A LuminescenceStore from ctg_storage.py.
+
+    cache: An AnalysisCache, see ctg_analysis().
+
+    Writes every sheet of the workbook to the database in one transaction,
+    then records the workbook in the cache.  Nothing is left in the store's
+    buffer if the write fails.
+    """
+
+    file, drug = job["file"], job["drug"]
+    try:
+        # Replace rows from a previous analysis of these sheets instead of duplicating them
+        if cache is not None:
+            store.replace_experiments([(cell_line, job["experiment_date"], job["experimenter"], drug)
+                                       for cell_line in job["cell_lines"]])
+        for sheet, (raw_data, processed_data, well_rows, response_rows) in zip(job["sheets"],
+                                                                             job["sheet_data"]):
+            with tracer.stage("store", file=file, sheet=sheet):
+                data_to_sql(raw_data, processed_data, store)
+                store.add_long(well_rows, response_rows)
+        if job["fit_rows"]:
+            store.add_fits(job["fit_rows"])
+        if job["qc_rows"]:
+            store.add_qc(job["qc_rows"])
+        # Write every sheet of the workbook in one transaction
+        with tracer.stage("flush", file=file) as flush_span:
+            # Counted once committed, so failed transactions are not
+            flush_span.add("rows_written", store.flush())
+    except Exception:
+        # Never leave part of a failed workbook in a shared store's buffer
+        store.clear()
+        raise
+
+    # Only record the workbook once its rows are in the database
+    if cache is not None:
+        workbook_key, sheet_keys = job["workbook_key"], job["sheet_keys"]
+        store.when_written(lambda: cache.record(file, workbook_key, sheet_keys, drug))
+
+
+def plot_workbook(job, plot_executor=None, tracer=NULL_TRACER):
+    """
+    job: A dictionary from compute_workbook().
+
+    plot_executor: See ctg_analysis().
+
+    Renders the plots of the workbook.  Returns the number of plots made, or
+    a future of it if plot_executor is provided.
+    """
+
+    file, plots = job["file"], job["plots"]
+    if plots == "none" and plot_executor is None:
+        # Nothing to render, so matplotlib is never imported
+        return 0
+    from ctg_plot import render_plots
+    workbook_name = os.path.basename(os.path.splitext(file)[0])
+    # The drugs of one workbook share its data directory, so their plots are named after the drug
+    tag = None
+    if job["requested_sheets"] is not None:
+        workbook_name += "_" + job["drug"]
+        tag = job["drug"]
+    with tracer.stage("plots", file=file, mode=plots) as span:
+        result = render_plots(job["mean_dfs"], job["doses"], job["drug"], job["unit"], job["sub_dir"],
+                              plots, plot_executor, workbook_name, tag)
+        if plot_executor is None:
+            span.add("plots", result)
+        elif tracer.enabled:
+            # Counted when the other process has finished them
+            def count_plots(future):
+                if future.exception() is None:
+                    tracer.count("plots", future.result(), file=file)
+            result.add_done_callback(count_plots)
+    return result
+
+
+def main(argv=None):
+    """Command line entry point for the interactive analysis, also run by
+    ctg_cli.py analyze."""
 
-if __name__ == "__main__":
     # Create parser for running script on command line
     ctg_parser = argparse.ArgumentParser(description="Provides the input path for analysis.")
     ctg_parser.add_argument("-i",
                             dest="input",
                             help="The path containing data to be analyzed.")
-    args = ctg_parser.parse_args()
+    ctg_parser.add_argument("--plots", choices=["png", "pdf", "none"], default="png",
+                            help="Save PNG plots, one PDF per file, or no plots.")
+    ctg_parser.add_argument("--qc", choices=["flag", "drop"], default=None,
+                            help="Check plates for outlier wells, and with drop leave them out of the means.")
+    ctg_parser.add_argument("--log-stages", action="store_true",
+                            help="Log the time of each stage as JSON (see ctg_trace.py).")
+    ctg_parser.add_argument("--trace", default=None,
+                            help="Append the time of each stage to this JSON lines file.")
+    ctg_parser.add_argument("--metrics", default=None,
+                            help="Write the stage totals in Prometheus text format to this file.")
+    ctg_parser.add_argument("--profile", default=None,
+                            help="Save cProfile statistics of the run to this file.")
+    args = ctg_parser.parse_args(argv)
     input_path = args.input
 
-    # Process data
-    while True:
-        file = file_selection(input_path)
-        doses, unit, drug = experimental_parameter_check()
-        ctg_analysis(file, doses, unit, drug)
-        print('Would you like to analyze another file?')
-        continue_analysis = input('Y/N: ')
-        if continue_analysis.lower() == 'n': # Repeat analysis if not 'n'
-            break
+    from ctg_trace import Tracer, profiled
+    tracer = None
+    if args.log_stages or args.trace or args.metrics:
+        tracer = Tracer(args.trace, log=args.log_stages)
+    if args.log_stages:
+        import logging
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    # Process data using one database connection for every file
+    # Plots are rendered in a separate process while the next file is chosen
+    from concurrent.futures import ProcessPoolExecutor
+    with profiled(args.profile), open_store() as store, \
+            ProcessPoolExecutor(max_workers=1) as plot_executor:
+        while True:
+            file = file_selection(input_path)
+            doses, unit, drug = experimental_parameter_check()
+            plot_job = ctg_analysis(file, doses, unit, drug, store=store,
+                                    plots=args.plots, plot_executor=plot_executor, tracer=tracer,
+                                    qc=args.qc)
+            plot_job.add_done_callback(
+                lambda job: job.exception() and print(f"\nPlotting failed: {job.exception()}"))
+            print('Would you like to analyze another file?')
+            continue_analysis = input('Y/N: ')
+            if continue_analysis.lower() == 'n': # Repeat analysis if not 'n'
+                break
+    # Written after the plot process has finished, so every plot is counted
+    if args.metrics:
+        tracer.write_metrics(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,530 @@
+# Non-interactive batch mode for ctg_analysis.py.
+# Runs ctg_analysis() on every .xls/.xlsx file in a directory (or matching a glob)
+# across a pool of worker processes.  The answers normally given at the prompts
+# (drug, date, experimenter, and viability of each cell line) are read from a
+# manifest file instead.
+#
+# Manifest formats:
+#
+# The drug may be left out.  Each sheet's drug is then found from the suffix
+# of its name (e.g. "mm1s_amg") using the aliases in drugs.json, so one
+# workbook may hold several drugs.  See ctg_registry.py.
+#
+# JSON - an optional "defaults" entry is applied to every file.
+# {
+#     "defaults": {"drug": "AMG-176", "experimenter": "NB"},
+#     "files": {
+#         "mcl20191017_amg176.xls": {"date": "2019-10-17",
+#                                    "viability": {"mm1s": 95, "lp1": 90}}
+#     }
+# }
+#
+# A cell line's viability may instead be given per drug, for workbooks in
+# which it was plated separately for each drug:
+#     "viability": {"mm1s": {"AMG-176": 95, "Venetoclax": 88}, "lp1": 90}
+#
+# CSV - one row per cell line (and drug) with the columns:
+# file,drug,date,experimenter,cell_line,viability
+# A row's viability applies only to its drug.  If the rows of a file name
+# different drugs, the drug of each sheet is found from its name.
+#
+# Usage:
+# python ctg_batch.py -i /path/to/exports -m manifest.json -w 8
+# python ctg_batch.py -i "/path/to/exports/*_amg176.xls" -m manifest.csv --overwrite
+# python ctg_batch.py -i /path/to/exports -m manifest.json --cache analyzed.db
+# python ctg_batch.py -i /path/to/exports -m manifest.json --trace spans.jsonl --metrics batch.prom
+#
+# With --trace, every worker appends the time of each stage of each workbook
+# to the same JSON lines file (see ctg_trace.py), and --metrics sums them
+# into Prometheus text at the end.  --profile saves cProfile statistics of
+# each worker to <profile>.<pid>.
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.util import Finalize
+
+# Plots are only saved to file, so never start a GUI backend in the workers.
+# Set before matplotlib is imported, which only happens when plotting.
+os.environ["MPLBACKEND"] = "Agg"
+
+from ctg_analysis import ctg_analysis, drug_parameters, valid_date, valid_viability
+from ctg_cache import AnalysisCache, analysis_key
+from ctg_registry import load_registry
+from ctg_storage import DEFAULT_DSN, open_store
+from ctg_trace import Tracer, read_trace
+
+# Each worker process keeps one database connection for all of its workbooks
+_store = None
+_cache = None
+_tracer = None
+
+
+def init_worker(dsn, cache_path=None, trace_path=None, profile_path=None):
+    """Opens the database connection and analysis cache of a worker process.
+    Used as the initializer of the process pool in run_batch().  If
+    trace_path is provided, the stages of each workbook are appended to it.
+    If profile_path is provided, the worker is profiled until it exits."""
+    global _store, _cache, _tracer
+    _store = open_store(dsn)
+    # Close the store when the worker exits, which finishes any Parquet files
+    Finalize(_store, _store.close, exitpriority=10)
+    if cache_path is not None:
+        _cache = AnalysisCache(cache_path)
+    if trace_path is not None:
+        _tracer = Tracer(trace_path)
+    if profile_path is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        Finalize(profiler, lambda: (profiler.disable(),
+                                    profiler.dump_stats(f"{profile_path}.{os.getpid()}")),
+                 exitpriority=5)
+
+
+def find_workbooks(input_path):
+    """
+    input_path: A directory or a glob pattern.
+
+    Returns a sorted list of the .xls and .xlsx files in the directory or
+    matching the glob pattern.
+    """
+
+    if os.path.isdir(input_path):
+        paths = [os.path.join(input_path, file) for file in os.listdir(input_path)]
+    else:
+        paths = glob.glob(input_path)
+
+    return sorted(path for path in paths
+                  if path.endswith(".xls") or path.endswith(".xlsx"))
+
+
+def load_manifest(manifest_path):
+    """
+    manifest_path: The path to a .json or .csv manifest (see the top of this file).
+
+    Returns a dictionary keyed by the file name of each workbook.  Each value
+    is a dictionary with drug, date, experimenter, and viability (itself a
+    dictionary of cell line, or of (cell line, drug) for viabilities given
+    per drug, to viability).  See viability_for().
+    """
+
+    manifest = {}
+    if manifest_path.endswith(".json"):
+        with open(manifest_path) as manifest_file:
+            contents = json.load(manifest_file)
+        defaults = contents.get("defaults", {})
+        for file, entry in contents.get("files", {}).items():
+            parameters = dict(defaults)
+            parameters.update(entry)
+            viability = {}
+            for cell_line, value in parameters.get("viability", {}).items():
+                if isinstance(value, dict):
+                    for drug, drug_viability in value.items():
+                        viability[(cell_line.lower(), drug)] = drug_viability
+                else:
+                    viability[cell_line.lower()] = value
+            parameters["viability"] = viability
+            manifest[os.path.basename(file)] = parameters
+
+    elif manifest_path.endswith(".csv"):
+        with open(manifest_path, newline="") as manifest_file:
+            for row in csv.DictReader(manifest_file):
+                file = os.path.basename(row["file"])
+                drug = (row.get("drug") or "").strip() or None
+                parameters = manifest.setdefault(
+                    file, {"drug": drug, "date": row["date"],
+                           "experimenter": row["experimenter"], "viability": {}})
+                # Several drugs in one workbook are told apart by the sheet names
+                if parameters["drug"] != drug:
+                    parameters["drug"] = None
+                cell_line = row["cell_line"].strip().lower()
+                parameters["viability"][cell_line if drug is None else (cell_line, drug)] = \
+                    row["viability"].strip()
+
+    else:
+        raise ValueError(f"Manifest must be a .json or .csv file: {manifest_path}")
+
+    return manifest
+
+
+def check_parameters(file, parameters):
+    """
+    file: The name of the workbook the parameters belong to.
+
+    parameters: One entry of the dictionary returned by load_manifest().
+
+    Applies the same checks as the interactive prompts and returns a list of
+    problems.  An empty list means the parameters can be used.
+    """
+
+    problems = []
+    for key in ["date", "experimenter"]:
+        if not parameters.get(key):
+            problems.append(f"{file}: missing {key}")
+    if parameters.get("drug"):
+        try:
+            drug_parameters(parameters["drug"])
+        except ValueError as error:
+            problems.append(f"{file}: {error}")
+    if parameters.get("date") and not valid_date(parameters["date"]):
+        problems.append(f"{file}: {parameters['date']} is not a valid date (yyyy-mm-dd)")
+    if len(str(parameters.get("experimenter", ""))) > 3:
+        problems.append(f"{file}: initials should not be longer than 3 letters")
+    for key, viability in parameters.get("viability", {}).items():
+        cell_line = key if isinstance(key, str) else f"{key[0]} with {key[1]}"
+        if not valid_viability(viability):
+            problems.append(f"{file}: {viability} is not a valid viability for {cell_line}")
+        if not isinstance(key, str):
+            try:
+                load_registry().drug_name(key[1])
+            except ValueError as error:
+                problems.append(f"{file}: {error} (viability of {key[0]})")
+
+    return problems
+
+
+def viability_for(parameters, drug=None):
+    """
+    parameters: One entry of the dictionary returned by load_manifest().
+
+    drug: The drug the viabilities are for.
+
+    Returns the viability dictionary of a manifest entry for one drug, with
+    integer values, as passed to ctg_analysis().  Viabilities given for the
+    drug replace those given for the cell line alone.
+    """
+
+    viability = {}
+    per_drug = {}
+    registry = load_registry()
+    for key, value in parameters["viability"].items():
+        if isinstance(key, str):
+            viability[key] = int(value)
+        elif drug is not None and registry.drug_name(key[1]) == registry.drug_name(drug):
+            per_drug[key[0]] = int(value)
+    viability.update(per_drug)
+    return viability
+
+
+def manifest_keys(path, parameters, qc=None):
+    """
+    path: The path of a workbook.
+
+    parameters: The manifest entry for this workbook.
+
+    Returns a dictionary of each drug of the workbook to its
+    ctg_cache.analysis_key(), for checking the cache before the workbook is
+    analyzed.  If the entry has no drug, the drugs are found from the sheet
+    names, which are read without the cells.  Returns None if the drugs
+    cannot be found, so the analysis reports the problem.
+    """
+
+    if parameters.get("drug"):
+        drugs = [load_registry().drug_name(parameters["drug"])]
+    else:
+        try:
+            drugs = list(plan_workbook(path, parameters))
+        except Exception:
+            return None
+    keys = {}
+    for drug in drugs:
+        doses, unit = drug_parameters(drug)
+        keys[drug] = analysis_key(drug, unit, doses, parameters["date"],
+                                  parameters["experimenter"].upper(),
+                                  viability_for(parameters, drug), qc)
+    return keys
+
+
+def workbook_unchanged(cache, path, parameters, qc=None):
+    """Returns True if every drug of a workbook was already analyzed with the
+    parameters of its manifest entry and the workbook has not changed since.
+    Costs a stat() (or a hash if the file was touched) instead of an analysis."""
+    keys = manifest_keys(path, parameters, qc)
+    return bool(keys) and all(cache.workbook_unchanged(path, key, drug)
+                              for drug, key in keys.items())
+
+
+def sheet_names(path):
+    """Returns the sheet names of an .xls or .xlsx workbook without reading
+    its cells or importing pandas."""
+
+    if path.lower().endswith(".xls"):
+        import xlrd
+        workbook = xlrd.open_workbook(path, on_demand=True)
+        try:
+            return workbook.sheet_names()
+        finally:
+            workbook.release_resources()
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+
+def plan_workbook(path, parameters):
+    """
+    path: The path of a workbook.
+
+    parameters: The manifest entry for this workbook.
+
+    Returns a dictionary of each drug to the sheets analyzed with it (None
+    for every sheet).  If the manifest entry has no drug, the sheets are
+    grouped by the drug their names resolve to.  Raises ValueError or
+    KeyError if a sheet has no drug, a drug has no doses, or a cell line
+    has no viability, so nothing is written for a workbook that would fail.
+    """
+
+    registry = load_registry()
+    sheets = [sheet for sheet in sheet_names(path) if not sheet.startswith("Sheet")]
+
+    # Drug: the sheets analyzed with it
+    if parameters.get("drug"):
+        groups = {registry.drug_name(parameters["drug"]): None}
+        sheet_drugs = {sheet: registry.drug_name(parameters["drug"]) for sheet in sheets}
+    else:
+        groups = {}
+        sheet_drugs = {}
+        for sheet in sheets:
+            _, drug = registry.resolve_sheet(sheet)
+            if drug is None:
+                raise ValueError(f"No drug in the registry matches the sheet name {sheet}")
+            groups.setdefault(drug, []).append(sheet)
+            sheet_drugs[sheet] = drug
+
+    for drug in groups:
+        registry.parameters(drug)
+    viability = {drug: viability_for(parameters, drug) for drug in groups}
+    missing = [f"{registry.cell_line(sheet, drug)} ({drug})" for sheet, drug in sheet_drugs.items()
+               if registry.cell_line(sheet, drug) not in viability[drug]]
+    if missing:
+        raise KeyError(f"No viability in the manifest for: {', '.join(missing)}")
+
+    return groups
+
+
+def validate(paths, manifest):
+    """
+    paths: List of workbook paths from find_workbooks().
+
+    manifest: Dictionary from load_manifest().
+
+    Checks every workbook as run_batch() would, reading only sheet names,
+    and prints one line per file.  Returns a list of (path, problems) tuples.
+    """
+
+    results = []
+    for path in paths:
+        file = os.path.basename(path)
+        if file not in manifest:
+            problems = [f"{file}: not listed in manifest"]
+        else:
+            problems = check_parameters(file, manifest[file])
+        if not problems:
+            try:
+                plan_workbook(path, manifest[file])
+            except (OSError, ValueError, KeyError) as error:
+                problems.append(f"{file}: {type(error).__name__}: {error}")
+        results.append((path, problems))
+        print(f"FAILED {'; '.join(problems)}" if problems else f"OK     {file}")
+    return results
+
+
+def drug_groups(path, parameters, overwrite=False):
+    """
+    path: The path of a workbook.
+
+    parameters: The manifest entry for this workbook.
+
+    overwrite: Passed to ctg_analysis() for the first drug.
+
+    Returns the arguments of ctg_analysis() (or ctg_analysis.workbook_job())
+    for each drug of the workbook, from plan_workbook().  Raises the errors
+    of plan_workbook() before anything is written.
+    """
+
+    registry = load_registry()
+    groups = plan_workbook(path, parameters)
+    arguments = []
+    for n, (drug, drug_sheets) in enumerate(groups.items()):
+        doses, unit = registry.parameters(drug)
+        arguments.append({"file": path, "doses": doses, "unit": unit, "drug": drug,
+                          "replicates": registry.layout(drug).get("replicates"),
+                          "viability_dictionary": viability_for(parameters, drug),
+                          "experiment_date": parameters["date"],
+                          "experimenter": parameters["experimenter"].upper(),
+                          # The data directory was made by the first drug
+                          "overwrite": overwrite if n == 0 else True,
+                          "sheets": drug_sheets})
+    return arguments
+
+
+def analyze_workbook(path, parameters, overwrite=False, plots="png", qc=None):
+    """
+    path: The path of the workbook to analyze.
+
+    parameters: The manifest entry for this workbook.
+
+    overwrite: Passed to ctg_analysis().  When False, workbooks that were
+    already analyzed are reported as failures instead of prompting.
+
+    plots: "png", "pdf", or "none".  Passed to ctg_analysis().
+
+    qc: "flag", "drop", or None.  Passed to ctg_analysis().
+
+    Runs ctg_analysis() without prompting.  This is the function run by each
+    worker process.  If the manifest entry has no drug, the sheets are grouped
+    by the drug their names resolve to and each group is analyzed with that
+    drug's doses.  Returns the path and the time taken in seconds.
+    """
+
+    start = time.perf_counter()
+    # Confirms every drug has doses and every sheet has a viability before anything is written
+    for arguments in drug_groups(path, parameters, overwrite):
+        ctg_analysis(**arguments, store=_store, plots=plots, cache=_cache, tracer=_tracer, qc=qc)
+
+    return path, time.perf_counter() - start
+
+
+def run_batch(paths, manifest, workers=None, overwrite=False, dsn=DEFAULT_DSN, plots="png",
+              cache_path=None, trace_path=None, profile_path=None, qc=None):
+    """
+    paths: List of workbook paths from find_workbooks().
+
+    manifest: Dictionary from load_manifest().
+
+    workers: Number of worker processes.  Defaults to the number of CPUs.
+
+    overwrite: Passed to analyze_workbook().
+
+    dsn: The database each worker connects to (see ctg_storage.open_store()).
+
+    plots: Passed to analyze_workbook().
+
+    cache_path: Optional AnalysisCache file.  Workbooks that have not changed
+    since they were recorded are skipped without being opened.
+
+    trace_path, profile_path: Passed to init_worker().
+
+    qc: Passed to analyze_workbook().
+
+    Analyzes every workbook in a process pool and prints one line per file
+    as it finishes.  Returns a list of (path, succeeded, message) tuples.
+    """
+
+    results = []
+    accepted = []
+    cache = AnalysisCache(cache_path) if cache_path is not None else None
+    for path in paths:
+        file = os.path.basename(path)
+        if file not in manifest:
+            results.append((path, False, "not listed in manifest"))
+            print(f"FAILED {file}: not listed in manifest")
+            continue
+        problems = check_parameters(file, manifest[file])
+        if problems:
+            results.append((path, False, "; ".join(problems)))
+            print(f"FAILED {'; '.join(problems)}")
+            continue
+        if cache is not None and workbook_unchanged(cache, path, manifest[file], qc):
+            results.append((path, True, "unchanged"))
+            print(f"SKIP   {file} (unchanged)")
+            continue
+        accepted.append(path)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(dsn, cache_path, trace_path, profile_path)) as executor:
+        jobs = {executor.submit(analyze_workbook, path, manifest[os.path.basename(path)],
+                                overwrite, plots, qc): path
+                for path in accepted}
+        for job in as_completed(jobs):
+            path = jobs[job]
+            file = os.path.basename(path)
+            try:
+                _, seconds = job.result()
+            except Exception as error:
+                message = f"{type(error).__name__}: {error}"
+                results.append((path, False, message))
+                print(f"FAILED {file}: {message}")
+            else:
+                results.append((path, True, f"{seconds:.1f}s"))
+                print(f"OK     {file} ({seconds:.1f}s)")
+
+    return results
+
+
+def main(argv=None, plots=None):
+    """Command line entry point.  Returns the exit status: 0 if every workbook
+    was analyzed, 1 if any failed, and 2 if nothing could be run.  If plots is
+    provided, it replaces the --plots option (ctg_cli.py ingest uses "none")."""
+
+    batch_parser = argparse.ArgumentParser(
+        description="Analyzes a directory of CTG workbooks without prompting.")
+    batch_parser.add_argument("-i", dest="input", required=True,
+                              help="A directory or glob pattern of .xls/.xlsx files.")
+    batch_parser.add_argument("-m", dest="manifest", required=True,
+                              help="A .json or .csv manifest of experimental parameters.")
+    batch_parser.add_argument("-w", dest="workers", type=int, default=None,
+                              help="Number of worker processes.  Defaults to the number of CPUs.")
+    batch_parser.add_argument("--overwrite", action="store_true",
+                              help="Re-analyze workbooks that already have a _data directory.")
+    batch_parser.add_argument("--dsn", default=DEFAULT_DSN,
+                              help="PostgreSQL connection string, sqlite:<path> for a SQLite database, "
+                                   "or parquet:<directory> for Parquet files.")
+    if plots is None:
+        batch_parser.add_argument("--plots", choices=["png", "pdf", "none"], default="png",
+                                  help="Save PNG plots, one PDF per workbook, or no plots.")
+    batch_parser.add_argument("--cache", default=None,
+                              help="File recording analyzed workbooks so unchanged ones are skipped.")
+    batch_parser.add_argument("--qc", choices=["flag", "drop"], default=None,
+                              help="Check plates for outlier wells, and with drop leave them out of the means.")
+    batch_parser.add_argument("--trace", default=None,
+                              help="Append the time of each stage to this JSON lines file.")
+    batch_parser.add_argument("--metrics", default=None,
+                              help="Write the stage totals in Prometheus text format to this file.")
+    batch_parser.add_argument("--profile", default=None,
+                              help="Save cProfile statistics of each worker to <profile>.<pid>.")
+    args = batch_parser.parse_args(argv)
+    if plots is not None:
+        args.plots = plots
+
+    paths = find_workbooks(args.input)
+    if not paths:
+        print(f"No .xls or .xlsx files were found for {args.input}.")
+        return 2
+    try:
+        manifest = load_manifest(args.manifest)
+    except (OSError, ValueError, KeyError) as error:
+        print(f"Could not read manifest {args.manifest}: {error}")
+        return 2
+
+    # The workers' stages are summed from the trace file, so --metrics needs one
+    trace_path = args.trace
+    if args.metrics and trace_path is None:
+        descriptor, trace_path = tempfile.mkstemp(suffix=".jsonl")
+        os.close(descriptor)
+
+    start = time.perf_counter()
+    results = run_batch(paths, manifest, args.workers, args.overwrite, args.dsn, args.plots,
+                        args.cache, trace_path, args.profile, args.qc)
+    failures = [result for result in results if not result[1]]
+    print(f"\n{len(results) - len(failures)} of {len(results)} workbooks analyzed "
+          f"in {time.perf_counter() - start:.1f}s.")
+    if args.metrics:
+        read_trace(trace_path).write_metrics(args.metrics)
+        if args.trace is None:
+            os.remove(trace_path)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
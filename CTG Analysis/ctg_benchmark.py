@@ -0,0 +1,509 @@
+# Benchmarks for the CTG analysis pipeline.
+# Each benchmark prints its results as JSON so numbers can be compared
+# between versions.
+#
+# Usage:
+# python ctg_benchmark.py storage --sheets 500
+# python ctg_benchmark.py storage --dsn "dbname=mcl1_test user=blixt007"
+# python ctg_benchmark.py engine --plates 5000
+# python ctg_benchmark.py plots --cell-lines 96 --workers 4
+# python ctg_benchmark.py pipeline --workbooks 8 --sheets 24 --doses 12 --save baseline.json
+# python ctg_benchmark.py pipeline --workbooks 8 --sheets 24 --doses 12 --baseline baseline.json
+# python ctg_benchmark.py startup --runs 5
+#
+# The pipeline benchmark writes synthetic workbooks in the layout of
+# mcl20191017_amg176.xls and times each stage separately.  With --baseline,
+# it exits with status 1 if any throughput fell, or the peak memory rose, by
+# more than --tolerance compared with the saved results.  It also runs the
+# same workbooks through the staged pipeline of ctg_pipeline.py
+# (run_pipeline), with plots rendered in --workers processes.
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import pandas as pd
+
+from ctg_analysis import (ausc_trapazoidal, clean_sheet_name, ctg_analysis, data_to_sql,
+                          make_mean_df, parse_luminescence, survival_plot,
+                          vbar_luminescence_plot, workbook_job)
+from ctg_engine import analyze_plates
+from ctg_pipeline import run_pipeline
+from ctg_plot import save_plots
+from ctg_storage import (PROCESSED_COLUMNS, RAW_COLUMNS, SQLITE_SCHEMA,
+                         open_store)
+
+
+def synthetic_sheet_rows(cell_line, replicates=4, doses=10):
+    """Returns raw_data and processed_data lists shaped like the ones made by
+    parse_luminescence() for one sheet, filled with random luminescence."""
+
+    raw_data = []
+    for n in range(replicates):
+        row = ["2019-10-17", "NB", "AMG-176", cell_line, "well_" + str(n + 1)]
+        row.extend(random.randint(50, 30000) for _ in range(doses))
+        raw_data.append(row)
+    processed_data = [cell_line, "2019-10-17", "NB", 90, "AMG-176", round(random.uniform(0, 30000), 2)]
+    processed_data.extend(float(random.randint(50, 30000)) for _ in range(doses))
+
+    return raw_data, processed_data
+
+
+def per_row_insert(dsn, raw_data, processed_data):
+    """The data_to_sql() of version 3.1: a new connection for every sheet and
+    one INSERT per row.  Used as the baseline in benchmark_storage()."""
+
+    if dsn.startswith("sqlite:"):
+        conn = sqlite3.connect(dsn[len("sqlite:"):])
+        placeholder = "?"
+    else:
+        import psycopg2
+        conn = psycopg2.connect(dsn)
+        placeholder = "%s"
+    with conn:
+        cur = conn.cursor()
+        for row in raw_data:
+            cur.execute(f"INSERT INTO raw_lum ({', '.join(RAW_COLUMNS)}) "
+                        f"VALUES ({', '.join([placeholder] * len(RAW_COLUMNS))})", tuple(row))
+        cur.execute(f"INSERT INTO lum_drug_sens ({', '.join(PROCESSED_COLUMNS)}) "
+                    f"VALUES ({', '.join([placeholder] * len(PROCESSED_COLUMNS))})",
+                    tuple(processed_data))
+    conn.close()
+
+
+def benchmark_storage(dsn=None, sheets=500, sheets_per_workbook=10):
+    """
+    dsn: The database to write to.  Defaults to a temporary SQLite file.  Rows
+    are written to the real tables, so only use a scratch PostgreSQL database.
+
+    sheets: The number of synthetic sheets to write.
+
+    sheets_per_workbook: Sheets buffered before each flush of the store.
+
+    Times the per-row baseline against ctg_storage and returns rows/sec for each.
+    """
+
+    temporary_directory = None
+    if dsn is None:
+        temporary_directory = tempfile.TemporaryDirectory()
+        dsn = "sqlite:" + os.path.join(temporary_directory.name, "benchmark.db")
+        with sqlite3.connect(dsn[len("sqlite:"):]) as conn:
+            conn.executescript(SQLITE_SCHEMA)
+
+    data = [synthetic_sheet_rows("cell_line_" + str(n)) for n in range(sheets)]
+    rows = sum(len(raw_data) + 1 for raw_data, _ in data)
+
+    start = time.perf_counter()
+    for raw_data, processed_data in data:
+        per_row_insert(dsn, raw_data, processed_data)
+    before = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open_store(dsn) as store:
+        for n, (raw_data, processed_data) in enumerate(data, start=1):
+            store.add(raw_data, processed_data)
+            if n % sheets_per_workbook == 0:
+                store.flush()
+    after = time.perf_counter() - start
+
+    if temporary_directory is not None:
+        temporary_directory.cleanup()
+
+    return {"benchmark": "storage",
+            "database": "sqlite" if dsn.startswith("sqlite:") else "postgresql",
+            "rows": rows,
+            "before_rows_per_sec": round(rows / before, 1),
+            "after_rows_per_sec": round(rows / after, 1),
+            "speedup": round(before / after, 2)}
+
+
+def synthetic_plates(plates=5000, replicates=4, doses=10, seed=0):
+    """Returns a dictionary shaped like the one from ctg_engine.stack_sheets()
+    with random luminescence that decreases with dose."""
+
+    rng = np.random.default_rng(seed)
+    signal = np.linspace(1, 0.01, doses) * rng.uniform(5000, 70000, size=(plates, 1, 1))
+    lum = np.rint(signal * rng.normal(1, 0.08, size=(plates, replicates, doses))).clip(1)
+
+    return {"cell_lines": ["cell_line_" + str(n) for n in range(plates)],
+            "lum": lum.astype(np.int64),
+            "means": np.rint(lum.mean(axis=1)),
+            "stdev": np.rint(lum.std(axis=1, ddof=1))}
+
+
+def benchmark_engine(plates=5000):
+    """
+    plates: The number of synthetic plates (cell lines) to analyze.
+
+    Times make_mean_df() and ausc_trapazoidal() on each plate against
+    ctg_engine.analyze_plates() on all plates at once, and checks that both
+    give the same AUSC.
+    """
+
+    doses = [0, 5, 16, 48, 144, 432, 1296, 3888, 11666, 35000]
+    stacked = synthetic_plates(plates, doses=len(doses))
+
+    start = time.perf_counter()
+    per_sheet_ausc = []
+    for cell_line, means, stdev in zip(stacked["cell_lines"], stacked["means"], stacked["stdev"]):
+        mean_df = make_mean_df(means, stdev, cell_line)
+        per_sheet_ausc.append(ausc_trapazoidal(mean_df, doses))
+    before = time.perf_counter() - start
+
+    start = time.perf_counter()
+    engine_ausc = analyze_plates(stacked, doses)["ausc"]
+    after = time.perf_counter() - start
+
+    return {"benchmark": "engine",
+            "plates": plates,
+            "identical_ausc": bool(np.array_equal(per_sheet_ausc, engine_ausc)),
+            "before_plates_per_sec": round(plates / before, 1),
+            "after_plates_per_sec": round(plates / after, 1),
+            "speedup": round(before / after, 2)}
+
+
+def benchmark_plots(cell_lines=96, workers=4):
+    """
+    cell_lines: The number of synthetic cell lines in the workbook.
+
+    workers: Number of processes for the pooled run.
+
+    Times vbar_luminescence_plot() and survival_plot() against ctg_plot's
+    templates in one process and split across a process pool.  Returns plots/sec.
+    """
+
+    doses = [0, 5, 16, 48, 144, 432, 1296, 3888, 11666, 35000]
+    plates = analyze_plates(synthetic_plates(cell_lines, doses=len(doses)), doses)
+    curves = list(zip(plates["cell_lines"], plates["means"], plates["stdev"], plates["normalized"]))
+    plots = 2 * cell_lines
+    result = {"benchmark": "plots", "cell_lines": cell_lines, "plots": plots}
+
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        for cell_line, means, stdev, _ in curves:
+            mean_df = make_mean_df(means, stdev, cell_line)
+            vbar_luminescence_plot(mean_df, doses, "AMG-176", "nM", path)
+            survival_plot(mean_df, doses, "AMG-176", "nM", path)
+        result["pyplot_plots_per_sec"] = round(plots / (time.perf_counter() - start), 1)
+
+        start = time.perf_counter()
+        save_plots(curves, doses, "AMG-176", "nM", path)
+        result["template_plots_per_sec"] = round(plots / (time.perf_counter() - start), 1)
+
+        start = time.perf_counter()
+        save_plots(curves, doses, "AMG-176", "nM", path, mode="pdf")
+        result["template_pdf_plots_per_sec"] = round(plots / (time.perf_counter() - start), 1)
+
+        # Each worker builds its own templates once, which is included in the timing
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = [curves[n::workers] for n in range(workers)]
+            list(executor.map(save_plots, chunks, *zip(*[(doses, "AMG-176", "nM", path)] * workers)))
+        result[f"pool_{workers}_plots_per_sec"] = round(plots / (time.perf_counter() - start), 1)
+
+    return result
+
+
+def synthetic_doses(doses=10):
+    """Returns a DMSO control followed by doses-1 threefold dilutions, the same
+    series as AMG-176 when doses is 10."""
+    return [0] + [int(round(35000 / 3 ** n)) for n in reversed(range(doses - 1))]
+
+
+def write_synthetic_workbook(path, sheets=9, replicates=4, doses=10, header_offset=0, seed=0,
+                             suffix="_amg"):
+    """
+    path: The .xlsx file to write.
+
+    sheets: The number of sheets (cell lines).
+
+    replicates: Wells per dose.
+
+    doses: Doses per sheet, including the DMSO control.
+
+    header_offset: Empty rows and columns before the table, for testing the
+    header search in read_sheet().
+
+    suffix: Added to each cell line name, such as "_amg" for AMG-176.
+
+    Writes a workbook in the layout of mcl20191017_amg176.xls: one row per
+    well with Well ID, Name, Well, and Lum, and the Count, Mean, Std Dev, and
+    CV (%) of each dose on its first well.  Returns the sheet names.
+    """
+
+    from openpyxl import Workbook
+
+    rng = np.random.default_rng(seed)
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    names = []
+    for sheet_number in range(sheets):
+        name = f"line{sheet_number}{suffix}"
+        worksheet = workbook.create_sheet(name)
+        rows = [["Well ID", "Name", "Well", "Lum", "Count", "Mean", "Std Dev", "CV (%)"]]
+        signal = rng.uniform(5000, 70000) / (1 + np.arange(doses) ** 2 * rng.uniform(0.01, 0.5))
+        for dose in range(doses):
+            lum = np.rint(signal[dose] * rng.normal(1, 0.08, replicates)).clip(1)
+            mean, stdev = lum.mean(), lum.std(ddof=1) if replicates > 1 else 0.0
+            for well in range(replicates):
+                row = [None, None, chr(ord("B") + well % 24) + str(dose + 2), float(lum[well]),
+                       None, None, None, None]
+                if well == 0:
+                    row[0] = "SPL" + str(dose + 1)
+                    row[4:] = [float(replicates), float(np.rint(mean)), float(np.rint(stdev)),
+                               round(100 * stdev / mean, 2)]
+                rows.append(row)
+        for row_number, row in enumerate(rows, start=1 + header_offset):
+            for column_number, value in enumerate(row, start=1 + header_offset):
+                if value is not None:
+                    worksheet.cell(row=row_number, column=column_number, value=value)
+        names.append(name)
+    workbook.save(path)
+
+    return names
+
+
+def flatten(result, prefix=""):
+    """Returns the numbers in a nested result dictionary keyed by dotted path."""
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def check_regressions(result, baseline, tolerance=0.2):
+    """
+    result, baseline: Results of the same benchmark.
+
+    tolerance: The allowed fractional change.
+
+    Returns a list of regressions: throughputs (keys ending in _per_sec) that
+    fell, and times (keys ending in _ms) and peak memory (keys ending in _mb)
+    that rose, by more than tolerance.
+    """
+
+    current = flatten(result)
+    regressions = []
+    for key, before in flatten(baseline).items():
+        if key not in current or not before:
+            continue
+        change = (current[key] - before) / before
+        if key.endswith("_per_sec") and change < -tolerance:
+            regressions.append(f"{key}: {before} -> {current[key]} ({change:+.0%})")
+        elif key.endswith(("_ms", "_mb")) and change > tolerance:
+            regressions.append(f"{key}: {before} -> {current[key]} ({change:+.0%})")
+    return regressions
+
+
+def benchmark_pipeline(workbooks=4, sheets=9, replicates=4, doses=10, header_offset=0, plots=True,
+                       dsn=None, workers=None):
+    """
+    workbooks, sheets, replicates, doses, header_offset: The synthetic
+    workbooks to analyze (see write_synthetic_workbook()).
+
+    plots: Include the plotting stages.
+
+    dsn: The database to write to.  Defaults to a temporary SQLite file.
+
+    workers: Plot processes of the staged pipeline.  Defaults to the number of CPUs.
+
+    Times each stage of the original per-sheet path separately
+    (parse_luminescence(), make_mean_df() with ausc_trapazoidal(),
+    data_to_sql(), and the two plot functions), then ctg_analysis() as a
+    whole and ctg_pipeline.run_pipeline(), and measures the peak memory of
+    ctg_analysis() with tracemalloc.  Returns the seconds and sheets/sec of
+    each stage.
+    """
+
+    dose_list = synthetic_doses(doses)
+    drug = "AMG-176"
+    with tempfile.TemporaryDirectory() as path:
+        database = dsn or "sqlite:" + os.path.join(path, "benchmark.db")
+        files = []
+        for number in range(workbooks):
+            file = os.path.join(path, f"synthetic_{number}.xlsx")
+            write_synthetic_workbook(file, sheets, replicates, doses, header_offset, seed=number)
+            files.append(file)
+        total_sheets = workbooks * sheets
+        seconds = dict.fromkeys(["read_workbook", "parse_luminescence", "make_mean_df_ausc",
+                                 "data_to_sql"] + (["vbar_luminescence_plot", "survival_plot"]
+                                                   if plots else []), 0.0)
+
+        with open_store(database) as store:
+            for file in files:
+                start = time.perf_counter()
+                xls_data = pd.ExcelFile(file)
+                seconds["read_workbook"] += time.perf_counter() - start
+                for sheet in xls_data.sheet_names:
+                    cell_line = clean_sheet_name(sheet, drug)
+                    viability = {cell_line: 90}
+
+                    start = time.perf_counter()
+                    mean_df, raw_data, processed_data = parse_luminescence(
+                        xls_data, sheet, cell_line, drug, dose_list, "2019-10-17", "NB", viability)
+                    seconds["parse_luminescence"] += time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    ausc_trapazoidal(make_mean_df(mean_df.iloc[:, 0], mean_df["stdev"], cell_line),
+                                     dose_list)
+                    seconds["make_mean_df_ausc"] += time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    data_to_sql(raw_data, processed_data, store)
+                    seconds["data_to_sql"] += time.perf_counter() - start
+
+                    if plots:
+                        for plot in [vbar_luminescence_plot, survival_plot]:
+                            start = time.perf_counter()
+                            plot(mean_df, dose_list, drug, "nM", path)
+                            seconds[plot.__name__] += time.perf_counter() - start
+                start = time.perf_counter()
+                store.flush()
+                seconds["data_to_sql"] += time.perf_counter() - start
+
+            # The whole pipeline, once for timing and once for peak memory
+            viability = {file: dict.fromkeys([clean_sheet_name(sheet, drug)
+                                              for sheet in pd.ExcelFile(file).sheet_names], 90)
+                         for file in files}
+
+            def run_all():
+                for file in files:
+                    ctg_analysis(file, dose_list, "nM", drug, viability_dictionary=viability[file],
+                                 experiment_date="2019-10-17", experimenter="NB", overwrite=True,
+                                 store=store, plots="png" if plots else "none")
+
+            start = time.perf_counter()
+            run_all()
+            seconds["ctg_analysis"] = time.perf_counter() - start
+
+            # The same workbooks with the stages overlapped
+            jobs = [workbook_job(file, dose_list, "nM", drug, viability_dictionary=viability[file],
+                                 experiment_date="2019-10-17", experimenter="NB", overwrite=True,
+                                 plots="png" if plots else "none")
+                    for file in files]
+            workers = workers or os.cpu_count()
+            start = time.perf_counter()
+            if plots:
+                with ProcessPoolExecutor(max_workers=workers) as plot_executor:
+                    finished = run_pipeline(jobs, database, plot_executor=plot_executor,
+                                            queue_size=max(workers, 2))
+            else:
+                finished = run_pipeline(jobs, database)
+            seconds["run_pipeline"] = time.perf_counter() - start
+            errors = [job["error"] for job in finished if job["error"] is not None]
+            if errors:
+                raise RuntimeError(f"run_pipeline failed: {errors[0]}")
+
+            tracemalloc.start()
+            run_all()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    return {"benchmark": "pipeline",
+            "workbooks": workbooks, "sheets": sheets, "replicates": replicates, "doses": doses,
+            "header_offset": header_offset, "plots": plots,
+            "stages": {stage: {"seconds": round(stage_seconds, 4),
+                               "sheets_per_sec": round(total_sheets / stage_seconds, 1)}
+                       for stage, stage_seconds in seconds.items()},
+            "ctg_analysis_peak_mb": round(peak / 2 ** 20, 2)}
+
+
+def benchmark_startup(runs=5):
+    """
+    runs: Times each command is started.  The median is reported.
+
+    Times a cold start of each ctg_cli.py command with --help, and the
+    imports every command paid for before ctg_cli.py (pandas, numpy,
+    matplotlib.pyplot, and psycopg2 if installed).  Returns milliseconds.
+    """
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    eager = "import pandas, numpy, matplotlib.pyplot\ntry:\n    import psycopg2\nexcept ImportError:\n    pass"
+    commands = {"eager_imports": [sys.executable, "-c", eager]}
+    for command in ["analyze", "validate", "plot", "ingest", "export"]:
+        commands[command] = [sys.executable, os.path.join(directory, "ctg_cli.py"), command, "--help"]
+
+    result = {"benchmark": "startup", "runs": runs}
+    for name, command in commands.items():
+        seconds = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=directory, stdout=subprocess.DEVNULL, check=True)
+            seconds.append(time.perf_counter() - start)
+        result[name + "_ms"] = round(1000 * sorted(seconds)[len(seconds) // 2], 1)
+    return result
+
+
+if __name__ == "__main__":
+    benchmark_parser = argparse.ArgumentParser(description="Benchmarks the CTG analysis pipeline.")
+    subparsers = benchmark_parser.add_subparsers(dest="benchmark", required=True)
+
+    storage_parser = subparsers.add_parser("storage", help="Database rows/sec before and after batching.")
+    storage_parser.add_argument("--dsn", default=None,
+                                help="Database to write to.  Defaults to a temporary SQLite file.")
+    storage_parser.add_argument("--sheets", type=int, default=500)
+
+    engine_parser = subparsers.add_parser("engine", help="Per-sheet analysis against the vectorized engine.")
+    engine_parser.add_argument("--plates", type=int, default=5000)
+
+    plots_parser = subparsers.add_parser("plots", help="Plots/sec for pyplot, templates, and a process pool.")
+    plots_parser.add_argument("--cell-lines", type=int, default=96)
+    plots_parser.add_argument("--workers", type=int, default=4)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Time each stage on synthetic workbooks.")
+    pipeline_parser.add_argument("--workbooks", type=int, default=4)
+    pipeline_parser.add_argument("--sheets", type=int, default=9)
+    pipeline_parser.add_argument("--replicates", type=int, default=4)
+    pipeline_parser.add_argument("--doses", type=int, default=10)
+    pipeline_parser.add_argument("--header-offset", type=int, default=0)
+    pipeline_parser.add_argument("--no-plots", action="store_true")
+    pipeline_parser.add_argument("--dsn", default=None,
+                                 help="Database to write to.  Defaults to a temporary SQLite file.")
+    pipeline_parser.add_argument("--workers", type=int, default=None,
+                                 help="Plot processes of the staged pipeline.  Defaults to the number of CPUs.")
+
+    startup_parser = subparsers.add_parser("startup", help="Time a cold start of each ctg_cli.py command.")
+    startup_parser.add_argument("--runs", type=int, default=5)
+
+    for subparser in [storage_parser, engine_parser, plots_parser, pipeline_parser, startup_parser]:
+        subparser.add_argument("--save", default=None, help="Also write the results to this file.")
+        subparser.add_argument("--baseline", default=None,
+                               help="Results of an earlier run to check for regressions.")
+        subparser.add_argument("--tolerance", type=float, default=0.2,
+                               help="Allowed fractional change from the baseline.")
+
+    args = benchmark_parser.parse_args()
+    if args.benchmark == "storage":
+        result = benchmark_storage(args.dsn, args.sheets)
+    elif args.benchmark == "engine":
+        result = benchmark_engine(args.plates)
+    elif args.benchmark == "plots":
+        result = benchmark_plots(args.cell_lines, args.workers)
+    elif args.benchmark == "pipeline":
+        result = benchmark_pipeline(args.workbooks, args.sheets, args.replicates, args.doses,
+                                    args.header_offset, not args.no_plots, args.dsn, args.workers)
+    elif args.benchmark == "startup":
+        result = benchmark_startup(args.runs)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            result["regressions"] = check_regressions(result, json.load(baseline_file), args.tolerance)
+    print(json.dumps(result, indent=2))
+    if args.save is not None:
+        with open(args.save, "w") as save_file:
+            json.dump(result, save_file, indent=2)
+    sys.exit(1 if result.get("regressions") else 0)
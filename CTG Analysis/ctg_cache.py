@@ -0,0 +1,141 @@
+# Persistent record of analyzed workbooks for ctg_analysis.py.
+# Each workbook is recorded once per drug with its size, modification time,
+# content hash, and a key made from the analysis parameters (drug, doses,
+# unit, date, experimenter, viability, and the VERSION of ctg_analysis.py),
+# so the drugs of a workbook holding several each keep their own key.  Each
+# sheet is recorded with a hash of its cells plus the same parameters.
+#
+# When a directory is scanned again:
+# - A workbook with the same size, modification time, and parameters is
+#   skipped after a single os.stat().
+# - A workbook whose modification time changed but whose content hash did
+#   not is skipped after hashing the file.
+# - Otherwise only the sheets whose content or parameters changed are
+#   analyzed again, and their old database rows are replaced.
+#
+# The record is a small SQLite file, so it can be shared by the worker
+# processes of ctg_batch.py.
+
+import hashlib
+import json
+import os
+import sqlite3
+
+from ctg_analysis import VERSION
+
+# The workbooks table of older caches had one key per path and is no longer
+# read, so their workbooks are analyzed once more.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    path TEXT, drug TEXT, size INTEGER, mtime_ns INTEGER, file_hash TEXT, analysis_key TEXT,
+    PRIMARY KEY (path, drug));
+CREATE TABLE IF NOT EXISTS sheets (
+    path TEXT, sheet TEXT, sheet_key TEXT, PRIMARY KEY (path, sheet));
+"""
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """Returns the SHA-256 hex digest of the file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as workbook:
+        for chunk in iter(lambda: workbook.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def analysis_key(drug, unit, doses, experiment_date, experimenter, viability_dictionary, qc=None):
+    """Returns a hash of every parameter that changes the results of ctg_analysis()."""
+
+    parameters = [VERSION, drug, unit, [float(dose) for dose in doses],
+                  str(experiment_date), experimenter, sorted(viability_dictionary.items())]
+    # Only part of the key when used, so workbooks analyzed without QC keep their keys
+    if qc is not None:
+        parameters.append(["qc", qc])
+    return hashlib.sha256(json.dumps(parameters, default=str).encode()).hexdigest()
+
+
+def sheet_key(rows, workbook_key):
+    """
+    rows: The cells of a sheet from ctg_analysis.sheet_rows().
+
+    workbook_key: The key from analysis_key().
+
+    Returns a hash of the sheet's cells and the analysis parameters.
+    """
+    return hashlib.sha256((workbook_key + repr(rows)).encode()).hexdigest()
+
+
+class AnalysisCache:
+    """The record of analyzed workbooks and sheets stored at path."""
+
+    def __init__(self, path):
+        # A generous timeout lets several worker processes share the file
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self._file_hashes = {}
+
+    def workbook_unchanged(self, file, workbook_key, drug):
+        """
+        file: The path of a workbook.
+
+        workbook_key: The key from analysis_key().
+
+        drug: The drug the key is for.
+
+        Returns True if the workbook's sheets of this drug were already
+        analyzed with these parameters and its contents have not changed.
+        """
+
+        file = os.path.abspath(file)
+        record = self.connection.execute(
+            "SELECT size, mtime_ns, file_hash, analysis_key FROM analyses WHERE path = ? AND drug = ?",
+            (file, drug)).fetchone()
+        if record is None or record[3] != workbook_key:
+            return False
+
+        stat = os.stat(file)
+        if (stat.st_size, stat.st_mtime_ns) == record[:2]:
+            return True
+
+        # The file was touched, so compare the contents
+        file_hash = hash_file(file)
+        self._file_hashes[file] = file_hash
+        if file_hash != record[2]:
+            return False
+        with self.connection:
+            self.connection.execute("UPDATE analyses SET size = ?, mtime_ns = ? WHERE path = ? AND drug = ?",
+                                    (stat.st_size, stat.st_mtime_ns, file, drug))
+        return True
+
+    def sheet_unchanged(self, file, sheet, key):
+        """Returns True if the sheet was already analyzed with the same sheet_key()."""
+        record = self.connection.execute(
+            "SELECT sheet_key FROM sheets WHERE path = ? AND sheet = ?",
+            (os.path.abspath(file), sheet)).fetchone()
+        return record is not None and record[0] == key
+
+    def record(self, file, workbook_key, sheet_keys, drug):
+        """
+        file: The path of a workbook that was analyzed successfully.
+
+        workbook_key: The key from analysis_key().
+
+        sheet_keys: A dictionary of sheet name to sheet_key().
+
+        drug: The drug the sheets were analyzed with.
+
+        Records the workbook and its sheets so unchanged ones are skipped next time.
+        """
+
+        file = os.path.abspath(file)
+        stat = os.stat(file)
+        file_hash = self._file_hashes.pop(file, None) or hash_file(file)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?, ?)",
+                                    (file, drug, stat.st_size, stat.st_mtime_ns, file_hash, workbook_key))
+            self.connection.executemany("INSERT OR REPLACE INTO sheets VALUES (?, ?, ?)",
+                                        [(file, sheet, key) for sheet, key in sheet_keys.items()])
+
+    def close(self):
+        self.connection.close()
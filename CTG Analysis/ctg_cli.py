@@ -0,0 +1,128 @@
+# Command line entry point for the CTG analysis tools.
+# Each command imports only what it needs, so commands that never plot or
+# read a workbook start without loading pandas, numpy, or matplotlib:
+#
+#   analyze   Analyze workbooks interactively (ctg_analysis.py), or without
+#             prompting when a manifest is given with -m (ctg_batch.py).
+#   validate  Check a manifest against a directory of workbooks, reading
+#             only sheet names.  Nothing is analyzed or written.
+#   plot      Make the plots again from the database (ctg_plot.py).
+#   ingest    Analyze workbooks with a manifest and write the database
+#             without plotting, so matplotlib is never imported.
+#   export    Copy database tables to Parquet files (ctg_export.py).
+#
+# The Agg backend is set before anything can import matplotlib, since plots
+# are only saved to file.
+#
+# Usage:
+# python ctg_cli.py analyze -i /path/to/exports
+# python ctg_cli.py analyze -i /path/to/exports -m manifest.json -w 8
+# python ctg_cli.py validate -i /path/to/exports -m manifest.json
+# python ctg_cli.py plot -o plots --drug AMG-176 --date 2019-10-17
+# python ctg_cli.py ingest -i /path/to/exports -m manifest.json --cache analyzed.db
+# python ctg_cli.py export -o results
+# python ctg_cli.py <command> --help
+
+import argparse
+import os
+import sys
+
+os.environ["MPLBACKEND"] = "Agg"
+
+from ctg_storage import DEFAULT_DSN
+
+
+def analyze(argv):
+    if any(arg.startswith("-m") for arg in argv):
+        from ctg_batch import main
+        return main(argv)
+    from ctg_analysis import main
+    main(argv)
+    return 0
+
+
+def validate(argv):
+    validate_parser = argparse.ArgumentParser(
+        prog="ctg_cli.py validate", description="Checks a manifest against a directory of workbooks.")
+    validate_parser.add_argument("-i", dest="input", required=True,
+                                 help="A directory or glob pattern of .xls/.xlsx files.")
+    validate_parser.add_argument("-m", dest="manifest", required=True,
+                                 help="A .json or .csv manifest of experimental parameters.")
+    args = validate_parser.parse_args(argv)
+
+    from ctg_batch import find_workbooks, load_manifest, validate as validate_workbooks
+    paths = find_workbooks(args.input)
+    if not paths:
+        print(f"No .xls or .xlsx files were found for {args.input}.")
+        return 2
+    try:
+        manifest = load_manifest(args.manifest)
+    except (OSError, ValueError, KeyError) as error:
+        print(f"Could not read manifest {args.manifest}: {error}")
+        return 2
+    results = validate_workbooks(paths, manifest)
+    return 1 if any(problems for _, problems in results) else 0
+
+
+def plot(argv):
+    plot_parser = argparse.ArgumentParser(
+        prog="ctg_cli.py plot", description="Makes the plots again from the database.")
+    plot_parser.add_argument("-o", dest="output", required=True, help="The output directory.")
+    plot_parser.add_argument("--dsn", default=DEFAULT_DSN,
+                             help="PostgreSQL connection string, or sqlite:<path> for a SQLite database.")
+    plot_parser.add_argument("--drug", default=None)
+    plot_parser.add_argument("--date", default=None, help="The experiment date (yyyy-mm-dd).")
+    plot_parser.add_argument("--experimenter", default=None)
+    plot_parser.add_argument("--mode", choices=["png", "pdf"], default="png",
+                             help="PNG plots per cell line, or one PDF per experiment.")
+    args = plot_parser.parse_args(argv)
+    if args.dsn.startswith("parquet:"):
+        plot_parser.error("plot reads a PostgreSQL or SQLite database, not parquet: files; "
+                          "load those with ctg_export.read_results()")
+
+    from ctg_plot import plot_database
+    from ctg_storage import open_store
+    with open_store(args.dsn) as store:
+        count = plot_database(store, args.output, args.drug, args.date,
+                              args.experimenter and args.experimenter.upper(), args.mode)
+    print(f"Saved {count} plots to {args.output}")
+    return 0 if count else 1
+
+
+def ingest(argv):
+    from ctg_batch import main
+    return main(argv, plots="none")
+
+
+def export(argv):
+    from ctg_export import main
+    main(argv)
+    return 0
+
+
+# Command: (function, description)
+COMMANDS = {
+    "analyze": (analyze, "Analyze workbooks, interactively or with a manifest (-m)."),
+    "validate": (validate, "Check a manifest against workbooks without analyzing them."),
+    "plot": (plot, "Make the plots again from the database."),
+    "ingest": (ingest, "Analyze workbooks with a manifest without plotting."),
+    "export": (export, "Copy database tables to Parquet files."),
+}
+
+
+def main(argv=None):
+    """Runs the command named by the first argument and returns its exit status."""
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        print("usage: ctg_cli.py {" + ",".join(COMMANDS) + "} ...\n")
+        for command, (_, description) in COMMANDS.items():
+            print(f"  {command:<10}{description}")
+        print("\nRun ctg_cli.py <command> --help for the options of each command.")
+        return 0 if argv and argv[0] in ["-h", "--help"] else 2
+    function, _ = COMMANDS[argv[0]]
+    return function(argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
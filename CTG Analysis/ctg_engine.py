@@ -0,0 +1,179 @@
+# Vectorized analysis engine for ctg_analysis.py.
+# Instead of building a data frame and integrating once per sheet, every
+# sheet of a workbook (or of a batch of workbooks) is stacked into arrays:
+#     lum:    cell line x replicate x dose
+#     means:  cell line x dose
+#     stdev:  cell line x dose
+# Normalization to the DMSO control and the area under the survival curve
+# (AUSC) are then calculated for all cell lines at once.  The results are
+# the same as make_mean_df() and ausc_trapazoidal() on each sheet.
+
+import numpy as np
+import pandas as pd
+
+from ctg_analysis import clean_sheet_name, read_sheet
+
+
+def stack_sheets(xls_data, sheets, drug, rows=None):
+    """
+    xls_data: Data from using pd.ExcelFile(path) on an xls file.
+
+    sheets: The names of the sheets to analyze.
+
+    drug: The name of the drug used in the experiment.
+
+    rows: An optional dictionary of sheet name to the cells from sheet_rows(),
+    for sheets that were already read.
+
+    Reads each sheet once with read_sheet() and stacks the values into arrays.
+    Returns a dictionary of plates with the cell line names and the lum, means,
+    and stdev arrays.  Every sheet must have the same number of replicates and doses.
+    """
+
+    cell_lines = []
+    lum, means, stdev = [], [], []
+    for sheet in sheets:
+        ctg_results = read_sheet(xls_data, sheet, rows.get(sheet) if rows else None)
+        replicates = ctg_results["replicates"]
+        # Wells are listed dose by dose, so each column of this reshape is one dose
+        lum.append(ctg_results["lum"].reshape(-1, replicates).T)
+        means.append(ctg_results["means"])
+        stdev.append(ctg_results["stdev"])
+        cell_lines.append(clean_sheet_name(sheet, drug))
+
+    shapes = {plate.shape for plate in lum}
+    if len(shapes) > 1:
+        raise ValueError(f"Sheets have different numbers of replicates and doses: {sorted(shapes)}")
+
+    return {"cell_lines": cell_lines,
+            "lum": np.stack(lum),
+            "means": np.stack(means),
+            "stdev": np.stack(stdev)}
+
+
+def stack_plates(plate_list):
+    """
+    plate_list: A list of dictionaries from stack_sheets(), one per workbook.
+
+    Concatenates several workbooks into one set of arrays so a whole batch
+    can be analyzed with a single call to analyze_plates().
+    """
+
+    return {"cell_lines": [cell_line for plates in plate_list for cell_line in plates["cell_lines"]],
+            "lum": np.concatenate([plates["lum"] for plates in plate_list]),
+            "means": np.concatenate([plates["means"] for plates in plate_list]),
+            "stdev": np.concatenate([plates["stdev"] for plates in plate_list])}
+
+
+def analyze_plates(plates, doses, recalculate=False, outliers=None):
+    """
+    plates: A dictionary from stack_sheets() or stack_plates().
+
+    doses: List of doses used in experiment, including 0 for the DMSO control.
+
+    recalculate: If True, means and stdev are calculated from the raw
+    luminescence of each well instead of using the values reported by the
+    plate reader.
+
+    outliers: An optional boolean array shaped like plates["lum"] from
+    ctg_qc.outlier_mask().  If provided, means and stdev are calculated from
+    the raw luminescence without the outlier wells, which are kept in plates.
+
+    Adds the normalized means and the AUSC of every cell line to plates and
+    returns it.  The first dose is the DMSO control used for normalization.
+    """
+
+    if outliers is not None:
+        from ctg_qc import masked_stats
+        plates["means"], plates["stdev"] = masked_stats(plates["lum"], outliers)
+        plates["outliers"] = outliers
+    elif recalculate:
+        plates["means"] = plates["lum"].mean(axis=1)
+        plates["stdev"] = plates["lum"].std(axis=1, ddof=1)
+
+    means = plates["means"]
+    if means.shape[1] != len(doses):
+        raise ValueError(f"Plates have {means.shape[1]} doses but {len(doses)} doses were provided.")
+    plates["normalized"] = means / means[:, :1]
+    plates["ausc"] = np.round(np.trapz(plates["normalized"], doses, axis=1), 2)
+
+    return plates
+
+
+def result_table(plates):
+    """
+    plates: A dictionary from analyze_plates().
+
+    Returns a data frame with one row per cell line containing the AUSC and
+    the mean, stdev, and normalized mean for each dose (mean_1, stdev_1,
+    normalized_1, ...).
+    """
+
+    doses = plates["means"].shape[1]
+    columns = {"cell_line": plates["cell_lines"], "ausc": plates["ausc"]}
+    for name, values in [("mean", plates["means"]), ("stdev", plates["stdev"]),
+                         ("normalized", plates["normalized"])]:
+        for n in range(doses):
+            columns[f"{name}_{n+1}"] = values[:, n]
+
+    return pd.DataFrame(columns)
+
+
+def sheet_results(plates, index, drug, experiment_date, experimenter, viability_dictionary):
+    """
+    plates: A dictionary from analyze_plates().
+
+    index: The position of the cell line in plates.
+
+    drug, experiment_date, experimenter, viability_dictionary: See parse_luminescence().
+
+    Returns mean_df, raw_data, and processed_data for one cell line in the same
+    form as parse_luminescence(), so the SQL and plotting functions can be used
+    unchanged.
+    """
+
+    cell_line = plates["cell_lines"][index]
+    means = plates["means"][index]
+    mean_df = pd.DataFrame({cell_line: means, "stdev": plates["stdev"][index],
+                            "normalized_mean": plates["normalized"][index]})
+
+    raw_data = []
+    for n, well in enumerate(plates["lum"][index]):
+        experimental_parameters = [experiment_date, experimenter, drug, cell_line, "well_" + str(n+1)]
+        experimental_parameters.extend(well.tolist())
+        raw_data.append(experimental_parameters)
+
+    processed_data = [cell_line, experiment_date, experimenter, viability_dictionary[cell_line],
+                      drug, plates["ausc"][index]]
+    processed_data.extend(means)
+
+    return mean_df, raw_data, processed_data
+
+
+def long_rows(plates, index, drug, experiment_date, experimenter, doses, unit):
+    """
+    plates: A dictionary from analyze_plates().
+
+    index: The position of the cell line in plates.
+
+    drug, experiment_date, experimenter, doses, unit: See ctg_analysis().
+
+    Returns the lum_well rows (one per well and dose) and the lum_response rows
+    (one per dose) of one cell line.  Unlike raw_lum and lum_drug_sens, these
+    tables hold any number of doses and replicates.
+    """
+
+    cell_line = plates["cell_lines"][index]
+    experiment = (cell_line, experiment_date, experimenter, drug)
+
+    well_rows = [experiment + ("well_" + str(n+1), dose_number + 1, float(doses[dose_number]), unit,
+                               float(lum))
+                 for n, well in enumerate(plates["lum"][index])
+                 for dose_number, lum in enumerate(well)]
+    response_rows = [experiment + (dose_number + 1, float(dose), unit, float(mean), float(stdev),
+                                   float(normalized))
+                     for dose_number, (dose, mean, stdev, normalized) in enumerate(zip(
+                         doses, plates["means"][index], plates["stdev"][index],
+                         plates["normalized"][index]))]
+
+    return well_rows, response_rows
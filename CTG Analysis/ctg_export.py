@@ -0,0 +1,321 @@
+# Parquet output for ctg_analysis.py.
+# ParquetStore has the same interface as the database stores in
+# ctg_storage.py, so any analysis can write its results to a directory of
+# Parquet files instead of a database:
+#     python ctg_batch.py -i exports/ -m manifest.json --dsn parquet:results/
+#
+# Each table is a dataset partitioned by drug and date:
+#     results/lum_well/drug=AMG-176/created_on=2019-10-17/part-<id>.parquet
+# lum_well holds the raw luminescence of every well and dose, lum_response
+# the mean, stdev, and normalized mean of every dose, lum_drug_sens the AUSC
+# and viability of every experiment, and lum_drug_fit the curve fits.
+# (raw_lum is not written, since lum_well holds the same values.)
+#
+# Rows are kept in memory only until a partition has a full row group, so
+# memory use is bounded by row_group_size times max_open_files no matter
+# how many plates are written, and each partition gets one file per run
+# instead of one per workbook.  Files are written under a hidden name and
+# renamed when they are finished by close(), so readers never see partial
+# files.  Rows are only safe once close() has finished, so --cache records
+# the workbooks of a run when it does (see when_written()), and a killed
+# run is analyzed again.
+#
+# Existing database tables can be exported the same way, reading in batches:
+#     python ctg_export.py --dsn "dbname=mcl1 user=blixt007" -o results/
+#
+# read_results() loads a table back into pandas, reading only the requested
+# columns and only the partitions that match the filters.
+
+import argparse
+import os
+import uuid
+from collections import OrderedDict
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ctg_storage import (DEFAULT_DSN, FIT_COLUMNS, PROCESSED_COLUMNS, QC_COLUMNS,
+                         RESPONSE_COLUMNS, WELL_COLUMNS, PostgresStore, open_store)
+
+# The partition columns are stored in the directory names, not in the files
+PARTITION_COLUMNS = ["drug", "created_on"]
+TABLES = {"lum_well": WELL_COLUMNS, "lum_response": RESPONSE_COLUMNS,
+          "lum_drug_sens": PROCESSED_COLUMNS, "lum_drug_fit": FIT_COLUMNS, "lum_qc": QC_COLUMNS}
+
+# Columns that are not floating point numbers
+STRING_COLUMNS = {"cell_line_str", "created_by", "well", "unit", "outlier_wells"}
+INTEGER_COLUMNS = {"dose_number", "viability", "wells", "outliers", "passed", "dropped"}
+
+
+def table_schema(columns):
+    """Returns the Arrow schema of a table's columns, without the partition columns."""
+    fields = []
+    for column in columns:
+        if column in PARTITION_COLUMNS:
+            continue
+        if column in STRING_COLUMNS:
+            fields.append(pa.field(column, pa.string()))
+        elif column in INTEGER_COLUMNS:
+            fields.append(pa.field(column, pa.int64()))
+        else:
+            fields.append(pa.field(column, pa.float64()))
+    return pa.schema(fields)
+
+
+class ParquetStore:
+    """Writes analysis results to partitioned Parquet datasets under root.
+    Used like a LuminescenceStore: add rows, flush() once per workbook, and
+    close() at the end of the run."""
+
+    def __init__(self, root, row_group_size=100000, max_open_files=64):
+        self.root = root
+        self.row_group_size = row_group_size
+        self.max_open_files = max_open_files
+        self.schemas = {table: table_schema(columns) for table, columns in TABLES.items()}
+        # Positions of the partition and data columns in the rows of each table
+        self.positions = {table: ([columns.index(column) for column in PARTITION_COLUMNS],
+                                  [n for n, column in enumerate(columns)
+                                   if column not in PARTITION_COLUMNS])
+                          for table, columns in TABLES.items()}
+
+        # Rows added since the last flush(), as in LuminescenceStore
+        self.pending = {table: [] for table in TABLES}
+        self.replaced = []
+        # (table, drug, date): rows waiting for a full row group, and the open file
+        self.partitions = OrderedDict()
+        self.rows_written = 0
+        # Called once the rows flushed so far are in finished files
+        self.written_callbacks = []
+
+    def add(self, raw_data, processed_data):
+        """Adds the lum_drug_sens row of one sheet.  The raw wells are written
+        to lum_well by add_long(), so raw_data is not used."""
+        processed_data = tuple(processed_data)
+        if len(processed_data) != len(PROCESSED_COLUMNS):
+            processed_data = processed_data[:6] + (None,) * (len(PROCESSED_COLUMNS) - 6)
+        self.pending["lum_drug_sens"].append(processed_data)
+
+    def add_long(self, well_rows, response_rows):
+        self.pending["lum_well"].extend(well_rows)
+        self.pending["lum_response"].extend(response_rows)
+
+    def add_fits(self, fit_rows):
+        self.pending["lum_drug_fit"].extend(tuple(row) for row in fit_rows)
+
+    def add_qc(self, qc_rows):
+        self.pending["lum_qc"].extend(tuple(row) for row in qc_rows)
+
+    def add_rows(self, table, rows):
+        """Adds rows whose columns are in the order of TABLES[table]."""
+        self.pending[table].extend(rows)
+
+    def replace_experiments(self, experiments):
+        """
+        experiments: A list of (cell_line, created_on, created_by, drug) tuples.
+
+        Rows of these experiments already written are removed by the next
+        flush() by rewriting the files of their drug and date partition.
+        """
+        self.replaced.extend(tuple(experiment) for experiment in experiments)
+
+    def clear(self):
+        """Discards rows added since the last flush()."""
+        self.pending = {table: [] for table in TABLES}
+        self.replaced = []
+
+    def flush(self):
+        """Moves the rows added since the last flush() into their partitions,
+        writing a row group for every partition that has enough rows.
+        Returns the number of rows added."""
+
+        if self.replaced:
+            self._remove(self.replaced)
+
+        added = 0
+        for table, rows in self.pending.items():
+            partition_positions, _ = self.positions[table]
+            for row in rows:
+                key = (table,) + tuple(str(row[n]) for n in partition_positions)
+                partition = self._partition(key)
+                partition["rows"].append(row)
+                if len(partition["rows"]) >= self.row_group_size:
+                    self._write_row_group(key)
+            added += len(rows)
+        self.rows_written += added
+        self.clear()
+
+        return added
+
+    def when_written(self, callback):
+        """Calls callback once the rows flushed so far are in finished files,
+        which is when close() has finished them."""
+        self.written_callbacks.append(callback)
+
+    def close(self):
+        """Flushes, writes every remaining row, and finishes every file."""
+        self.flush()
+        for key in list(self.partitions):
+            self._close_partition(key)
+        callbacks, self.written_callbacks = self.written_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.clear()
+        self.close()
+
+    def _directory(self, key):
+        """Returns the directory of a (table, drug, date) partition."""
+        table, drug, created_on = key
+        return os.path.join(self.root, table, "drug=" + quote(drug, safe=""),
+                            "created_on=" + quote(created_on, safe=""))
+
+    def _partition(self, key):
+        """Returns the buffer of a partition, closing the least recently used
+        partition if too many files are open."""
+
+        if key in self.partitions:
+            self.partitions.move_to_end(key)
+            return self.partitions[key]
+        while len(self.partitions) >= self.max_open_files:
+            self._close_partition(next(iter(self.partitions)))
+        self.partitions[key] = {"rows": [], "writer": None, "path": None}
+        return self.partitions[key]
+
+    def _write_row_group(self, key):
+        partition = self.partitions[key]
+        if not partition["rows"]:
+            return
+        table = key[0]
+        if partition["writer"] is None:
+            directory = self._directory(key)
+            os.makedirs(directory, exist_ok=True)
+            # Hidden until finished; pyarrow skips names starting with "."
+            partition["path"] = os.path.join(directory, f".part-{uuid.uuid4().hex}.parquet")
+            partition["writer"] = pq.ParquetWriter(partition["path"], self.schemas[table])
+
+        _, data_positions = self.positions[table]
+        columns = list(zip(*partition["rows"]))
+        arrays = [pa.array(columns[n], type=field.type)
+                  for n, field in zip(data_positions, self.schemas[table])]
+        partition["writer"].write_table(pa.Table.from_arrays(arrays, schema=self.schemas[table]))
+        partition["rows"] = []
+
+    def _close_partition(self, key):
+        self._write_row_group(key)
+        partition = self.partitions.pop(key)
+        if partition["writer"] is not None:
+            partition["writer"].close()
+            directory, name = os.path.split(partition["path"])
+            os.replace(partition["path"], os.path.join(directory, name[1:]))
+
+    def _remove(self, experiments):
+        """Removes the rows of the experiments from every table, reading each
+        file of their drug and date partitions once."""
+
+        # (drug, date): the (cell line, experimenter) pairs to remove
+        removed = {}
+        for cell_line, created_on, created_by, drug in experiments:
+            removed.setdefault((str(drug), str(created_on)), set()).add((str(cell_line),
+                                                                         str(created_by)))
+        for (drug, created_on), pairs in removed.items():
+            for table in TABLES:
+                key = (table, drug, created_on)
+                # Finish the open file first so its rows are filtered too
+                if key in self.partitions:
+                    self._close_partition(key)
+                directory = self._directory(key)
+                if not os.path.isdir(directory):
+                    continue
+                for name in os.listdir(directory):
+                    if name.startswith("."):
+                        continue
+                    path = os.path.join(directory, name)
+                    contents = pq.read_table(path)
+                    keep = [(line, by) not in pairs for line, by in
+                            zip(contents["cell_line_str"].to_pylist(),
+                                contents["created_by"].to_pylist())]
+                    if all(keep):
+                        continue
+                    if any(keep):
+                        temporary = os.path.join(directory, "." + name)
+                        pq.write_table(contents.filter(pa.array(keep)), temporary)
+                        os.replace(temporary, path)
+                    else:
+                        os.remove(path)
+
+def export_database(store, sink, tables=None, batch_size=50000):
+    """
+    store: A LuminescenceStore from ctg_storage.open_store().
+
+    sink: A ParquetStore.
+
+    tables: The tables to export.  Defaults to every table in TABLES.
+
+    Copies the tables from the database into the sink, batch_size rows at a
+    time, so the database is never read into memory all at once.  Returns
+    the number of rows exported.
+    """
+
+    exported = 0
+    for table in tables or TABLES:
+        # A named cursor makes PostgreSQL send the rows in batches
+        if isinstance(store, PostgresStore):
+            cur = store.connection.cursor(name="ctg_export_" + table)
+        else:
+            cur = store.connection.cursor()
+        cur.execute(f"SELECT {', '.join(TABLES[table])} FROM {table}")
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            sink.add_rows(table, rows)
+            exported += sink.flush()
+        cur.close()
+    store.connection.rollback()
+
+    return exported
+
+
+def read_results(root, table, columns=None, filters=None):
+    """
+    root: The directory given to ParquetStore.
+
+    table: lum_well, lum_response, lum_drug_sens, or lum_drug_fit.
+
+    columns: The columns to read.  Defaults to every column.
+
+    filters: pyarrow filters such as [("drug", "=", "AMG-176"), ("created_on", ">=", "2019-01-01")].
+    Partitions and row groups that cannot match are skipped without being read.
+
+    Returns the matching rows as a data frame.
+    """
+
+    return pq.read_table(os.path.join(root, table), columns=columns, filters=filters,
+                         partitioning="hive", memory_map=True).to_pandas()
+
+
+def main(argv=None):
+    """Command line entry point, also run by ctg_cli.py export."""
+
+    export_parser = argparse.ArgumentParser(
+        description="Exports the CTG database tables to partitioned Parquet files.")
+    export_parser.add_argument("--dsn", default=DEFAULT_DSN,
+                               help="PostgreSQL connection string, or sqlite:<path> for a SQLite database.")
+    export_parser.add_argument("-o", dest="output", required=True, help="The output directory.")
+    export_parser.add_argument("--tables", nargs="+", choices=list(TABLES), default=None)
+    export_parser.add_argument("--row-group-size", type=int, default=100000)
+    args = export_parser.parse_args(argv)
+
+    with open_store(args.dsn) as store, ParquetStore(args.output, args.row_group_size) as sink:
+        count = export_database(store, sink, args.tables)
+    print(f"Exported {count} rows to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+# Dose-response curve fitting for ctg_analysis.py.
+# Fits a 4-parameter logistic (Hill) model to the normalized survival of
+# every cell line:
+#     survival = bottom + (top - bottom) / (1 + 10**(hill_slope * (log10(dose) - log10(IC50))))
+# The fits are calculated for all curves at once with a batched
+# Levenberg-Marquardt solver in NumPy, so refitting thousands of
+# historical experiments takes seconds.  The DMSO control (dose 0) is left
+# out of the fit because it cannot be placed on a log scale.
+#
+# Usage (refit everything stored in lum_drug_sens):
+# python ctg_fit.py --dsn "dbname=mcl1 user=blixt007" --cache fit_cache.json -w 4
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ctg_storage import FIT_COLUMNS
+
+# Limits that keep the solver away from meaningless curves
+HILL_LIMITS = (0.05, 20)
+LOG_IC50_MARGIN = 3  # Decades beyond the tested doses
+
+
+def logistic(log_doses, parameters):
+    """
+    log_doses: Array of log10 doses, shape (doses,) or (curves, doses).
+
+    parameters: Array of shape (curves, 4) with bottom, top, log10 IC50, and Hill slope.
+
+    Returns the modeled survival for each curve, shape (curves, doses).
+    """
+
+    bottom, top, log_ic50, hill = (parameters[:, [n]] for n in range(4))
+    return bottom + (top - bottom) / (1 + 10 ** (hill * (log_doses - log_ic50)))
+
+
+def _jacobian(log_doses, parameters):
+    """Partial derivatives of logistic() with respect to each parameter,
+    shape (curves, doses, 4)."""
+
+    bottom, top, log_ic50, hill = (parameters[:, [n]] for n in range(4))
+    power = 10 ** (hill * (log_doses - log_ic50))
+    denominator = 1 + power
+    d_top = 1 / denominator
+    d_bottom = 1 - d_top
+    # d/dp of 1/(1 + 10**u) is -ln(10) * 10**u / (1 + 10**u)**2 * du/dp
+    common = -(top - bottom) * np.log(10) * power / denominator ** 2
+    d_log_ic50 = common * -hill
+    d_hill = common * (log_doses - log_ic50)
+
+    return np.stack([d_bottom, d_top, d_log_ic50, d_hill], axis=-1)
+
+
+def initial_guesses(log_doses, survival):
+    """
+    log_doses: Array of log10 doses, shape (doses,).
+
+    survival: Normalized survival of each curve, shape (curves, doses).
+
+    Estimates starting parameters from the data: top and bottom from the
+    largest and smallest values, IC50 from where the curve first drops
+    below the midpoint, and a Hill slope of 1.
+    """
+
+    top = survival.max(axis=1)
+    bottom = survival.min(axis=1)
+    midpoint = (top + bottom) / 2
+    below = survival < midpoint[:, None]
+    # Index of the first dose below the midpoint (the middle dose if the curve never drops)
+    first_below = np.where(below.any(axis=1), below.argmax(axis=1), len(log_doses) // 2)
+    log_ic50 = log_doses[first_below]
+
+    return np.column_stack([bottom, top, log_ic50, np.ones(len(survival))])
+
+
+def _clip(parameters, log_doses):
+    """Keeps the Hill slope and IC50 within HILL_LIMITS and LOG_IC50_MARGIN."""
+    parameters[:, 2] = parameters[:, 2].clip(log_doses.min() - LOG_IC50_MARGIN,
+                                             log_doses.max() + LOG_IC50_MARGIN)
+    parameters[:, 3] = parameters[:, 3].clip(*HILL_LIMITS)
+    return parameters
+
+
+def fit_curves(log_doses, survival, start=None, iterations=100, tolerance=1e-10):
+    """
+    log_doses: Array of log10 doses, shape (doses,).
+
+    survival: Normalized survival of each curve, shape (curves, doses).
+
+    start: Optional starting parameters, shape (curves, 4).  Rows containing
+    NaN use initial_guesses() instead, which allows warm starts for only
+    some of the curves.
+
+    iterations: Maximum number of Levenberg-Marquardt steps.
+
+    tolerance: Curves stop updating once a step improves the sum of squared
+    residuals by less than this amount.
+
+    Fits every curve at once and returns the parameters (curves, 4) and the
+    sum of squared residuals of each curve.
+    """
+
+    survival = np.asarray(survival, dtype=float)
+    parameters = initial_guesses(log_doses, survival)
+    if start is not None:
+        warm = ~np.isnan(start).any(axis=1)
+        parameters[warm] = start[warm]
+    parameters = _clip(parameters, log_doses)
+
+    damping = np.full(len(survival), 1e-3)
+    residuals = logistic(log_doses, parameters) - survival
+    sse = (residuals ** 2).sum(axis=1)
+    active = np.ones(len(survival), dtype=bool)
+    identity = np.eye(4)
+
+    for _ in range(iterations):
+        if not active.any():
+            break
+        jacobian = _jacobian(log_doses, parameters[active])
+        jt_j = jacobian.transpose(0, 2, 1) @ jacobian
+        jt_r = (jacobian.transpose(0, 2, 1) @ residuals[active][:, :, None])[:, :, 0]
+        # Levenberg-Marquardt step, scaled by the diagonal of J^T J
+        scale = np.einsum("nii->ni", jt_j)[:, :, None] * identity + 1e-12 * identity
+        step = np.linalg.solve(jt_j + damping[active, None, None] * scale, -jt_r[:, :, None])[:, :, 0]
+
+        candidate = _clip(parameters[active] + step, log_doses)
+        candidate_residuals = logistic(log_doses, candidate) - survival[active]
+        candidate_sse = (candidate_residuals ** 2).sum(axis=1)
+
+        # Accept steps that improve the fit and relax the damping, otherwise increase it
+        improved = candidate_sse < sse[active]
+        indices = np.flatnonzero(active)
+        accepted = indices[improved]
+        converged = accepted[(sse[accepted] - candidate_sse[improved]) < tolerance]
+        parameters[accepted] = candidate[improved]
+        residuals[accepted] = candidate_residuals[improved]
+        sse[accepted] = candidate_sse[improved]
+        damping[accepted] /= 10
+        damping[indices[~improved]] *= 10
+
+        active[converged] = False
+        active[damping > 1e10] = False
+
+    return parameters, sse
+
+
+def log_auc(log_doses, survival):
+    """Area under the survival curve over log10 dose, divided by the log dose
+    range so a curve that stays at 100% survival has an AUC of 1."""
+    return np.trapz(survival, log_doses, axis=1) / (log_doses[-1] - log_doses[0])
+
+
+def treated_survival(normalized, doses):
+    """Returns the log10 doses and the normalized survival without the DMSO control."""
+    doses = np.asarray(doses, dtype=float)
+    treated = doses > 0
+    return np.log10(doses[treated]), np.asarray(normalized, dtype=float)[:, treated]
+
+
+def fit_summary(log_doses, survival, parameters, sse):
+    """Converts the output of fit_curves() into a dictionary of arrays: ic50,
+    hill_slope, top, bottom, r_squared, rmse, and log_auc."""
+
+    total = ((survival - survival.mean(axis=1, keepdims=True)) ** 2).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r_squared = np.where(total > 0, 1 - sse / total, np.nan)
+
+    return {"ic50": 10 ** parameters[:, 2],
+            "hill_slope": parameters[:, 3],
+            "top": parameters[:, 1],
+            "bottom": parameters[:, 0],
+            "r_squared": r_squared,
+            "rmse": np.sqrt(sse / survival.shape[1]),
+            "log_auc": log_auc(log_doses, survival)}
+
+
+def fit_plates(plates, doses, drug="", cache=None):
+    """
+    plates: A dictionary from ctg_engine.analyze_plates().
+
+    doses: List of doses used in experiment, including 0 for the DMSO control.
+
+    drug: The name of the drug, used as part of the cache key.
+
+    cache: An optional FitCache used to warm start the fit and updated with the results.
+
+    Fits the normalized survival of every cell line and returns the dictionary
+    from fit_summary().
+    """
+
+    log_doses, survival = treated_survival(plates["normalized"], doses)
+    keys = [(cell_line, drug) for cell_line in plates["cell_lines"]]
+    start = cache.get(keys) if cache is not None else None
+    parameters, sse = fit_curves(log_doses, survival, start)
+    if cache is not None:
+        cache.update(keys, parameters)
+
+    return fit_summary(log_doses, survival, parameters, sse)
+
+
+def fit_rows(plates, fits, drug, experiment_date, experimenter):
+    """Returns one lum_drug_fit row per cell line, in the order of FIT_COLUMNS."""
+
+    rows = []
+    for n, cell_line in enumerate(plates["cell_lines"]):
+        rows.append((cell_line, experiment_date, experimenter, drug)
+                    + tuple(round(float(fits[name][n]), 4) for name in FIT_COLUMNS[4:]))
+    return rows
+
+
+class FitCache:
+    """Parameters of previous fits stored in a JSON file and used as starting
+    points for later fits of the same cell line and drug."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.parameters = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as cache_file:
+                self.parameters = json.load(cache_file)
+
+    def get(self, keys):
+        """keys: A list of (cell_line, drug) tuples.
+
+        Returns cached parameters for each key, with NaN where none are cached."""
+        return np.array([self.parameters.get("|".join(key), [np.nan] * 4) for key in keys],
+                        dtype=float)
+
+    def update(self, keys, parameters):
+        """Stores the fitted parameters of each (cell_line, drug) key."""
+        for key, values in zip(keys, parameters):
+            if np.isfinite(values).all():
+                self.parameters["|".join(key)] = [float(value) for value in values]
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path, "w") as cache_file:
+                json.dump(self.parameters, cache_file)
+
+
+def _fit_chunk(arguments):
+    """Fits one chunk of curves in a worker process for refit_database()."""
+    log_doses, survival, start = arguments
+    return fit_curves(log_doses, survival, start)
+
+
+def refit_database(store, cache_path=None, workers=1, chunk_size=20000):
+    """
+    store: A LuminescenceStore from ctg_storage.open_store().
+
+    cache_path: Optional JSON file of previous fits used as warm starts.
+
+    workers: Number of processes.  Each fits chunks of chunk_size curves.
+
+    Fits every experiment in lum_drug_sens and replaces their rows of
+    lum_drug_fit with the results.  Plates without 10 doses have no means
+    in lum_drug_sens and are left out, as are drugs without doses in the
+    registry, so their fits are kept.  Returns the number of curves fitted.
+    """
+
+    # Imported here so fitting arrays does not require pandas
+    from ctg_analysis import drug_parameters
+    from ctg_storage import DOSE_COLUMNS
+
+    cur = store.connection.cursor()
+    cur.execute(f"SELECT cell_line_str, created_on, created_by, drug, {', '.join(DOSE_COLUMNS)} "
+                f"FROM lum_drug_sens WHERE dose_1 IS NOT NULL")
+    experiments = cur.fetchall()
+    cache = FitCache(cache_path)
+
+    rows = []
+    for drug in sorted({row[3] for row in experiments}):
+        try:
+            doses, _ = drug_parameters(drug)
+        except ValueError as error:
+            print(f"Skipping {drug}: {error}")
+            continue
+        drug_rows = [row for row in experiments if row[3] == drug]
+        means = np.array([row[4:4 + len(doses)] for row in drug_rows], dtype=float)
+        log_doses, survival = treated_survival(means / means[:, :1], doses)
+
+        # Fit in chunks so large histories can be spread over several processes
+        keys = [(row[0], drug) for row in drug_rows]
+        start = cache.get(keys)
+        chunks = [(log_doses, survival[n:n + chunk_size], start[n:n + chunk_size])
+                  for n in range(0, len(survival), chunk_size)]
+        if workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_fit_chunk, chunks))
+        else:
+            results = [_fit_chunk(chunk) for chunk in chunks]
+        parameters = np.concatenate([result[0] for result in results])
+        sse = np.concatenate([result[1] for result in results])
+        cache.update(keys, parameters)
+
+        fits = fit_summary(log_doses, survival, parameters, sse)
+        for n, row in enumerate(drug_rows):
+            rows.append((row[0], str(row[1]), row[2], drug)
+                        + tuple(round(float(fits[name][n]), 4) for name in FIT_COLUMNS[4:]))
+
+    store.replace_fits(rows)
+    cache.save()
+
+    return len(rows)
+
+
+if __name__ == "__main__":
+    from ctg_storage import DEFAULT_DSN, open_store
+
+    fit_parser = argparse.ArgumentParser(
+        description="Refits every experiment in lum_drug_sens and rewrites their rows of lum_drug_fit.")
+    fit_parser.add_argument("--dsn", default=DEFAULT_DSN,
+                            help="PostgreSQL connection string, or sqlite:<path> for a SQLite database.")
+    fit_parser.add_argument("--cache", default=None,
+                            help="JSON file of previous fits used as starting points.")
+    fit_parser.add_argument("-w", dest="workers", type=int, default=1,
+                            help="Number of worker processes.")
+    args = fit_parser.parse_args()
+
+    with open_store(args.dsn) as store:
+        print(f"Fitted {refit_database(store, args.cache, args.workers)} curves.")
@@ -0,0 +1,224 @@
+# Staged pipeline for ctg_analysis.py.
+# ctg_analysis() finishes one workbook before starting the next, so the CPU
+# waits while the database commits and the database waits while plots are
+# rendered.  Here each stage of ctg_analysis() runs in its own thread, and
+# the threads are joined by bounded queues.  While one workbook is written,
+# the next is analyzed and the one after it is read:
+#
+#   reader   read_workbook()     Opens each workbook and reads its sheets.
+#   compute  compute_workbook()  Normalization, AUSC, fits, and QC.
+#   writer   write_workbook()    The database transaction of each workbook.
+#   plotter  plot_workbook()     Renders the plots, or hands them to the
+#                                processes of a plot_executor.
+#
+# Each queue holds at most queue_size workbooks.  A slow stage therefore
+# holds up the stages before it, and read workbooks never pile up in memory.
+# Workbooks pass through every stage in order, so the database rows and
+# plots are the same as calling ctg_analysis() on each workbook in turn.
+# The threads overlap where the work releases the GIL: database round trips
+# and commits, file reads, and numpy.  Rendering is the slowest stage and
+# holds the GIL, so with a plot_executor the plotter only submits each
+# workbook's plots.  The calling thread then waits for them in order, with
+# up to queue_size workbooks being plotted at once.
+#
+# This is experimental and not used by ctg_batch.py.  On one CPU the stages
+# only take turns, and it measured slower than ctg_analysis() on each
+# workbook in turn, even writing to PostgreSQL with a plot_executor.  Time
+# it with ctg_benchmark.py pipeline before relying on it.
+#
+# SQLite connections can only be used in the thread that opened them.  The
+# writer thread therefore opens its own database connection, and the reader
+# and writer threads each open their own connection to the cache.  A failed
+# workbook is reported and the pipeline carries on.  Later jobs for the
+# same file (other drugs of the workbook) are skipped, as in ctg_batch.py,
+# where one failed drug fails the workbook.
+#
+# Usage:
+# jobs = [workbook_job(file, doses, unit, drug, viability_dictionary=viability,
+#                      experiment_date="2019-10-17", experimenter="NB", overwrite=True)
+#         for file in files]
+# for job in run_pipeline(jobs, dsn="sqlite:results.db"):
+#     print(job["file"], job["error"] or f"{job['seconds']:.1f}s")
+#
+# python ctg_benchmark.py pipeline --workbooks 8 --sheets 12
+
+import queue
+import sys
+import threading
+import time
+
+from ctg_analysis import compute_workbook, plot_workbook, read_workbook, write_workbook
+from ctg_storage import DEFAULT_DSN, open_store
+from ctg_trace import NULL_TRACER, profiled
+
+STAGES = ["reader", "compute", "writer", "plotter"]
+
+
+def _stage_thread(name, work, inbox, outbox, failed_files, tracer, profile_path, finish=None):
+    """
+    name: One of STAGES.
+
+    work: A function of (job, span) that runs the stage on one job.
+
+    inbox, outbox: The queues jobs are taken from and passed on to.  None
+    marks the end of the jobs.
+
+    failed_files: The files of failed jobs, shared by every stage.
+
+    finish: Called in the thread after the last job, e.g. to close its connections.
+
+    Returns the thread running the stage.  Jobs that failed or were skipped
+    in an earlier stage are passed on without running it.
+    """
+
+    def run():
+        with profiled(None if profile_path is None else f"{profile_path}.{name}"):
+            try:
+                while True:
+                    job = inbox.get()
+                    if job is None:
+                        break
+                    if job["error"] is None and job["file"] in failed_files:
+                        job["error"] = "skipped after an earlier failure in the same file"
+                    if job["error"] is None and not job["skipped"]:
+                        try:
+                            with tracer.stage(name, file=job["file"]) as span:
+                                work(job, span)
+                        except Exception as error:
+                            job["error"] = f"{type(error).__name__}: {error}"
+                            failed_files.add(job["file"])
+                    outbox.put(job)
+            finally:
+                try:
+                    if finish is not None:
+                        finish()
+                finally:
+                    outbox.put(None)
+
+    return threading.Thread(target=run, name=f"ctg_{name}", daemon=True)
+
+
+def run_pipeline(jobs, dsn=DEFAULT_DSN, cache_path=None, plot_executor=None, tracer=None,
+                 queue_size=2, profile_path=None, done=None):
+    """
+    jobs: An iterable of dictionaries from ctg_analysis.workbook_job().
+    Each must have its viability_dictionary, experiment_date, experimenter,
+    and overwrite, since the pipeline cannot prompt for them.
+
+    dsn: The database the writer thread connects to (see ctg_storage.open_store()).
+
+    cache_path: Optional AnalysisCache file.  See ctg_analysis().
+
+    plot_executor: An optional concurrent.futures executor the plotter hands
+    the plots to.  Give it queue_size workers to keep them all busy.
+
+    tracer: A Tracer from ctg_trace.py.  Each stage of each workbook is
+    recorded, with the stages of ctg_analysis() inside it.
+
+    queue_size: The most workbooks waiting between two stages.
+
+    profile_path: Save cProfile statistics of each stage thread to
+    <profile_path>.<stage>.  From Python 3.12 only one profiler can run at
+    a time, and it sees every thread, so the whole pipeline is saved to
+    <profile_path>.pipeline instead.
+
+    done: Called in the calling thread with each job as it finishes.
+
+    Runs every job through the stages and returns the jobs in order.  Each
+    has an error (None if it succeeded), skipped (True if the cache showed
+    nothing changed), plots_made (the number of plots), and seconds (from
+    the start of its read to the end of its plots).
+    """
+
+    if tracer is None:
+        tracer = NULL_TRACER
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(STAGES) + 1)]
+    failed_files = set()
+    # Connections opened by the thread that uses them
+    connections = {}
+
+    def cache(stage):
+        if cache_path is None:
+            return None
+        if stage not in connections:
+            from ctg_cache import AnalysisCache
+            connections[stage] = AnalysisCache(cache_path)
+        return connections[stage]
+
+    def read(job, span):
+        missing = [key for key in ["viability_dictionary", "experiment_date", "experimenter",
+                                   "overwrite"] if job[key] is None]
+        if missing:
+            raise ValueError(f"The pipeline cannot prompt for {', '.join(missing)}")
+        job["start"] = time.perf_counter()
+        job["skipped"] = not read_workbook(job, cache("reader"), tracer, span)
+
+    def compute(job, span):
+        compute_workbook(job, tracer)
+        # The cells are no longer needed once the rows are made
+        del job["xls_data"], job["rows"]
+
+    def write(job, span):
+        if "store" not in connections:
+            connections["store"] = open_store(dsn)
+        write_workbook(job, connections["store"], cache("writer"), tracer)
+        del job["sheet_data"]
+
+    def plot(job, span):
+        result = plot_workbook(job, plot_executor, tracer)
+        if plot_executor is None:
+            job["plots_made"] = result
+        else:
+            job["plot_job"] = result
+        del job["mean_dfs"]
+
+    def close(*names):
+        def finish():
+            for name in names:
+                if name in connections:
+                    connections.pop(name).close()
+        return finish
+
+    # From Python 3.12 cProfile uses sys.monitoring, which has one profiler for every thread
+    per_thread = sys.version_info < (3, 12)
+    threads = [_stage_thread(name, work, queues[n], queues[n + 1], failed_files, tracer,
+                             profile_path if per_thread else None, finish)
+               for n, (name, work, finish) in enumerate([("reader", read, close("reader")),
+                                                          ("compute", compute, None),
+                                                          ("writer", write, close("store", "writer")),
+                                                          ("plotter", plot, None)])]
+
+    def feed():
+        # Blocks while the reader's queue is full
+        try:
+            for job in jobs:
+                job.update({"error": None, "skipped": False, "plots_made": 0,
+                            "start": time.perf_counter()})
+                queues[0].put(job)
+        finally:
+            queues[0].put(None)
+
+    feeder = threading.Thread(target=feed, name="ctg_feed", daemon=True)
+    finished = []
+    with profiled(None if profile_path is None or per_thread else f"{profile_path}.pipeline"):
+        feeder.start()
+        for thread in threads:
+            thread.start()
+
+        while True:
+            job = queues[-1].get()
+            if job is None:
+                break
+            if "plot_job" in job:
+                try:
+                    job["plots_made"] = job.pop("plot_job").result()
+                except Exception as error:
+                    job["error"] = f"{type(error).__name__}: {error}"
+            job["seconds"] = time.perf_counter() - job.pop("start")
+            finished.append(job)
+            if done is not None:
+                done(job)
+        for thread in [feeder] + threads:
+            thread.join()
+
+    return finished
@@ -0,0 +1,234 @@
+# Plot rendering for ctg_analysis.py.
+# The bar plot and survival plot are built once per drug and dose series as
+# templates on the non-interactive Agg backend.  Each cell line only updates
+# the data, limits, and title of the existing artists before saving, instead
+# of building new figures through pyplot.  Plots can be saved as PNG files
+# (the same files vbar_luminescence_plot() and survival_plot() make), as one
+# multi-page PDF per workbook, or skipped.  render_plots() can hand the work
+# to a process pool so plotting does not hold up parsing and database writes.
+
+import os
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+from matplotlib.ticker import PercentFormatter
+import numpy as np
+
+PLOT_MODES = ["png", "pdf", "none"]
+
+# Templates already built in this process, keyed by drug, unit, and doses
+_templates = {}
+
+
+class PlotTemplates:
+    """The bar plot and survival plot for one drug and dose series.  Call
+    update() with a cell line's values, then save_bar_plot() and
+    save_survival_plot()."""
+
+    def __init__(self, doses, drug, unit):
+        matplotlib.rcParams["font.family"] = "Times New Roman"
+        self.doses = doses
+        self.drug = drug
+        self.unit = unit
+        positions = np.arange(len(doses))
+
+        # Vertical bar plot of raw luminescence
+        self.bar_figure = Figure()
+        FigureCanvasAgg(self.bar_figure)
+        ax = self.bar_figure.add_subplot(1, 1, 1)
+        self.bars = ax.bar(x=[str(dose) + ' nM' for dose in doses], height=np.ones(len(doses)), # Data
+                           yerr=np.zeros(len(doses)), capsize=5, # Error bar settings
+                           color="blue", edgecolor="black", alpha=0.5 # Color of bars and outline
+                           )
+        self.positions = positions
+        for label in ax.get_xticklabels():
+            label.set_rotation(45)
+            label.set_ha("right") # ha='right' helps keep labels aligned
+        ax.set_ylabel("Luminescence", size=20)
+        ax.set_xlabel("Treatment", size=20)
+        ax.tick_params(axis="both", labelsize=17)
+        ax.grid(axis="y", color="grey", linewidth=0.5)
+        self.bar_title = ax.set_title("", size=20)
+        self.bar_ax = ax
+
+        # Survival plot of normalized luminescence on a log scale
+        self.survival_figure = Figure()
+        FigureCanvasAgg(self.survival_figure)
+        ax = self.survival_figure.add_subplot(1, 1, 1)
+        # Adds one to every value so log scale can be used (log 1 = 0)
+        self.line, = ax.plot([dose+1 for dose in doses], np.ones(len(doses)), # Data
+                             linestyle='-', color='dodgerblue', marker='o', # Line and marker specs
+                             )
+        ax.set_ylabel("Survival", size=20)
+        ax.set_xlabel(f"{drug} ({unit})", size=20)
+        ax.set_xscale('log')
+        ax.tick_params(axis="both", labelsize=17)
+        ax.grid(axis="y", color="grey", linewidth=0.5)
+        ax.yaxis.set_major_formatter(PercentFormatter(xmax=1, decimals=0))
+        self.survival_title = ax.set_title("", size=20)
+        self.survival_ax = ax
+
+    def update(self, cell_line, means, stdev, normalized):
+        """Replaces the data and titles with the values of one cell line."""
+
+        cell_line = cell_line.upper()
+        means = np.asarray(means, dtype=float)
+        stdev = np.asarray(stdev, dtype=float)
+
+        # Bars, error bars, and caps
+        for bar, height in zip(self.bars.patches, means):
+            bar.set_height(height)
+        _, caplines, barlinecols = self.bars.errorbar.lines
+        barlinecols[0].set_segments([[(x, mean - sd), (x, mean + sd)]
+                                     for x, mean, sd in zip(self.positions, means, stdev)])
+        caplines[0].set_ydata(means - stdev)
+        caplines[1].set_ydata(means + stdev)
+        # Same limits pyplot's autoscaling gives the bars and error bars
+        self.bar_ax.set_ylim(0, np.nanmax(means + stdev) * 1.05)
+        self.bar_title.set_text(f"{cell_line} Treated With {self.drug}")
+
+        # Survival curve
+        self.line.set_ydata(normalized)
+        self.survival_ax.relim()
+        self.survival_ax.autoscale_view()
+        self.survival_ax.set_ylim(bottom=0)
+        self.survival_title.set_text(f"{cell_line} Survival Plot")
+
+        self.cell_line = cell_line
+
+    def save_bar_plot(self, path, tag=None):
+        """Saves path/<CELL_LINE>_bar_plot.png, or <CELL_LINE>_<tag>_bar_plot.png."""
+        name = self.cell_line if tag is None else f"{self.cell_line}_{tag}"
+        self.bar_figure.savefig(os.path.join(path, name + "_bar_plot.png"), bbox_inches="tight")
+
+    def save_survival_plot(self, path, tag=None):
+        """Saves path/<CELL_LINE>_survival_plot.png, or <CELL_LINE>_<tag>_survival_plot.png."""
+        name = self.cell_line if tag is None else f"{self.cell_line}_{tag}"
+        self.survival_figure.savefig(os.path.join(path, name + "_survival_plot.png"),
+                                     bbox_inches="tight")
+
+
+def get_templates(doses, drug, unit):
+    """Returns the PlotTemplates for the drug and doses, building them the first
+    time they are needed in this process."""
+
+    key = (drug, unit, tuple(doses))
+    if key not in _templates:
+        _templates[key] = PlotTemplates(doses, drug, unit)
+    return _templates[key]
+
+
+def save_plots(curves, doses, drug, unit, path, mode="png", name="plots", tag=None):
+    """
+    curves: A list of (cell_line, means, stdev, normalized) tuples, one per cell line.
+
+    doses, drug, unit: See ctg_analysis().
+
+    path: The directory the plots are saved in.
+
+    mode: "png" saves a bar plot and survival plot for every cell line,
+    "pdf" saves all of them as pages of path/<name>.pdf, and "none" skips plotting.
+
+    tag: Added to the name of every PNG, such as the drug when the drugs of
+    one workbook are plotted into the same directory.
+
+    Renders the plots and returns the number of plots made.
+    """
+
+    if mode == "none" or not curves:
+        return 0
+    if mode not in PLOT_MODES:
+        raise ValueError(f"Plot mode must be one of {PLOT_MODES}, not {mode}")
+
+    templates = get_templates(doses, drug, unit)
+    if mode == "png":
+        for cell_line, means, stdev, normalized in curves:
+            templates.update(cell_line, means, stdev, normalized)
+            templates.save_bar_plot(path, tag)
+            templates.save_survival_plot(path, tag)
+    else:
+        with PdfPages(os.path.join(path, name + ".pdf")) as pdf:
+            for cell_line, means, stdev, normalized in curves:
+                templates.update(cell_line, means, stdev, normalized)
+                pdf.savefig(templates.bar_figure, bbox_inches="tight")
+                pdf.savefig(templates.survival_figure, bbox_inches="tight")
+
+    return 2 * len(curves)
+
+
+def curves_from_mean_dfs(mean_dfs):
+    """Converts the mean_df of each cell line into the plain tuples used by
+    save_plots(), which are cheap to send to another process."""
+    return [(mean_df.columns[0], mean_df.iloc[:, 0].values, mean_df["stdev"].values,
+             mean_df["normalized_mean"].values) for mean_df in mean_dfs]
+
+
+def render_plots(mean_dfs, doses, drug, unit, path, mode="png", executor=None, name="plots",
+                 tag=None):
+    """
+    mean_dfs: A list of data frames from make_mean_df(), one per cell line.
+
+    doses, drug, unit, path, mode, name, tag: See save_plots().
+
+    executor: An optional concurrent.futures executor.  If provided, the plots
+    are rendered there and a future is returned; otherwise they are rendered
+    now and the number of plots is returned.
+    """
+
+    curves = curves_from_mean_dfs(mean_dfs)
+    if executor is not None:
+        return executor.submit(save_plots, curves, doses, drug, unit, path, mode, name, tag)
+    return save_plots(curves, doses, drug, unit, path, mode, name, tag)
+
+
+def plot_database(store, path, drug=None, created_on=None, created_by=None, mode="png"):
+    """
+    store: A LuminescenceStore from ctg_storage.open_store().
+
+    path: The directory the plots are saved in.  Each experiment (drug, date,
+    and experimenter) gets its own subdirectory.
+
+    drug, created_on, created_by: Only plot experiments matching these.
+
+    mode: "png" or "pdf" (see save_plots()).
+
+    Makes the plots of ctg_analysis() again from the lum_response table,
+    without reading any workbooks.  Returns the number of plots made.
+    """
+
+    filters = [(column, value) for column, value in [("drug", drug), ("created_on", created_on),
+                                                     ("created_by", created_by)]
+               if value is not None]
+    where = " AND ".join(f"{column} = {store.placeholder}" for column, _ in filters)
+    cur = store.connection.cursor()
+    cur.execute("SELECT drug, created_on, created_by, unit, cell_line_str, dose, mean, stdev, normalized "
+                "FROM lum_response" + (f" WHERE {where}" if where else "")
+                + " ORDER BY drug, created_on, created_by, cell_line_str, dose_number",
+                tuple(value for _, value in filters))
+
+    # (drug, date, experimenter, unit): cell line: list of (dose, mean, stdev, normalized)
+    experiments = {}
+    for drug_name, date, experimenter, unit, cell_line, dose, mean, stdev, normalized in cur.fetchall():
+        experiment = experiments.setdefault((drug_name, str(date), experimenter, unit), {})
+        experiment.setdefault(cell_line, []).append((dose, mean, stdev, normalized))
+
+    count = 0
+    for (drug_name, date, experimenter, unit), cell_lines in experiments.items():
+        directory = os.path.join(path, f"{drug_name}_{date}_{experimenter}")
+        os.makedirs(directory, exist_ok=True)
+        # Cell lines of one experiment share a dose series unless a plate was different
+        series = {}
+        for cell_line, values in cell_lines.items():
+            doses = tuple(int(dose) if float(dose).is_integer() else float(dose)
+                          for dose, _, _, _ in values)
+            curve = (cell_line,) + tuple(np.array(column, dtype=float)
+                                         for column in list(zip(*values))[1:])
+            series.setdefault(doses, []).append(curve)
+        for number, (doses, curves) in enumerate(series.items()):
+            name = "plots" if number == 0 else f"plots_{number + 1}"
+            count += save_plots(curves, list(doses), drug_name, unit, directory, mode, name)
+
+    return count
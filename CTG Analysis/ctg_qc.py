@@ -0,0 +1,142 @@
+# Plate quality control for ctg_analysis.py.
+# The plate reader's Mean and Std Dev columns include every well.  Here the
+# statistics are calculated again from the raw luminescence of each well,
+# for every plate of a workbook (or batch) at once on the stacked
+# cell line x replicate x dose array from ctg_engine.stack_sheets():
+#
+# - Outlier wells are found with a robust z-score, (lum - median) / scale
+#   within each dose, where scale is the MAD / 0.6745 of the dose.  Four
+#   replicates give an unreliable MAD (it is 0 when most wells agree), so
+#   the scale is never below the plate's typical relative spread, the
+#   median |lum / median - 1| of all its wells / 0.6745, times the dose's
+#   median.  Wells above the threshold are outliers, but at least
+#   min_wells wells of each dose are always kept.
+# - The mean, standard deviation, and CV (%) of each dose without outliers.
+# - The Z'-factor of each plate, 1 - 3 * (sd_dmso + sd_top) / |mean_dmso - mean_top|,
+#   with the DMSO control as the high signal and the highest dose as the
+#   low signal.  The plates have no blank wells, so it measures the window
+#   of the dose response rather than of the assay.
+#
+# A plate passes if the CV of its DMSO wells is at most cv_limit (and its
+# Z'-factor is at least z_prime_limit, if one is given).  The verdicts are
+# stored in the lum_qc table.  With qc="drop", ctg_analysis() also uses the
+# means without outliers for normalization and AUSC (see
+# ctg_engine.analyze_plates()); with qc="flag" the plate reader's means are
+# kept and outliers are only recorded.
+#
+# Usage:
+# ctg_analysis(file, doses, unit, drug, ..., qc="drop")
+# python ctg_batch.py -i /path/to/exports -m manifest.json --qc flag
+
+import numpy as np
+
+
+def robust_z(lum):
+    """
+    lum: An array of cell line x replicate x dose.
+
+    Returns the robust z-score (see the top of this file) of every well
+    relative to the other wells of the same dose, with the same shape as lum.
+    """
+
+    lum = np.asarray(lum, dtype=float)
+    median = np.median(lum, axis=1, keepdims=True)
+    deviation = lum - median
+    mad_scale = np.median(np.abs(deviation), axis=1, keepdims=True) / 0.6745
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative = np.abs(deviation / median).reshape(len(lum), -1)
+        plate_scale = np.nanmedian(relative, axis=1)[:, None, None] / 0.6745
+        scale = np.maximum(mad_scale, plate_scale * np.abs(median))
+        return np.where(scale > 0, deviation / scale, 0.0)
+
+
+def outlier_mask(lum, threshold=3.5, min_wells=3):
+    """
+    lum: An array of cell line x replicate x dose.
+
+    threshold: Wells with an absolute robust z-score above this are outliers.
+
+    min_wells: The fewest wells kept for each dose.  If more wells are above
+    the threshold, only the furthest from the median are outliers.
+
+    Returns a boolean array shaped like lum that is True for outlier wells.
+    """
+
+    z = np.abs(robust_z(lum))
+    max_outliers = max(z.shape[1] - min_wells, 0)
+    # Rank of each well within its dose, 0 for the furthest from the median
+    ranks = np.argsort(np.argsort(-z, axis=1, kind="stable"), axis=1)
+    return (z > threshold) & (ranks < max_outliers)
+
+
+def masked_stats(lum, outliers):
+    """
+    lum: An array of cell line x replicate x dose.
+
+    outliers: A boolean array shaped like lum, True for wells to leave out.
+
+    Returns the mean and sample standard deviation of each dose (cell line x
+    dose arrays) from the remaining wells.
+    """
+
+    kept = np.where(outliers, np.nan, np.asarray(lum, dtype=float))
+    return np.nanmean(kept, axis=1), np.nanstd(kept, axis=1, ddof=1)
+
+
+def plate_qc(plates, threshold=3.5, min_wells=3, cv_limit=20.0, z_prime_limit=None):
+    """
+    plates: A dictionary from ctg_engine.stack_sheets() or stack_plates().
+
+    threshold, min_wells: See outlier_mask().
+
+    cv_limit: The largest CV (%) of the DMSO wells for a plate to pass.
+
+    z_prime_limit: The smallest Z'-factor for a plate to pass, or None to
+    leave it out of the verdict.  Resistant cell lines never reach a low
+    signal at the highest dose, so their Z'-factor is low for a good plate.
+
+    Returns a dictionary of arrays: outliers (like plates["lum"]), means,
+    stdev, and cv (cell line x dose), and z_prime and passed (one per cell line).
+    """
+
+    outliers = outlier_mask(plates["lum"], threshold, min_wells)
+    means, stdev = masked_stats(plates["lum"], outliers)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cv = 100 * stdev / means
+        z_prime = 1 - 3 * (stdev[:, 0] + stdev[:, -1]) / np.abs(means[:, 0] - means[:, -1])
+    passed = cv[:, 0] <= cv_limit
+    if z_prime_limit is not None:
+        passed &= z_prime >= z_prime_limit
+
+    return {"outliers": outliers, "means": means, "stdev": stdev, "cv": cv,
+            "z_prime": z_prime, "passed": passed}
+
+
+def qc_rows(plates, qc, drug, experiment_date, experimenter, dropped):
+    """
+    plates: A dictionary from ctg_engine.stack_sheets().
+
+    qc: The dictionary from plate_qc().
+
+    drug, experiment_date, experimenter: See ctg_analysis().
+
+    dropped: True if the outliers were left out of the stored means.
+
+    Returns one lum_qc row per cell line, in the order of ctg_storage.QC_COLUMNS.
+    """
+
+    def number(value):
+        # NULL instead of NaN or infinity, e.g. for a Z'-factor with no window
+        return round(float(value), 4) if np.isfinite(value) else None
+
+    outlier_counts = qc["outliers"].sum(axis=(1, 2))
+    max_cv = np.nanmax(np.where(np.isfinite(qc["cv"]), qc["cv"], np.nan), axis=1)
+    rows = []
+    for n, cell_line in enumerate(plates["cell_lines"]):
+        wells = ",".join(f"well_{replicate + 1}:dose_{dose + 1}"
+                         for replicate, dose in np.argwhere(qc["outliers"][n]))
+        rows.append((cell_line, experiment_date, experimenter, drug,
+                     int(plates["lum"][n].size), int(outlier_counts[n]), wells,
+                     number(qc["means"][n, 0]), number(qc["cv"][n, 0]), number(max_cv[n]),
+                     number(qc["z_prime"][n]), int(qc["passed"][n]), int(dropped)))
+    return rows
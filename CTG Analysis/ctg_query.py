@@ -0,0 +1,250 @@
+# Queries across experiments for the tables written by ctg_analysis.py.
+# ensure_schema() adds indexes on (cell_line_str, drug, created_on) to
+# lum_drug_sens, raw_lum, lum_drug_fit, and lum_response, and creates
+# lum_summary, a summary of every cell line and drug pair:
+#
+#   experiments, mean_ausc, sd_ausc, min_ausc, max_ausc, first_run, latest_run
+#
+# The summary is refreshed incrementally.  LuminescenceStore.flush() records
+# the cell line and drug of everything it writes or replaces in
+# lum_summary_dirty, once per pair, and refresh_summaries() recalculates
+# only those pairs from lum_drug_sens, in one transaction that also empties
+# the dirty table.  When nothing is dirty, summary() reads lum_summary
+# without taking any locks.  Rows written without a LuminescenceStore are
+# picked up with full=True.
+#
+# Usage:
+# from ctg_query import summary, experiments
+# with open_store() as store:
+#     summary(store, drugs=["AMG-176"])              # Refreshed, then read from lum_summary
+#     experiments(store, cell_lines=["mm1s"], drugs=["AMG-176"], since="2019-01-01")
+#
+# python ctg_query.py summary --drug AMG-176
+# python ctg_query.py refresh --full
+
+import argparse
+import math
+import time
+
+import pandas as pd
+
+from ctg_storage import (DEFAULT_DSN, FIT_COLUMNS, PROCESSED_COLUMNS, RAW_COLUMNS,
+                         RESPONSE_COLUMNS, SQLiteStore, open_store)
+
+SUMMARY_COLUMNS = ["cell_line_str", "drug", "experiments", "mean_ausc", "sd_ausc", "min_ausc",
+                   "max_ausc", "first_run", "latest_run"]
+SUMMARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lum_summary (
+    cell_line_str TEXT, drug TEXT, experiments INTEGER, mean_ausc REAL, sd_ausc REAL,
+    min_ausc REAL, max_ausc REAL, first_run DATE, latest_run DATE,
+    PRIMARY KEY (cell_line_str, drug));
+"""
+
+# Table: the indexed columns.  Most queries select a cell line and drug,
+# then a range of dates.
+INDEXES = {table: ["cell_line_str", "drug", "created_on"]
+           for table in ["lum_drug_sens", "raw_lum", "lum_drug_fit", "lum_response"]}
+
+# The summary of the pairs listed in lum_summary_dirty, calculated from
+# lum_drug_sens.  The standard deviation is taken around each pair's mean
+# instead of from sums of squares, which lose precision.
+REFRESH_SQL = """
+INSERT INTO lum_summary (cell_line_str, drug, experiments, mean_ausc, sd_ausc, min_ausc,
+                         max_ausc, first_run, latest_run)
+SELECT s.cell_line_str, s.drug, COUNT(*), AVG(s.ausc),
+       CASE WHEN COUNT(*) > 1
+            THEN sqrt(SUM((s.ausc - m.mean_ausc) * (s.ausc - m.mean_ausc)) / (COUNT(*) - 1)) END,
+       MIN(s.ausc), MAX(s.ausc), MIN(s.created_on), MAX(s.created_on)
+FROM lum_drug_sens s
+JOIN (SELECT cell_line_str, drug, AVG(ausc) AS mean_ausc FROM lum_drug_sens
+      WHERE (cell_line_str, drug) IN (SELECT cell_line_str, drug FROM lum_summary_dirty)
+      GROUP BY cell_line_str, drug) m
+  ON s.cell_line_str = m.cell_line_str AND s.drug = m.drug
+GROUP BY s.cell_line_str, s.drug
+"""
+
+
+def _is_sqlite(store):
+    return isinstance(store, SQLiteStore)
+
+
+def _frame(cur):
+    """Returns the rows of an executed query as a data frame."""
+    return pd.DataFrame(cur.fetchall(), columns=[column[0] for column in cur.description])
+
+
+def ensure_schema(store):
+    """
+    store: A PostgresStore or SQLiteStore from ctg_storage.open_store().
+
+    Creates the indexes and the lum_summary table if they are missing.  A
+    new lum_summary is filled from every row of lum_drug_sens.
+    """
+
+    with store.connection:
+        cur = store.connection.cursor()
+        for table, columns in INDEXES.items():
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_{'_'.join(columns)}_idx "
+                        f"ON {table} ({', '.join(columns)})")
+        if _is_sqlite(store):
+            cur.execute("SELECT name FROM sqlite_master WHERE name = 'lum_summary'")
+            created = cur.fetchone() is None
+        else:
+            cur.execute("SELECT to_regclass('lum_summary')")
+            created = cur.fetchone()[0] is None
+        cur.execute(SUMMARY_SCHEMA)
+    if created:
+        refresh_summaries(store, full=True)
+
+
+def refresh_summaries(store, full=False):
+    """
+    store: A PostgresStore or SQLiteStore.
+
+    full: Recalculate every pair instead of only those in lum_summary_dirty.
+
+    Brings lum_summary up to date in one transaction.  Returns the number
+    of cell line and drug pairs recalculated.
+    """
+
+    if not full:
+        # Nothing to do, so readers never wait for or block a writer
+        cur = store.connection.cursor()
+        cur.execute("SELECT 1 FROM lum_summary_dirty LIMIT 1")
+        dirty = cur.fetchone() is not None
+        store.connection.rollback()
+        if not dirty:
+            return 0
+    if _is_sqlite(store):
+        # SQLite is not always built with its math functions
+        store.connection.create_function("sqrt", 1, lambda value: None if value is None
+                                         else math.sqrt(value))
+    with store.connection:
+        cur = store.connection.cursor()
+        if not _is_sqlite(store):
+            # Flushes that started earlier commit first, and later ones wait,
+            # so no pair can be marked dirty while it is being recalculated
+            cur.execute("LOCK TABLE lum_summary_dirty IN SHARE ROW EXCLUSIVE MODE")
+        if full:
+            cur.execute("DELETE FROM lum_summary_dirty")
+            cur.execute("INSERT INTO lum_summary_dirty (cell_line_str, drug) "
+                        "SELECT DISTINCT cell_line_str, drug FROM lum_drug_sens")
+            cur.execute("DELETE FROM lum_summary")
+        else:
+            cur.execute("DELETE FROM lum_summary WHERE (cell_line_str, drug) IN "
+                        "(SELECT cell_line_str, drug FROM lum_summary_dirty)")
+        cur.execute("SELECT COUNT(*) FROM lum_summary_dirty")
+        pairs = cur.fetchone()[0]
+        if pairs:
+            cur.execute(REFRESH_SQL)
+            cur.execute("DELETE FROM lum_summary_dirty")
+
+    return pairs
+
+
+def _where(store, filters):
+    """
+    filters: A list of (column, operator, value) tuples.  A list or tuple
+    value with "in" becomes an IN list, and None values are left out.
+
+    Returns the WHERE clause and its parameters.
+    """
+
+    clauses, parameters = [], []
+    for column, operator, value in filters:
+        if value is None:
+            continue
+        if operator == "in":
+            values = [value] if isinstance(value, str) else list(value)
+            clauses.append(f"{column} IN ({', '.join([store.placeholder] * len(values))})")
+            parameters.extend(values)
+        else:
+            clauses.append(f"{column} {operator} {store.placeholder}")
+            parameters.append(value)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), parameters
+
+
+def summary(store, cell_lines=None, drugs=None, refresh=True):
+    """
+    store: A PostgresStore or SQLiteStore.
+
+    cell_lines, drugs: Lists (or single names) to select.  Defaults to every one.
+
+    refresh: Recalculate dirty pairs first, so the results include every flush.
+
+    Returns the rows of lum_summary as a data frame, one row per cell line and drug.
+    """
+
+    if refresh:
+        refresh_summaries(store)
+    where, parameters = _where(store, [("cell_line_str", "in", cell_lines), ("drug", "in", drugs)])
+    cur = store.connection.cursor()
+    cur.execute(f"SELECT {', '.join(SUMMARY_COLUMNS)} FROM lum_summary{where} "
+                f"ORDER BY drug, cell_line_str", parameters)
+    return _frame(cur)
+
+
+def _experiment_query(store, table, columns, cell_lines, drugs, since, until):
+    where, parameters = _where(store, [("cell_line_str", "in", cell_lines), ("drug", "in", drugs),
+                                       ("created_on", ">=", since), ("created_on", "<=", until)])
+    cur = store.connection.cursor()
+    cur.execute(f"SELECT {', '.join(columns)} FROM {table}{where} "
+                f"ORDER BY cell_line_str, drug, created_on", parameters)
+    return _frame(cur)
+
+
+def experiments(store, cell_lines=None, drugs=None, since=None, until=None):
+    """
+    store: A PostgresStore or SQLiteStore.
+
+    cell_lines, drugs: Lists (or single names) to select.  Defaults to every one.
+
+    since, until: The first and last experiment dates (yyyy-mm-dd) to include.
+
+    Returns the matching rows of lum_drug_sens, one per experiment.
+    """
+    return _experiment_query(store, "lum_drug_sens", PROCESSED_COLUMNS, cell_lines, drugs,
+                             since, until)
+
+
+def wells(store, cell_lines=None, drugs=None, since=None, until=None):
+    """Returns the matching rows of raw_lum, one per well.  See experiments()."""
+    return _experiment_query(store, "raw_lum", RAW_COLUMNS, cell_lines, drugs, since, until)
+
+
+def responses(store, cell_lines=None, drugs=None, since=None, until=None):
+    """Returns the matching rows of lum_response, one per experiment and
+    dose, for plates with any number of doses.  See experiments()."""
+    return _experiment_query(store, "lum_response", RESPONSE_COLUMNS, cell_lines, drugs,
+                             since, until)
+
+
+def fits(store, cell_lines=None, drugs=None, since=None, until=None):
+    """Returns the matching rows of lum_drug_fit.  See experiments()."""
+    return _experiment_query(store, "lum_drug_fit", FIT_COLUMNS, cell_lines, drugs, since, until)
+
+
+if __name__ == "__main__":
+    query_parser = argparse.ArgumentParser(description="Summarizes experiments across the CTG tables.")
+    query_parser.add_argument("command", choices=["summary", "refresh"])
+    query_parser.add_argument("--dsn", default=DEFAULT_DSN,
+                              help="PostgreSQL connection string, or sqlite:<path> for a SQLite database.")
+    query_parser.add_argument("--cell-line", dest="cell_lines", nargs="+", default=None)
+    query_parser.add_argument("--drug", dest="drugs", nargs="+", default=None)
+    query_parser.add_argument("--full", action="store_true",
+                              help="Recalculate every summary instead of only the changed ones.")
+    args = query_parser.parse_args()
+    if args.dsn.startswith("parquet:"):
+        query_parser.error("summaries are kept in a PostgreSQL or SQLite database, not parquet: "
+                           "files; load those with ctg_export.read_results()")
+
+    with open_store(args.dsn) as store:
+        ensure_schema(store)
+        start = time.perf_counter()
+        if args.command == "refresh":
+            pairs = refresh_summaries(store, args.full)
+            print(f"Refreshed {pairs} summaries in {time.perf_counter() - start:.3f}s")
+        else:
+            with pd.option_context("display.max_rows", None, "display.max_columns", None,
+                                   "display.width", 200):
+                print(summary(store, args.cell_lines, args.drugs))
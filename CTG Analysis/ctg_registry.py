@@ -0,0 +1,129 @@
+# Drug and dose registry for ctg_analysis.py.
+# The drugs, their dose series and units, the sheet name suffixes that
+# identify them, and the plate layouts are read from drugs.json next to this
+# file (or from the file named by the CTG_REGISTRY environment variable)
+# instead of being written into the code.
+#
+# File format:
+# {
+#     "layouts": {"dmso_9_doses": {"replicates": 4}},
+#     "drugs": {
+#         "AMG-176": {"aliases": ["amg"], "doses": [0, 5, 16, ...],
+#                     "unit": "nM", "layout": "dmso_9_doses"}
+#     }
+# }
+#
+# Aliases are matched case-insensitively after an underscore in the sheet
+# name, so "mm1s_amg176" is MM1S treated with AMG-176.  They are also
+# accepted in place of the drug's name.  A drug with an empty dose list is
+# known but cannot be analyzed until its doses are added.
+#
+# The registry is loaded once per process and loaded again only if the
+# file changes.  Sheet names are matched with regular expressions that are
+# compiled when the registry is loaded.
+
+import json
+import os
+import re
+
+DEFAULT_REGISTRY = os.environ.get(
+    "CTG_REGISTRY", os.path.join(os.path.dirname(os.path.abspath(__file__)), "drugs.json"))
+
+# Registries already loaded in this process: path: (modification time, DrugRegistry)
+_registries = {}
+
+
+class DrugRegistry:
+    """The drugs, aliases, dose series, units, and plate layouts from a registry file."""
+
+    def __init__(self, contents):
+        self.layouts = contents.get("layouts", {})
+        self.drugs = contents["drugs"]
+
+        # Lower case drug names and aliases: drug name
+        self.names = {}
+        for drug, entry in self.drugs.items():
+            if entry.get("layout") is not None and entry["layout"] not in self.layouts:
+                raise ValueError(f"{drug} uses the unknown layout {entry['layout']}")
+            for name in [drug] + entry.get("aliases", []):
+                if self.names.setdefault(name.lower(), drug) != drug:
+                    raise ValueError(f"{name} is an alias of both {self.names[name.lower()]} and {drug}")
+
+        # One pattern for every drug and one for each drug, with the longest
+        # aliases tried first so a short alias cannot hide a longer one
+        self.sheet_pattern = suffix_pattern(
+            alias for entry in self.drugs.values() for alias in entry.get("aliases", []))
+        self.drug_patterns = {drug: suffix_pattern(entry.get("aliases", []))
+                              for drug, entry in self.drugs.items()}
+
+    def drug_name(self, name):
+        """Returns the registered name of a drug given its name or an alias.
+        Raises ValueError for an unknown drug."""
+        try:
+            return self.names[str(name).lower()]
+        except KeyError:
+            raise ValueError(f"Unknown drug: {name}") from None
+
+    def parameters(self, drug):
+        """Returns the doses and unit of the drug.  Raises ValueError if the
+        drug is unknown or has no dose series."""
+
+        drug = self.drug_name(drug)
+        entry = self.drugs[drug]
+        if not entry.get("doses"):
+            raise ValueError(f"No doses are registered for {drug}; add them to the registry file.")
+        return list(entry["doses"]), entry["unit"]
+
+    def layout(self, drug):
+        """Returns the plate layout dictionary of the drug, or an empty dictionary."""
+        return self.layouts.get(self.drugs[self.drug_name(drug)].get("layout"), {})
+
+    def resolve_sheet(self, sheet):
+        """
+        sheet: The name of a sheet, such as "mm1s_amg".
+
+        Returns the cell line and the drug named by the sheet's suffix.  The
+        drug is None if the sheet name does not contain a registered alias.
+        """
+
+        match = self.sheet_pattern.search(sheet) if self.sheet_pattern else None
+        if match is None:
+            return sheet.lower(), None
+        return sheet[:match.start()].lower(), self.names[match.group(1).lower()]
+
+    def cell_line(self, sheet, drug):
+        """Returns the sheet name without the suffix of the given drug, in lower case.
+        Sheets with no suffix or the suffix of a different drug are only lower cased."""
+
+        pattern = self.drug_patterns.get(self.names.get(str(drug).lower()))
+        match = pattern.search(sheet) if pattern else None
+        if match is not None:
+            sheet = sheet[:match.start()]
+        return sheet.lower()
+
+
+def suffix_pattern(aliases):
+    """Returns a compiled pattern matching an underscore followed by any of
+    the aliases, or None if there are no aliases."""
+    aliases = sorted({alias.lower() for alias in aliases}, key=len, reverse=True)
+    if not aliases:
+        return None
+    return re.compile("_(" + "|".join(re.escape(alias) for alias in aliases) + ")", re.IGNORECASE)
+
+
+def load_registry(path=None):
+    """
+    path: A registry file.  Defaults to DEFAULT_REGISTRY.
+
+    Returns the DrugRegistry for the file, reading it only the first time and
+    whenever its modification time changes.
+    """
+
+    path = os.path.abspath(path or DEFAULT_REGISTRY)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _registries.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as registry_file:
+            cached = (mtime, DrugRegistry(json.load(registry_file)))
+        _registries[path] = cached
+    return cached[1]
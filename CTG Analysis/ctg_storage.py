@@ -0,0 +1,347 @@
+# Storage layer for ctg_analysis.py.
+# Rows for the raw_lum and lum_drug_sens tables are buffered in memory and
+# written in a single transaction per workbook over one connection that is
+# kept open for the whole run.
+#
+# raw_lum and lum_drug_sens have one column per dose and only fit plates
+# with 10 doses.  Every plate is also written in long format to lum_well
+# (one row per well and dose) and lum_response (one row per dose), which
+# hold any number of doses and replicates.  Plates with a different number
+# of doses get no raw_lum rows, and their lum_drug_sens dose columns are NULL.
+# Plate QC verdicts from ctg_qc.py are written to lum_qc.  Every flush also
+# records the cell line and drug of each experiment written or replaced in
+# lum_summary_dirty, so ctg_query.py only refreshes the summaries of those
+# pairs.  PostgreSQL is the production database;
+# SQLite is a stand-in with the same interface for local testing and
+# benchmarking.
+#
+# Usage:
+# with open_store() as store:
+#     store.add(raw_data, processed_data)  # Once per sheet
+#     store.flush()                        # Once per workbook
+
+import csv
+import io
+import sqlite3
+
+DEFAULT_DSN = "dbname=mcl1 user=blixt007"
+
+DOSE_COLUMNS = ["dose_" + str(n) for n in range(1, 11)]
+
+# Column order of the lists made by parse_luminescence()
+RAW_COLUMNS = ["created_on", "created_by", "drug", "cell_line_str", "well"] + DOSE_COLUMNS
+PROCESSED_COLUMNS = ["cell_line_str", "created_on", "created_by", "viability",
+                     "drug", "ausc"] + DOSE_COLUMNS
+
+# Columns of lum_drug_fit, the curve fits from ctg_fit.py
+FIT_COLUMNS = ["cell_line_str", "created_on", "created_by", "drug", "ic50", "hill_slope",
+               "top", "bottom", "r_squared", "rmse", "log_auc"]
+
+# Columns of the long format tables, from ctg_engine.long_rows()
+WELL_COLUMNS = ["cell_line_str", "created_on", "created_by", "drug", "well", "dose_number",
+                "dose", "unit", "lum"]
+RESPONSE_COLUMNS = ["cell_line_str", "created_on", "created_by", "drug", "dose_number",
+                    "dose", "unit", "mean", "stdev", "normalized"]
+
+# Columns of lum_qc, from ctg_qc.qc_rows()
+QC_COLUMNS = ["cell_line_str", "created_on", "created_by", "drug", "wells", "outliers",
+              "outlier_wells", "dmso_mean", "dmso_cv", "max_cv", "z_prime", "passed", "dropped"]
+
+# These tables were added after the original tables, so they are created if missing
+FIT_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS lum_drug_fit (
+    cell_line_str TEXT, created_on DATE, created_by TEXT, drug TEXT,
+    {", ".join(column + " REAL" for column in FIT_COLUMNS[4:])});
+"""
+WELL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lum_well (
+    cell_line_str TEXT, created_on DATE, created_by TEXT, drug TEXT, well TEXT,
+    dose_number INTEGER, dose REAL, unit TEXT, lum REAL);
+"""
+RESPONSE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lum_response (
+    cell_line_str TEXT, created_on DATE, created_by TEXT, drug TEXT,
+    dose_number INTEGER, dose REAL, unit TEXT, mean REAL, stdev REAL, normalized REAL);
+"""
+QC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lum_qc (
+    cell_line_str TEXT, created_on DATE, created_by TEXT, drug TEXT, wells INTEGER,
+    outliers INTEGER, outlier_wells TEXT, dmso_mean REAL, dmso_cv REAL, max_cv REAL,
+    z_prime REAL, passed INTEGER, dropped INTEGER);
+"""
+DIRTY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lum_summary_dirty (
+    cell_line_str TEXT, drug TEXT, PRIMARY KEY (cell_line_str, drug));
+"""
+ADDED_TABLES = {"lum_drug_fit": FIT_SCHEMA, "lum_well": WELL_SCHEMA, "lum_response": RESPONSE_SCHEMA,
+                "lum_qc": QC_SCHEMA, "lum_summary_dirty": DIRTY_SCHEMA}
+
+# Used to create the tables in a SQLite stand-in database.  The original
+# PostgreSQL tables already exist.
+SQLITE_SCHEMA = FIT_SCHEMA + WELL_SCHEMA + RESPONSE_SCHEMA + QC_SCHEMA + DIRTY_SCHEMA + f"""
+CREATE TABLE IF NOT EXISTS raw_lum (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    {", ".join(column + " TEXT" for column in RAW_COLUMNS[:5])},
+    {", ".join(column + " REAL" for column in DOSE_COLUMNS)});
+CREATE TABLE IF NOT EXISTS lum_drug_sens (
+    cell_line_str TEXT, created_on TEXT, created_by TEXT, viability INTEGER,
+    drug TEXT, ausc REAL,
+    {", ".join(column + " REAL" for column in DOSE_COLUMNS)});
+"""
+
+
+class LuminescenceStore:
+    """Buffers rows from any number of sheets and writes them to the raw_lum
+    and lum_drug_sens tables in one transaction when flush() is called.
+
+    Subclasses open the connection and provide _write_raw(), _write_processed(),
+    _write_fits(), _write_long(), and the query placeholder for their database."""
+
+    placeholder = "%s"
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.raw_rows = []
+        self.processed_rows = []
+        self.fit_rows = []
+        self.well_rows = []
+        self.response_rows = []
+        self.qc_rows = []
+        self.replaced = []
+        self.rows_written = 0
+
+    def add(self, raw_data, processed_data):
+        """
+        raw_data: The nested list of raw_lum rows from parse_luminescence().
+
+        processed_data: The lum_drug_sens row from parse_luminescence().
+
+        Adds the rows of one sheet to the buffer.  Nothing is written until flush().
+        Plates without exactly 10 doses only fit the long format tables, so
+        their raw rows are left out and their dose columns are NULL.
+        """
+        if len(processed_data) != len(PROCESSED_COLUMNS):
+            self.processed_rows.append(tuple(processed_data[:6]) + (None,) * len(DOSE_COLUMNS))
+            return
+        self.raw_rows.extend(tuple(row) for row in raw_data)
+        self.processed_rows.append(tuple(processed_data))
+
+    def add_long(self, well_rows, response_rows):
+        """
+        well_rows, response_rows: The lum_well and lum_response rows from
+        ctg_engine.long_rows().
+
+        Adds the long format rows of one sheet to the buffer.
+        """
+        self.well_rows.extend(well_rows)
+        self.response_rows.extend(response_rows)
+
+    def add_fits(self, fit_rows):
+        """
+        fit_rows: lum_drug_fit rows from ctg_fit.fit_rows().
+
+        Adds curve fits to the buffer.  They are written with the other rows by flush().
+        """
+        self.fit_rows.extend(tuple(row) for row in fit_rows)
+
+    def add_qc(self, qc_rows):
+        """
+        qc_rows: lum_qc rows from ctg_qc.qc_rows().
+
+        Adds plate QC verdicts to the buffer.  They are written with the other rows by flush().
+        """
+        self.qc_rows.extend(tuple(row) for row in qc_rows)
+
+    def replace_experiments(self, experiments):
+        """
+        experiments: A list of (cell_line, created_on, created_by, drug) tuples.
+
+        Rows of these experiments already in raw_lum, lum_drug_sens,
+        lum_drug_fit, lum_well, lum_response, and lum_qc are deleted by the next flush(), in the same
+        transaction that writes their new rows.
+        """
+        self.replaced.extend(tuple(experiment) for experiment in experiments)
+
+    def replace_fits(self, fit_rows):
+        """Replaces the lum_drug_fit rows of the experiments in fit_rows with
+        fit_rows in one transaction.  Fits of other experiments are kept."""
+        fit_rows = [tuple(row) for row in fit_rows]
+        with self.connection:
+            cur = self.connection.cursor()
+            cur.executemany(f"DELETE FROM lum_drug_fit WHERE cell_line_str = {self.placeholder} "
+                            f"AND created_on = {self.placeholder} AND created_by = {self.placeholder} "
+                            f"AND drug = {self.placeholder}", [row[:4] for row in fit_rows])
+            self._write_fits(cur, fit_rows)
+
+    def when_written(self, callback):
+        """Calls callback once the rows flushed so far are written, which for
+        a database is as soon as flush() has committed."""
+        callback()
+
+    def clear(self):
+        """Discards buffered rows without writing them."""
+        self.raw_rows = []
+        self.processed_rows = []
+        self.fit_rows = []
+        self.well_rows = []
+        self.response_rows = []
+        self.qc_rows = []
+        self.replaced = []
+
+    def flush(self):
+        """Writes all buffered rows in a single transaction and empties the buffer.
+        If the write fails the transaction is rolled back and the rows are
+        kept so the caller may retry.  Returns the number of rows written."""
+
+        if not (self.raw_rows or self.processed_rows or self.fit_rows or self.well_rows
+                or self.response_rows or self.qc_rows or self.replaced):
+            return 0
+        # Commits on success and rolls back on an exception without closing
+        with self.connection:
+            cur = self.connection.cursor()
+            if self.replaced:
+                for table in ["raw_lum", "lum_drug_sens", "lum_drug_fit", "lum_well", "lum_response",
+                              "lum_qc"]:
+                    cur.executemany(f"DELETE FROM {table} WHERE cell_line_str = {self.placeholder} "
+                                    f"AND created_on = {self.placeholder} AND created_by = {self.placeholder} "
+                                    f"AND drug = {self.placeholder}", self.replaced)
+            if self.raw_rows:
+                self._write_raw(cur, self.raw_rows)
+            if self.processed_rows:
+                self._write_processed(cur, self.processed_rows)
+            if self.fit_rows:
+                self._write_fits(cur, self.fit_rows)
+            if self.well_rows:
+                self._write_long(cur, "lum_well", WELL_COLUMNS, self.well_rows)
+            if self.response_rows:
+                self._write_long(cur, "lum_response", RESPONSE_COLUMNS, self.response_rows)
+            if self.qc_rows:
+                self._write_long(cur, "lum_qc", QC_COLUMNS, self.qc_rows)
+            # Summaries of these cell lines and drugs are out of date (see ctg_query.py)
+            dirty = ({(row[0], row[4]) for row in self.processed_rows}
+                     | {(experiment[0], experiment[3]) for experiment in self.replaced})
+            # Each pair is listed once however often it is written before a refresh
+            cur.executemany(f"INSERT INTO lum_summary_dirty (cell_line_str, drug) "
+                            f"VALUES ({self.placeholder}, {self.placeholder}) "
+                            f"ON CONFLICT DO NOTHING", sorted(dirty))
+        written = (len(self.raw_rows) + len(self.processed_rows) + len(self.fit_rows)
+                   + len(self.well_rows) + len(self.response_rows) + len(self.qc_rows))
+        self.rows_written += written
+        self.clear()
+
+        return written
+
+    def close(self):
+        """Flushes any remaining rows and closes the connection."""
+        try:
+            self.flush()
+        finally:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Do not write a partial workbook if the analysis failed
+        if exc_type is not None:
+            self.clear()
+        self.close()
+
+    def _write_raw(self, cur, rows):
+        raise NotImplementedError
+
+    def _write_processed(self, cur, rows):
+        raise NotImplementedError
+
+    def _write_fits(self, cur, rows):
+        raise NotImplementedError
+
+    def _write_long(self, cur, table, columns, rows):
+        raise NotImplementedError
+
+
+class PostgresStore(LuminescenceStore):
+    """Writes raw_lum with COPY FROM STDIN and lum_drug_sens with a multi-row
+    INSERT from psycopg2.extras.execute_values."""
+
+    def __init__(self, dsn=DEFAULT_DSN):
+        import psycopg2
+        super().__init__(psycopg2.connect(dsn))
+        # Several workers may connect at once, so only one of them creates each table
+        for table, schema in ADDED_TABLES.items():
+            try:
+                with self.connection:
+                    cur = self.connection.cursor()
+                    cur.execute("SELECT to_regclass(%s)", (table,))
+                    if cur.fetchone()[0] is None:
+                        cur.execute(schema)
+            except (psycopg2.errors.UniqueViolation, psycopg2.errors.DuplicateTable):
+                pass
+
+    def _write_raw(self, cur, rows):
+        # COPY expects a file, so write the rows as CSV into memory first
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cur.copy_expert(f"COPY raw_lum ({', '.join(RAW_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                        buffer)
+
+    def _write_processed(self, cur, rows):
+        from psycopg2.extras import execute_values
+        # lum_drug_sens has no auto-increment column, so values are positional
+        execute_values(cur, "INSERT INTO lum_drug_sens VALUES %s", rows)
+
+    def _write_fits(self, cur, rows):
+        from psycopg2.extras import execute_values
+        execute_values(cur, f"INSERT INTO lum_drug_fit ({', '.join(FIT_COLUMNS)}) VALUES %s", rows)
+
+    def _write_long(self, cur, table, columns, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+class SQLiteStore(LuminescenceStore):
+    """A SQLite stand-in for the PostgreSQL database.  The tables are created
+    if they do not exist."""
+
+    placeholder = "?"
+
+    def __init__(self, path=":memory:"):
+        super().__init__(sqlite3.connect(path))
+        self.connection.executescript(SQLITE_SCHEMA)
+
+    def _write_raw(self, cur, rows):
+        cur.executemany(f"INSERT INTO raw_lum ({', '.join(RAW_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(RAW_COLUMNS))})", rows)
+
+    def _write_processed(self, cur, rows):
+        cur.executemany(f"INSERT INTO lum_drug_sens ({', '.join(PROCESSED_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(PROCESSED_COLUMNS))})", rows)
+
+    def _write_fits(self, cur, rows):
+        cur.executemany(f"INSERT INTO lum_drug_fit ({', '.join(FIT_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(FIT_COLUMNS))})", rows)
+
+    def _write_long(self, cur, table, columns, rows):
+        cur.executemany(f"INSERT INTO {table} ({', '.join(columns)}) "
+                        f"VALUES ({', '.join('?' * len(columns))})", rows)
+
+
+def open_store(dsn=DEFAULT_DSN):
+    """
+    dsn: A PostgreSQL connection string, "sqlite:" followed by the path
+    of a SQLite database ("sqlite::memory:" for an in-memory database), or
+    "parquet:" followed by a directory for Parquet files without a database.
+
+    Returns a PostgresStore, SQLiteStore, or ctg_export.ParquetStore for the dsn.
+    """
+
+    if dsn.startswith("parquet:"):
+        # Imported here so pyarrow is only needed for Parquet output
+        from ctg_export import ParquetStore
+        return ParquetStore(dsn[len("parquet:"):])
+    if dsn.startswith("sqlite:"):
+        return SQLiteStore(dsn[len("sqlite:"):] or ":memory:")
+    return PostgresStore(dsn)
@@ -0,0 +1,254 @@
+# Per-stage instrumentation for ctg_analysis.py.
+# ctg_analysis() times each stage of a workbook with a Tracer:
+#
+#   workbook    The whole call, with the bytes of the workbook read.
+#   read_sheet  Reading the cells of one sheet (per sheet).
+#   analyze     Normalization and AUSC of every sheet at once.
+#   fit         The dose-response fits.
+#   store       Buffering the database rows of one sheet (per sheet).
+#   flush       The database transaction of the workbook, with the rows
+#               written once it commits.
+#   plots       Rendering the plots, with the number of plots made.
+#
+# ctg_pipeline.py runs the same stages in threads, under a reader, compute,
+# writer, or plotter span per workbook instead of the workbook span.
+#
+# Each finished stage records its wall time, CPU time of the thread, and
+# counters as an OpenTelemetry-style span (trace, span, and parent IDs,
+# start time, attributes).  Spans can be logged as JSON on the "ctg_trace"
+# logger, appended to a JSON lines file, and summed into Prometheus text.
+# Without a Tracer, ctg_analysis() uses NULL_TRACER, whose stages do nothing.
+#
+# Usage:
+# python ctg_analysis.py --log-stages --metrics run.prom --profile run.prof
+# python ctg_batch.py -i exports -m manifest.json --trace spans.jsonl --metrics run.prom
+# python ctg_trace.py spans.jsonl                    # Prometheus text of a trace file
+# python -m pstats run.prof                          # Or snakeviz/flameprof for a flame graph
+
+import argparse
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+logger = logging.getLogger("ctg_trace")
+
+# Counters that spans may record, as named in the Prometheus output
+COUNTERS = ["rows_written", "bytes_read", "plots"]
+
+
+class Span:
+    """One timed stage.  add() a counter while it runs."""
+
+    __slots__ = ["name", "attributes", "counters", "span_id", "parent_id", "start",
+                 "wall_start", "cpu_start"]
+
+    def __init__(self, name, attributes, parent_id):
+        self.name = name
+        self.attributes = attributes
+        self.counters = {}
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+
+    def add(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+
+class _NullSpan:
+    """Stands in for a Span when tracing is off."""
+
+    __slots__ = []
+
+    def add(self, counter, value=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class NullTracer:
+    """A Tracer that records nothing, so disabled tracing costs a method call per stage."""
+
+    enabled = False
+
+    def stage(self, name, **attributes):
+        return NULL_SPAN
+
+    def count(self, counter, value=1, **attributes):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class Tracer:
+    """Records the stages of ctg_analysis() runs."""
+
+    enabled = True
+
+    def __init__(self, trace_path=None, log=False, keep=10000):
+        """
+        trace_path: A file each finished span is appended to as one JSON line.
+        Several processes may append to the same file.
+
+        log: Also log each span as JSON on the "ctg_trace" logger at INFO.
+
+        keep: The most recent spans kept in memory for spans().  The totals
+        in metrics_text() cover every span.
+        """
+
+        self.trace_path = trace_path
+        self.log = log
+        self.trace_id = uuid.uuid4().hex
+        self.records = deque(maxlen=keep)
+        # Stage: [calls, wall seconds, cpu seconds]
+        self.totals = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, name, **attributes):
+        """
+        name: The stage (see the top of this file).
+
+        attributes: Labels such as file and sheet.
+
+        Times the body of a with statement and yields its Span.  Stages
+        started inside it record it as their parent.
+        """
+
+        stack = self.local.__dict__.setdefault("stack", [])
+        span = Span(name, attributes, stack[-1].span_id if stack else None)
+        stack.append(span)
+        error = None
+        try:
+            yield span
+        except BaseException as exception:
+            error = type(exception).__name__
+            raise
+        finally:
+            stack.pop()
+            self._finish(span, time.perf_counter() - span.wall_start,
+                         time.thread_time() - span.cpu_start, error)
+
+    def count(self, counter, value=1, **attributes):
+        """Adds to a counter outside of any stage, such as plots finished in
+        another process."""
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+        if self.log:
+            logger.info(json.dumps({"counter": counter, "value": value, **attributes}, default=str))
+
+    def _finish(self, span, wall, cpu, error):
+        record = {"trace_id": self.trace_id, "span_id": span.span_id, "parent_id": span.parent_id,
+                  "name": span.name, "start": round(span.start, 6),
+                  "wall_seconds": round(wall, 6), "cpu_seconds": round(cpu, 6),
+                  "attributes": span.attributes, "counters": span.counters, "pid": os.getpid()}
+        if error is not None:
+            record["error"] = error
+        self.add_record(record)
+
+        line = json.dumps(record, default=str)
+        if self.log:
+            logger.info(line)
+        if self.trace_path is not None:
+            # One write per line, so lines from several processes do not interleave
+            with open(self.trace_path, "a") as trace_file:
+                trace_file.write(line + "\n")
+
+    def add_record(self, record):
+        """Adds a finished span record to the totals."""
+        with self.lock:
+            self.records.append(record)
+            totals = self.totals.setdefault(record["name"], [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += record["wall_seconds"]
+            totals[2] += record["cpu_seconds"]
+            for counter, value in record["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def spans(self):
+        """Returns the records of the most recent spans."""
+        with self.lock:
+            return list(self.records)
+
+    def metrics_text(self, prefix="ctg"):
+        """Returns the stage totals and counters in Prometheus text format."""
+
+        with self.lock:
+            totals = {stage: list(values) for stage, values in self.totals.items()}
+            counters = dict(self.counters)
+        lines = []
+        for metric, position, help_text in [("stage_calls_total", 0, "Times each stage ran."),
+                                            ("stage_seconds_total", 1, "Wall time of each stage."),
+                                            ("stage_cpu_seconds_total", 2, "CPU time of each stage.")]:
+            lines.append(f"# HELP {prefix}_{metric} {help_text}")
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            for stage, values in sorted(totals.items()):
+                value = values[position] if position == 0 else round(values[position], 6)
+                lines.append(f'{prefix}_{metric}{{stage="{stage}"}} {value}')
+        for counter, value in counters.items():
+            lines.append(f"# TYPE {prefix}_{counter}_total counter")
+            lines.append(f"{prefix}_{counter}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path):
+        """Writes metrics_text() to path, for example for the textfile
+        collector of the Prometheus node exporter."""
+        with open(path + ".tmp", "w") as metrics_file:
+            metrics_file.write(self.metrics_text())
+        os.replace(path + ".tmp", path)
+
+
+def read_trace(path, keep=10000):
+    """Returns a Tracer with the totals of every span in a JSON lines trace file."""
+
+    tracer = Tracer(keep=keep)
+    with open(path) as trace_file:
+        for line in trace_file:
+            if line.strip():
+                tracer.add_record(json.loads(line))
+    return tracer
+
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """
+    path: The file cProfile statistics are saved to.  Nothing is profiled if None.
+
+    Profiles the body of a with statement.  The file can be read with
+    python -m pstats, or drawn as a flame graph with snakeviz or flameprof.
+    """
+
+    if path is None:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+if __name__ == "__main__":
+    trace_parser = argparse.ArgumentParser(description="Prints the Prometheus text of a trace file.")
+    trace_parser.add_argument("trace", help="A JSON lines file written with --trace.")
+    args = trace_parser.parse_args()
+    print(read_trace(args.trace).metrics_text(), end="")
@@ -0,0 +1,278 @@
+# Ingestion service for ctg_analysis.py.
+# Watches a directory for new plate reader exports and analyzes each one as
+# soon as the plate reader has finished writing it.
+#
+# - The directory is polled with os.scandir().  A file is ready once its
+#   size and modification time have not changed for --settle seconds, so
+#   partially written .xls/.xlsx files are never opened.
+# - Ready files wait in a bounded queue.  When the queue is full, files stay
+#   pending and are offered again on the next scan.
+# - A dispatcher sends queued files to a process pool that runs the same
+#   analyze_workbook() as ctg_batch.py (parse, database write, and plots).
+# - Parameters come from a manifest (see ctg_batch.py), which is reloaded
+#   when it changes.  Files without a manifest entry wait until one is added.
+# - A file that fails is not retried until it is written again or the
+#   manifest changes, so a corrupt export is only analyzed once.
+# - Counters are written to the log and served in Prometheus text format
+#   on --metrics-port.
+#
+# Usage:
+# python ctg_watch.py -i /path/to/exports -m manifest.json --cache analyzed.db --metrics-port 9108
+# Stop with Ctrl+C.  Files already sent to the pool are finished first.
+
+import argparse
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ctg_batch import (analyze_workbook, check_parameters, init_worker,
+                       load_manifest, workbook_unchanged)
+from ctg_cache import AnalysisCache
+from ctg_storage import DEFAULT_DSN
+
+logger = logging.getLogger("ctg_watch")
+
+
+class WorkbookWatcher:
+    """Finds finished workbooks in directory and analyzes them in a process pool.
+
+    Call scan() to check the directory once, or run() to scan and process
+    files until stop() is called."""
+
+    def __init__(self, directory, manifest_path, dsn=DEFAULT_DSN, workers=None, settle=2.0,
+                 interval=1.0, queue_size=100, cache_path=None, plots="png"):
+        self.directory = directory
+        self.manifest_path = manifest_path
+        self.dsn = dsn
+        self.workers = workers or os.cpu_count() or 1
+        self.settle = settle
+        self.interval = interval
+        self.cache_path = cache_path
+        self.plots = plots
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.manifest = {}
+        self.manifest_mtime = None
+        # Opened by the thread that scans, since SQLite connections stay in one thread
+        self.cache = None
+        # path: (size, mtime_ns, first time this size and mtime were seen)
+        self.pending = {}
+        # path: (size, mtime_ns) of files already queued or analyzed
+        self.done = {}
+        # path: ((size, mtime_ns), manifest mtime) of files that failed
+        self.failed = {}
+        self.in_flight = threading.BoundedSemaphore(self.workers)
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.metrics = {"files_discovered_total": 0, "files_queued_total": 0,
+                        "files_analyzed_total": 0, "files_skipped_total": 0,
+                        "files_failed_total": 0, "files_waiting_for_manifest": 0,
+                        "files_in_progress": 0, "seconds_analyzing_total": 0.0,
+                        "last_latency_seconds": 0.0}
+        self.started = time.time()
+
+    def reload_manifest(self):
+        """Reloads the manifest if it changed since it was last read."""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self.manifest_mtime:
+            try:
+                self.manifest = load_manifest(self.manifest_path)
+                self.manifest_mtime = mtime
+                logger.info("Loaded manifest with %d workbooks", len(self.manifest))
+            except (OSError, ValueError, KeyError) as error:
+                # Probably saved halfway; try again on the next scan
+                logger.warning("Could not read manifest %s: %s", self.manifest_path, error)
+
+    def scan(self, now=None):
+        """Checks the directory once and queues every workbook that has
+        finished being written.  Returns the number of files queued."""
+
+        now = time.time() if now is None else now
+        self.reload_manifest()
+        if self.cache is None and self.cache_path is not None:
+            self.cache = AnalysisCache(self.cache_path)
+        queued = 0
+        waiting = 0
+        # done, failed, and pending are also changed by _finished() in the pool's callback thread
+        with os.scandir(self.directory) as entries, self.lock:
+            for entry in entries:
+                name = entry.name
+                # Skip other files and the lock files Excel leaves while a workbook is open
+                if not (name.endswith(".xls") or name.endswith(".xlsx")) or name.startswith(("~$", ".")):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if self.done.get(entry.path) == signature:
+                    continue
+                # Retried only once the file or the manifest has changed
+                if self.failed.get(entry.path) == (signature, self.manifest_mtime):
+                    continue
+
+                # Wait until the size and modification time stop changing
+                previous = self.pending.get(entry.path)
+                if previous is None or previous[:2] != signature:
+                    if previous is None:
+                        self.metrics["files_discovered_total"] += 1
+                    self.pending[entry.path] = signature + (now,)
+                    continue
+                if stat.st_size == 0 or now - previous[2] < self.settle:
+                    continue
+
+                if name not in self.manifest or check_parameters(name, self.manifest[name]):
+                    waiting += 1
+                    continue
+                parameters = self.manifest[name]
+                if self.cache is not None and workbook_unchanged(self.cache, entry.path, parameters):
+                    self.done[entry.path] = signature
+                    del self.pending[entry.path]
+                    self.metrics["files_skipped_total"] += 1
+                    continue
+
+                attempt = (signature, self.manifest_mtime)
+                try:
+                    self.queue.put_nowait((entry.path, parameters, stat.st_mtime, attempt))
+                except queue.Full:
+                    # Leave it pending so it is offered again on the next scan
+                    break
+                self.done[entry.path] = signature
+                self.failed.pop(entry.path, None)
+                del self.pending[entry.path]
+                self.metrics["files_queued_total"] += 1
+                queued += 1
+
+            self.metrics["files_waiting_for_manifest"] = waiting
+        return queued
+
+    def _finished(self, path, exported, attempt, future):
+        """Records the result of one workbook.  Runs when its future completes.
+        attempt is the file's (size, mtime_ns) and the manifest mtime it was queued with."""
+        self.in_flight.release()
+        with self.lock:
+            self.metrics["files_in_progress"] -= 1
+            try:
+                _, seconds = future.result()
+            except Exception as error:
+                self.metrics["files_failed_total"] += 1
+                # Retry once the file is written again or the manifest changes
+                self.done.pop(path, None)
+                self.failed[path] = attempt
+                logger.error("Failed %s: %s: %s", os.path.basename(path), type(error).__name__, error)
+                return
+            self.metrics["files_analyzed_total"] += 1
+            self.metrics["seconds_analyzing_total"] = round(self.metrics["seconds_analyzing_total"] + seconds, 3)
+            self.metrics["last_latency_seconds"] = round(time.time() - exported, 3)
+            logger.info("Analyzed %s in %.1fs (%.1fs after export)", os.path.basename(path),
+                        seconds, self.metrics["last_latency_seconds"])
+
+    def dispatch(self, executor):
+        """Sends queued workbooks to the pool, never more than one per worker
+        at a time, until stop() is called and the queue is empty."""
+
+        while not (self.stopping.is_set() and self.queue.empty()):
+            try:
+                path, parameters, exported, attempt = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.in_flight.acquire()
+            with self.lock:
+                self.metrics["files_in_progress"] += 1
+            future = executor.submit(analyze_workbook, path, parameters, True, self.plots)
+            future.add_done_callback(lambda done, path=path, exported=exported, attempt=attempt:
+                                     self._finished(path, exported, attempt, done))
+
+    def run(self):
+        """Scans the directory every interval seconds and analyzes new workbooks
+        until stop() is called."""
+
+        logger.info("Watching %s with %d workers", self.directory, self.workers)
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                 initargs=(self.dsn, self.cache_path)) as executor:
+            dispatcher = threading.Thread(target=self.dispatch, args=(executor,), daemon=True)
+            dispatcher.start()
+            while not self.stopping.is_set():
+                try:
+                    self.scan()
+                except OSError as error:
+                    # e.g. a network share that dropped; keep watching
+                    logger.error("Could not scan %s: %s", self.directory, error)
+                self.stopping.wait(self.interval)
+            dispatcher.join()
+
+    def stop(self):
+        self.stopping.set()
+
+    def metrics_text(self):
+        """Returns the counters in Prometheus text format."""
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics["files_pending"] = len(self.pending)
+            metrics["files_failed_waiting"] = len(self.failed)
+        metrics["queue_depth"] = self.queue.qsize()
+        uptime = time.time() - self.started
+        metrics["files_per_minute"] = round(60 * metrics["files_analyzed_total"] / uptime, 3)
+        return "".join(f"ctg_watch_{name} {value}\n" for name, value in metrics.items())
+
+
+def serve_metrics(watcher, port):
+    """Serves watcher.metrics_text() at http://localhost:port/metrics in a background thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = watcher.metrics_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    watch_parser = argparse.ArgumentParser(
+        description="Watches a directory and analyzes new CTG workbooks as they arrive.")
+    watch_parser.add_argument("-i", dest="input", required=True, help="The directory to watch.")
+    watch_parser.add_argument("-m", dest="manifest", required=True,
+                              help="A .json or .csv manifest of experimental parameters.")
+    watch_parser.add_argument("-w", dest="workers", type=int, default=None,
+                              help="Number of worker processes.  Defaults to the number of CPUs.")
+    watch_parser.add_argument("--dsn", default=DEFAULT_DSN,
+                              help="PostgreSQL connection string, sqlite:<path> for a SQLite database, "
+                                   "or parquet:<directory> for Parquet files.")
+    watch_parser.add_argument("--cache", default=None,
+                              help="File recording analyzed workbooks so restarts skip them.")
+    watch_parser.add_argument("--plots", choices=["png", "pdf", "none"], default="png")
+    watch_parser.add_argument("--settle", type=float, default=2.0,
+                              help="Seconds a file must stay unchanged before it is analyzed.")
+    watch_parser.add_argument("--interval", type=float, default=1.0,
+                              help="Seconds between scans of the directory.")
+    watch_parser.add_argument("--queue-size", type=int, default=100)
+    watch_parser.add_argument("--metrics-port", type=int, default=None,
+                              help="Serve Prometheus metrics on this port.")
+    args = watch_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    watcher = WorkbookWatcher(args.input, args.manifest, args.dsn, args.workers, args.settle,
+                              args.interval, args.queue_size, args.cache, args.plots)
+    if args.metrics_port is not None:
+        serve_metrics(watcher, args.metrics_port)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        logger.info("Stopping after the workbooks in progress")
+        watcher.stop()
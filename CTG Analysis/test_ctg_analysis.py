@@ -0,0 +1,76 @@
+# Tests for ctg_analysis.py.  Run with python -m pytest from this directory.
+
+import re
+
+from openpyxl import load_workbook
+
+from ctg_analysis import clean_sheet_name, ctg_analysis, drug_parameters
+from ctg_benchmark import write_synthetic_workbook
+from ctg_cache import AnalysisCache
+from ctg_fit import FitCache
+from ctg_storage import open_store
+
+
+def pdf_pages(path):
+    with open(path, "rb") as pdf_file:
+        return len(re.findall(rb"/Type\s*/Page\b(?!s)", pdf_file.read()))
+
+
+def test_pdf_keeps_unchanged_sheets_after_a_partial_run(tmp_path):
+    workbook = str(tmp_path / "plates.xlsx")
+    sheets = write_synthetic_workbook(workbook, sheets=3)
+    doses, unit = drug_parameters("AMG-176")
+    viability = {clean_sheet_name(sheet, "AMG-176"): 90 for sheet in sheets}
+    store = open_store("sqlite:" + str(tmp_path / "results.db"))
+    cache = AnalysisCache(str(tmp_path / "cache.db"))
+
+    def analyze():
+        return ctg_analysis(workbook, doses, unit, "AMG-176", viability_dictionary=viability,
+                            experiment_date="2019-10-17", experimenter="NB", overwrite=True,
+                            store=store, plots="pdf", cache=cache)
+
+    pdf = str(tmp_path / "plates_data" / "plates.pdf")
+    try:
+        assert analyze() == 6
+        assert pdf_pages(pdf) == 6
+
+        # Change one well of the second sheet
+        cells = load_workbook(workbook)
+        cells[sheets[1]]["D2"].value += 1000
+        cells.save(workbook)
+        assert analyze() == 6
+        assert pdf_pages(pdf) == 6
+        # The changed sheet replaced its rows instead of adding more
+        assert store.connection.execute("SELECT COUNT(*) FROM lum_drug_sens").fetchone()[0] == 3
+    finally:
+        cache.close()
+        store.close()
+
+
+def test_fit_cache_warm_starts_later_workbooks(tmp_path):
+    workbook = str(tmp_path / "plates.xlsx")
+    sheets = write_synthetic_workbook(workbook, sheets=2)
+    doses, unit = drug_parameters("AMG-176")
+    viability = {clean_sheet_name(sheet, "AMG-176"): 90 for sheet in sheets}
+    store = open_store("sqlite:" + str(tmp_path / "results.db"))
+    fit_cache = FitCache(str(tmp_path / "fits.json"))
+
+    def analyze():
+        ctg_analysis(workbook, doses, unit, "AMG-176", viability_dictionary=viability,
+                     experiment_date="2019-10-17", experimenter="NB", overwrite=True,
+                     store=store, plots="none", fit_cache=fit_cache)
+        # The rows of this run, without a cache to replace the earlier ones
+        rows = store.connection.execute("SELECT cell_line_str, ic50, rmse FROM lum_drug_fit "
+                                        "ORDER BY rowid DESC LIMIT 2").fetchall()
+        return sorted(rows)
+
+    try:
+        first = analyze()
+        assert sorted(fit_cache.parameters) == [f"{cell_line}|AMG-176" for cell_line, _, _ in first]
+        second = analyze()
+        for (cell_line, ic50, rmse), (_, _, first_rmse) in zip(second, first):
+            # The cache holds the fits of the second run, which started from the first
+            assert ic50 == round(10 ** fit_cache.parameters[f"{cell_line}|AMG-176"][2], 4)
+            assert rmse <= first_rmse
+    finally:
+        store.close()
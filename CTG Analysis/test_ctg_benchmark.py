@@ -0,0 +1,16 @@
+# Tests for ctg_benchmark.py.  Run with python -m pytest from this directory.
+
+from ctg_benchmark import check_regressions
+
+
+def test_check_regressions():
+    baseline = {"parse": {"sheets_per_sec": 100.0, "median_ms": 10.0, "peak_mb": 50.0}, "runs": 3}
+    assert check_regressions(baseline, baseline) == []
+    # Faster, smaller and within tolerance are not regressions
+    better = {"parse": {"sheets_per_sec": 150.0, "median_ms": 5.0, "peak_mb": 59.0}, "runs": 9}
+    assert check_regressions(better, baseline) == []
+
+    worse = {"parse": {"sheets_per_sec": 70.0, "median_ms": 13.0, "peak_mb": 61.0}, "runs": 3}
+    regressions = check_regressions(worse, baseline)
+    assert [line.split(":")[0] for line in regressions] == [
+        "parse.sheets_per_sec", "parse.median_ms", "parse.peak_mb"]
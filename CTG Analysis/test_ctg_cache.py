@@ -0,0 +1,29 @@
+# Tests for ctg_cache.py.  Run with python -m pytest from this directory.
+
+from ctg_cache import AnalysisCache, analysis_key
+
+
+def key(drug, viability):
+    return analysis_key(drug, "uM", [0, 1, 10], "2019-10-17", "NB", viability)
+
+
+def test_each_drug_keeps_its_key(tmp_path):
+    workbook = tmp_path / "mixed.xlsx"
+    workbook.write_bytes(b"cells" * 100)
+    amg, venetoclax = key("AMG-176", {"mm1s": 90}), key("Venetoclax", {"mm1s": 80})
+
+    cache = AnalysisCache(str(tmp_path / "cache.db"))
+    try:
+        assert not cache.workbook_unchanged(str(workbook), amg, "AMG-176")
+        cache.record(str(workbook), amg, {"mm1s_amg": "a"}, "AMG-176")
+        cache.record(str(workbook), venetoclax, {"mm1s_ven": "v"}, "Venetoclax")
+        # Recording the second drug leaves the first one's key alone
+        assert cache.workbook_unchanged(str(workbook), amg, "AMG-176")
+        assert cache.workbook_unchanged(str(workbook), venetoclax, "Venetoclax")
+        assert not cache.workbook_unchanged(str(workbook), key("AMG-176", {"mm1s": 50}), "AMG-176")
+
+        workbook.write_bytes(b"other cells" * 100)
+        assert not cache.workbook_unchanged(str(workbook), amg, "AMG-176")
+        assert not cache.workbook_unchanged(str(workbook), venetoclax, "Venetoclax")
+    finally:
+        cache.close()
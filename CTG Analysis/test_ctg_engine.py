@@ -0,0 +1,69 @@
+# Tests that ctg_engine.py gives the same results as parse_luminescence()
+# and ausc_trapazoidal() on each sheet.  Run with python -m pytest from
+# this directory.
+
+import numpy as np
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+from ctg_analysis import ausc_trapazoidal, make_mean_df, parse_luminescence, read_sheet
+from ctg_benchmark import write_synthetic_workbook
+from ctg_engine import analyze_plates, sheet_results, stack_sheets
+from ctg_qc import outlier_mask
+
+DOSES = [0, 5, 16, 48, 144, 432, 1296, 3888, 11666, 35000]
+
+
+def workbook(path, doses):
+    """Writes a workbook of three plates with one outlier well, and returns
+    it opened with pandas and its sheet names."""
+    sheets = write_synthetic_workbook(path, sheets=3, doses=doses, seed=doses)
+    cells = load_workbook(path)
+    cells[sheets[1]]["D3"].value *= 5
+    cells.save(path)
+    return pd.ExcelFile(path), sheets
+
+
+def per_sheet(xls_data, sheet, doses, outliers=None):
+    """The means and AUSC of one sheet from its wells, one dose at a time."""
+    ctg_results = read_sheet(xls_data, sheet)
+    wells = pd.DataFrame(ctg_results["lum"].reshape(-1, ctg_results["replicates"]).astype(float))
+    if outliers is not None:
+        wells = wells.mask(outliers.T)
+    mean_df = make_mean_df(wells.mean(axis=1), wells.std(axis=1), sheet)
+    return mean_df, ausc_trapazoidal(mean_df, doses)
+
+
+@pytest.mark.parametrize("doses", [DOSES, DOSES[:8]])
+def test_reported_means_match_parse_luminescence(tmp_path, doses):
+    xls_data, sheets = workbook(str(tmp_path / "plates.xlsx"), len(doses))
+    viability = {sheet: 90 for sheet in sheets}
+    plates = analyze_plates(stack_sheets(xls_data, sheets, "Venetoclax"), doses)
+    for index, sheet in enumerate(sheets):
+        expected = parse_luminescence(xls_data, sheet, sheet, "Venetoclax", doses, "2019-10-17",
+                                      "NB", viability)
+        mean_df, raw_data, processed_data = sheet_results(plates, index, "Venetoclax",
+                                                          "2019-10-17", "NB", viability)
+        pd.testing.assert_frame_equal(mean_df, expected[0])
+        assert raw_data == expected[1]
+        assert processed_data == expected[2]
+
+
+@pytest.mark.parametrize("doses", [DOSES, DOSES[:8]])
+def test_recalculated_and_dropped_means_match_each_sheet(tmp_path, doses):
+    xls_data, sheets = workbook(str(tmp_path / "plates.xlsx"), len(doses))
+    plates = stack_sheets(xls_data, sheets, "Venetoclax")
+    outliers = outlier_mask(plates["lum"])
+    assert outliers[1].sum() == 1
+
+    for mask in [None, outliers]:
+        analyzed = analyze_plates(stack_sheets(xls_data, sheets, "Venetoclax"), doses,
+                                  recalculate=True, outliers=mask)
+        for index, sheet in enumerate(sheets):
+            mean_df, ausc = per_sheet(xls_data, sheet, doses, None if mask is None else mask[index])
+            np.testing.assert_allclose(analyzed["means"][index], mean_df[sheet], rtol=1e-12)
+            np.testing.assert_allclose(analyzed["stdev"][index], mean_df["stdev"], rtol=1e-12)
+            np.testing.assert_allclose(analyzed["normalized"][index], mean_df["normalized_mean"],
+                                       rtol=1e-12)
+            assert analyzed["ausc"][index] == ausc
@@ -0,0 +1,56 @@
+# Tests for ctg_export.py.  Run with python -m pytest from this directory.
+
+import os
+
+from ctg_export import ParquetStore, read_results
+
+
+def well_rows(cell_line, created_by, lum):
+    return [(cell_line, "2019-10-17", created_by, "AMG-176", f"A{dose}", dose, 0.1 * dose, "uM", lum)
+            for dose in range(1, 4)]
+
+
+def part_files(root, table):
+    return [name for directory, _, names in os.walk(os.path.join(root, table))
+            for name in names if name.endswith(".parquet")]
+
+
+def test_one_file_per_partition_and_replaced_experiments(tmp_path):
+    root = str(tmp_path / "results")
+    written = []
+    store = ParquetStore(root, row_group_size=4)
+    for number, cell_line in enumerate(["MM1S", "U266", "KMS11"]):
+        store.add_long(well_rows(cell_line, "NB", 100.0 * number), [])
+        store.flush()
+        store.when_written(lambda cell_line=cell_line: written.append(cell_line))
+    # Nothing is recorded as written until the files are finished
+    assert written == []
+
+    # Analyzed again: the old rows of both experiments are replaced
+    store.replace_experiments([("MM1S", "2019-10-17", "NB", "AMG-176"),
+                               ("U266", "2019-10-17", "NB", "AMG-176")])
+    store.add_long(well_rows("MM1S", "NB", 150.0) + well_rows("U266", "NB", 250.0), [])
+    store.flush()
+    store.close()
+
+    assert written == ["MM1S", "U266", "KMS11"]
+    wells = read_results(root, "lum_well")
+    assert len(wells) == 9
+    assert set(wells.loc[wells["cell_line_str"] == "MM1S", "lum"]) == {150.0}
+    assert set(wells.loc[wells["cell_line_str"] == "U266", "lum"]) == {250.0}
+    assert str(wells["drug"].iloc[0]) == "AMG-176"
+    # The file finished to filter the replaced rows, and the one after it
+    assert len(part_files(root, "lum_well")) == 2
+
+
+def test_killed_run_leaves_no_visible_files(tmp_path):
+    root = str(tmp_path / "results")
+    store = ParquetStore(root, row_group_size=2)
+    store.add_long(well_rows("MM1S", "NB", 100.0), [])
+    store.flush()
+    written = []
+    store.when_written(lambda: written.append(True))
+    # Without close() only hidden, unfinished files exist
+    files = part_files(root, "lum_well")
+    assert files and all(name.startswith(".") for name in files)
+    assert written == []
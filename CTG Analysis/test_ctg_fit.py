@@ -0,0 +1,40 @@
+# Tests for ctg_fit.py.  Run with python -m pytest from this directory.
+
+import numpy as np
+
+from ctg_fit import refit_database
+from ctg_storage import DOSE_COLUMNS, FIT_COLUMNS, PROCESSED_COLUMNS, open_store
+
+
+def add_experiment(store, cell_line, drug, means):
+    values = (cell_line, "2019-10-17", "NB", 90, drug, 500.0) + tuple(means)
+    store.connection.execute(f"INSERT INTO lum_drug_sens ({', '.join(PROCESSED_COLUMNS)}) "
+                             f"VALUES ({', '.join('?' * len(values))})", values)
+
+
+def test_refit_replaces_only_refit_experiments(tmp_path, capsys):
+    store = open_store("sqlite:" + str(tmp_path / "results.db"))
+    try:
+        survival = 1 / (1 + (np.arange(len(DOSE_COLUMNS)) / 5) ** 2)
+        add_experiment(store, "MM1S", "AMG-176", 1000 * survival)
+        add_experiment(store, "U266", "A-1155463", 1000 * survival)
+        # Fits of plates with no row in lum_drug_sens, and of drugs with no doses
+        kept = [("KMS11", "2019-10-17", "NB", "AMG-176") + (1.0,) * (len(FIT_COLUMNS) - 4),
+                ("U266", "2019-10-17", "NB", "A-1155463") + (2.0,) * (len(FIT_COLUMNS) - 4)]
+        store.connection.executemany(f"INSERT INTO lum_drug_fit ({', '.join(FIT_COLUMNS)}) "
+                                     f"VALUES ({', '.join('?' * len(FIT_COLUMNS))})", kept)
+        store.connection.commit()
+
+        assert refit_database(store) == 1
+        assert "Skipping A-1155463" in capsys.readouterr().out
+        rows = store.connection.execute("SELECT cell_line_str, drug, ic50 FROM lum_drug_fit "
+                                        "ORDER BY cell_line_str").fetchall()
+        assert [row[:2] for row in rows] == [("KMS11", "AMG-176"), ("MM1S", "AMG-176"),
+                                             ("U266", "A-1155463")]
+        assert rows[0][2] == 1.0 and rows[2][2] == 2.0
+
+        # Refitting again replaces the fit instead of adding another
+        assert refit_database(store) == 1
+        assert store.connection.execute("SELECT COUNT(*) FROM lum_drug_fit").fetchone()[0] == 3
+    finally:
+        store.close()
@@ -0,0 +1,51 @@
+# Tests for ctg_pipeline.py.  Run with python -m pytest from this directory.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import ctg_pipeline
+from ctg_analysis import clean_sheet_name, drug_parameters, workbook_job
+from ctg_benchmark import write_synthetic_workbook
+from ctg_pipeline import run_pipeline
+
+
+def job(file, sheets, drug="AMG-176"):
+    doses, unit = drug_parameters(drug)
+    viability = {clean_sheet_name(sheet, drug): 90 for sheet in sheets}
+    return workbook_job(file, doses, unit, drug, viability_dictionary=viability,
+                        experiment_date="2019-10-17", experimenter="NB", overwrite=True,
+                        plots="none")
+
+
+def test_failure_skips_later_jobs_of_the_same_file(tmp_path):
+    good = str(tmp_path / "good.xlsx")
+    sheets = write_synthetic_workbook(good, sheets=2)
+    bad = tmp_path / "bad.xlsx"
+    bad.write_bytes(b"not a workbook" * 100)
+
+    finished = []
+    jobs = run_pipeline([job(str(bad), sheets), job(str(bad), sheets, "Venetoclax"),
+                         job(good, sheets)],
+                        dsn="sqlite:" + str(tmp_path / "results.db"), done=finished.append)
+    assert [job["file"] for job in jobs] == [str(bad), str(bad), good]
+    assert finished == jobs
+    assert jobs[0]["error"] is not None
+    assert jobs[1]["error"] == "skipped after an earlier failure in the same file"
+    assert jobs[2]["error"] is None and not jobs[2]["skipped"]
+
+
+def fail_to_plot(job, plot_executor, tracer):
+    def render():
+        raise RuntimeError("no space left for plots")
+    return plot_executor.submit(render)
+
+
+def test_plot_failure_is_reported(tmp_path, monkeypatch):
+    monkeypatch.setattr(ctg_pipeline, "plot_workbook", fail_to_plot)
+    good = str(tmp_path / "good.xlsx")
+    sheets = write_synthetic_workbook(good, sheets=2)
+
+    with ThreadPoolExecutor(max_workers=1) as plot_executor:
+        jobs = run_pipeline([job(good, sheets)], dsn="sqlite:" + str(tmp_path / "results.db"),
+                            plot_executor=plot_executor)
+    assert jobs[0]["error"] == "RuntimeError: no space left for plots"
+    assert jobs[0]["plots_made"] == 0
@@ -0,0 +1,64 @@
+# Tests for ctg_qc.py.  Run with python -m pytest from this directory.
+# The plates are small enough to check by hand: replicates on axis 1, doses
+# on axis 2, and a typical relative spread of 10% (the median |lum / median - 1|).
+
+import numpy as np
+import pytest
+
+from ctg_qc import outlier_mask, plate_qc, robust_z
+
+
+def plate(*doses):
+    """One cell line with the given wells (a list per dose)."""
+    return np.array(doses, dtype=float).T[None]
+
+
+def test_mad_floor():
+    # Three equal wells give dose 0 a MAD of 0, so its scale comes from the
+    # plate: 0.1 / 0.6745 * 100.  Doses 1 and 2 have MAD = 10% of the median.
+    lum = plate([100, 100, 100, 160], [90, 110, 90, 110], [45, 55, 45, 55])
+    z = robust_z(lum)
+    assert z[0, :, 0] == pytest.approx([0, 0, 0, 60 * 0.6745 / 10])
+    assert z[0, :, 1] == pytest.approx([-0.6745, 0.6745, -0.6745, 0.6745])
+    assert z[0, :, 2] == pytest.approx([-0.6745, 0.6745, -0.6745, 0.6745])
+    assert outlier_mask(lum)[0].tolist() == [[False] * 3, [False] * 3, [False] * 3, [True, False, False]]
+
+    # A plate where every well agrees has no spread and no outliers
+    assert not robust_z(plate([100] * 4, [50] * 4)).any()
+
+
+@pytest.mark.parametrize("min_wells, expected", [
+    (3, [170, 160]),
+    (5, [170]),
+    (6, []),
+])
+def test_min_wells(min_wells, expected):
+    # z-scores of 70 / 14.83 = 4.72 and 60 / 14.83 = 4.05 at dose 0
+    lum = plate([100, 100, 100, 100, 170, 160], [90, 110, 90, 110, 90, 110])
+    outliers = outlier_mask(lum, min_wells=min_wells)
+    assert sorted(lum[outliers].tolist(), reverse=True) == expected
+    assert not outliers[0, :, 1].any()
+
+
+def test_cv_and_z_prime():
+    # sd = sqrt(4 * 10^2 / 3) = 11.547 at dose 0 and 1.1547 at dose 1
+    lum = plate([90, 110, 90, 110], [9, 11, 9, 11])
+    qc = plate_qc({"lum": lum})
+    assert not qc["outliers"].any()
+    assert qc["means"][0] == pytest.approx([100, 10])
+    assert qc["stdev"][0] == pytest.approx([11.547, 1.1547], abs=1e-4)
+    assert qc["cv"][0] == pytest.approx([11.547, 11.547], abs=1e-3)
+    # 1 - 3 * (11.547 + 1.1547) / 90
+    assert qc["z_prime"][0] == pytest.approx(0.57661, abs=1e-5)
+    assert qc["passed"].tolist() == [True]
+    assert plate_qc({"lum": lum}, cv_limit=10)["passed"].tolist() == [False]
+    assert plate_qc({"lum": lum}, z_prime_limit=0.6)["passed"].tolist() == [False]
+
+
+def test_outliers_are_left_out_of_the_statistics():
+    lum = plate([100, 100, 100, 160], [90, 110, 90, 110], [45, 55, 45, 55])
+    qc = plate_qc({"lum": lum})
+    assert qc["means"][0] == pytest.approx([100, 100, 50])
+    assert qc["cv"][0, 0] == 0
+    # 1 - 3 * (0 + 5.7735) / 50
+    assert qc["z_prime"][0] == pytest.approx(1 - 3 * 5.7735 / 50, abs=1e-4)
@@ -0,0 +1,69 @@
+# Tests for ctg_query.py on a SQLite stand-in database.  Run with
+# python -m pytest from this directory.
+
+import pandas as pd
+import pytest
+
+from ctg_query import ensure_schema, experiments, refresh_summaries, summary
+from ctg_storage import open_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = open_store("sqlite:" + str(tmp_path / "results.db"))
+    ensure_schema(store)
+    yield store
+    store.close()
+
+
+def add(store, cell_line, created_on, drug, ausc, created_by="NB"):
+    # Six columns, as for a plate without 10 doses
+    store.add([], (cell_line, created_on, created_by, 90, drug, ausc))
+    store.flush()
+
+
+def dirty(store):
+    return store.connection.execute("SELECT COUNT(*) FROM lum_summary_dirty").fetchone()[0]
+
+
+def test_summary_is_refreshed_from_dirty_pairs(store):
+    add(store, "MM1S", "2019-10-17", "AMG-176", 400.0)
+    add(store, "MM1S", "2019-11-01", "AMG-176", 600.0)
+    add(store, "U266", "2019-10-17", "Venetoclax", 300.0)
+    # The same pair flushed twice is listed once
+    assert dirty(store) == 2
+
+    rows = summary(store).set_index(["cell_line_str", "drug"])
+    assert dirty(store) == 0
+    amg = rows.loc[("MM1S", "AMG-176")]
+    assert amg["experiments"] == 2
+    assert amg["mean_ausc"] == pytest.approx(500.0)
+    assert amg["sd_ausc"] == pytest.approx(141.4214, abs=1e-4)
+    assert (amg["min_ausc"], amg["max_ausc"]) == (400.0, 600.0)
+    assert (amg["first_run"], amg["latest_run"]) == ("2019-10-17", "2019-11-01")
+    venetoclax = rows.loc[("U266", "Venetoclax")]
+    assert venetoclax["experiments"] == 1 and pd.isna(venetoclax["sd_ausc"])
+
+    # Only the changed pair is recalculated
+    add(store, "U266", "2019-11-01", "Venetoclax", 500.0)
+    assert refresh_summaries(store) == 1
+    assert refresh_summaries(store) == 0
+    rows = summary(store, drugs="Venetoclax")
+    assert list(rows["experiments"]) == [2]
+    assert rows["mean_ausc"].iloc[0] == pytest.approx(400.0)
+
+
+def test_full_refresh_and_experiment_filters(store):
+    add(store, "MM1S", "2019-10-17", "AMG-176", 400.0)
+    add(store, "MM1S", "2020-01-05", "AMG-176", 500.0)
+    # Written without a LuminescenceStore, so not marked dirty
+    store.connection.execute("INSERT INTO lum_drug_sens (cell_line_str, created_on, created_by, "
+                             "viability, drug, ausc) VALUES ('KMS11', '2019-12-01', 'NB', 90, "
+                             "'AMG-176', 700.0)")
+    store.connection.commit()
+    assert refresh_summaries(store, full=True) == 2
+    assert list(summary(store, cell_lines=["KMS11"])["experiments"]) == [1]
+
+    rows = experiments(store, cell_lines="MM1S", drugs=["AMG-176"], since="2019-11-01")
+    assert list(rows["created_on"]) == ["2020-01-05"]
+    assert rows["dose_1"].isna().all()
@@ -0,0 +1,71 @@
+# Tests for ctg_registry.py.  Run with python -m pytest from this directory.
+
+import json
+import os
+
+import pytest
+
+from ctg_registry import DrugRegistry, load_registry
+
+SHEETS = ["MM1S_amg", "mm1s_AMG176", "KMS-11_ven", "u266_venetoclax", "LP1", "h929_a115",
+          "molp8_abt", "Sheet_amg_ven", "oci_ly1_amg", "jjn3_ven_amg"]
+
+
+def baseline_clean_sheet_name(sheet, drug):
+    """clean_sheet_name() as it was before the registry, for comparison."""
+    if drug == "AMG-176":
+        drug_index = sheet.lower().find("_amg")
+        if drug_index != -1:
+            sheet = sheet[:drug_index]
+    elif drug == "Venetoclax":
+        drug_index = sheet.lower().find("_ven")
+        if drug_index != -1:
+            sheet = sheet[:drug_index]
+    return sheet.lower()
+
+
+@pytest.mark.parametrize("drug", ["AMG-176", "Venetoclax", "A-1155463"])
+def test_cell_lines_match_the_baseline(drug):
+    registry = load_registry()
+    for sheet in SHEETS:
+        assert registry.cell_line(sheet, drug) == baseline_clean_sheet_name(sheet, drug)
+
+
+def test_resolve_sheet():
+    registry = load_registry()
+    assert registry.resolve_sheet("MM1S_amg176") == ("mm1s", "AMG-176")
+    assert registry.resolve_sheet("KMS-11_Ven") == ("kms-11", "Venetoclax")
+    # The first suffix names the drug
+    assert registry.resolve_sheet("jjn3_ven_amg") == ("jjn3", "Venetoclax")
+    assert registry.resolve_sheet("LP1") == ("lp1", None)
+    assert registry.resolve_sheet("molp8_abt") == ("molp8_abt", None)
+
+
+def test_names_doses_and_layouts():
+    registry = load_registry()
+    assert registry.drug_name("amg") == "AMG-176"
+    assert registry.drug_name("venetoclax") == "Venetoclax"
+    with pytest.raises(ValueError):
+        registry.drug_name("abt")
+    doses, unit = registry.parameters("ven")
+    assert (len(doses), doses[0], unit) == (10, 0, "nM")
+    with pytest.raises(ValueError, match="No doses"):
+        registry.parameters("A-1155463")
+    assert registry.layout("AMG-176")["replicates"] == 4
+
+
+def test_longest_alias_wins_and_conflicts_are_rejected(tmp_path):
+    registry = DrugRegistry({"drugs": {"Short": {"aliases": ["ab"]},
+                                       "Long": {"aliases": ["abc"]}}})
+    assert registry.resolve_sheet("line_abc") == ("line", "Long")
+    assert registry.resolve_sheet("line_ab") == ("line", "Short")
+    with pytest.raises(ValueError, match="alias of both"):
+        DrugRegistry({"drugs": {"One": {"aliases": ["x"]}, "Two": {"aliases": ["X"]}}})
+
+    # A changed file is loaded again
+    path = tmp_path / "drugs.json"
+    path.write_text(json.dumps({"drugs": {"One": {"aliases": ["x"], "doses": [0, 1], "unit": "uM"}}}))
+    assert load_registry(str(path)).parameters("x") == ([0, 1], "uM")
+    path.write_text(json.dumps({"drugs": {"One": {"aliases": ["x"], "doses": [0, 2], "unit": "uM"}}}))
+    os.utime(path, ns=(1, 1))
+    assert load_registry(str(path)).parameters("x") == ([0, 2], "uM")
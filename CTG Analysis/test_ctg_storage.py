@@ -0,0 +1,89 @@
+# Tests for ctg_storage.py on the SQLite stand-in database.  Run with
+# python -m pytest from this directory.
+
+import sqlite3
+
+import pytest
+
+from ctg_storage import DOSE_COLUMNS, QC_COLUMNS, open_store
+
+TABLES = ["raw_lum", "lum_drug_sens", "lum_drug_fit", "lum_well", "lum_response", "lum_qc"]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = open_store("sqlite:" + str(tmp_path / "results.db"))
+    yield store
+    store.close()
+
+
+def add_plate(store, cell_line, lum, doses=10, created_by="NB"):
+    """Adds every row of one plate of two wells per dose, as ctg_analysis() does."""
+    experiment = (cell_line, "2019-10-17", created_by, "AMG-176")
+    raw_data = [["2019-10-17", created_by, "AMG-176", cell_line, f"well_{well}"] + [lum] * doses
+                for well in (1, 2)]
+    store.add(raw_data, [cell_line, "2019-10-17", created_by, 90, "AMG-176", 500.0] + [lum] * doses)
+    store.add_long([experiment + (f"well_{well}", dose, dose, "nM", lum)
+                    for well in (1, 2) for dose in range(doses)],
+                   [experiment + (dose, dose, "nM", lum, 0.0, 1.0) for dose in range(doses)])
+    store.add_fits([experiment + (10.0, 1.0, 1.0, 0.0, 0.99, 0.01, 5.0)])
+    store.add_qc([experiment + (2 * doses, 0, "", lum, 1.0, 2.0, 0.8, 1, 0)])
+
+
+def counts(store, cell_line=None):
+    where = "" if cell_line is None else f" WHERE cell_line_str = '{cell_line}'"
+    return [store.connection.execute(f"SELECT COUNT(*) FROM {table}{where}").fetchone()[0]
+            for table in TABLES]
+
+
+def test_flush_writes_every_table(store):
+    add_plate(store, "MM1S", 1000.0)
+    assert counts(store) == [0] * 6
+    assert store.flush() == 2 + 1 + 1 + 20 + 10 + 1
+    assert counts(store) == [2, 1, 1, 20, 10, 1]
+    assert store.flush() == 0
+
+
+def test_failed_flush_rolls_back_and_keeps_rows(store):
+    add_plate(store, "MM1S", 1000.0)
+    store.add_qc([("U266",) * (len(QC_COLUMNS) - 1)])
+    with pytest.raises(sqlite3.Error):
+        store.flush()
+    assert counts(store) == [0] * 6
+    # The rows are kept for a retry, and clear() discards them
+    assert len(store.processed_rows) == 1
+    store.clear()
+    add_plate(store, "U266", 2000.0)
+    store.flush()
+    assert counts(store) == [2, 1, 1, 20, 10, 1]
+
+
+def test_replace_experiments_in_every_table(store):
+    add_plate(store, "MM1S", 1000.0)
+    add_plate(store, "U266", 2000.0)
+    store.flush()
+
+    store.replace_experiments([("MM1S", "2019-10-17", "NB", "AMG-176")])
+    add_plate(store, "MM1S", 1500.0)
+    store.flush()
+    assert counts(store, "MM1S") == [2, 1, 1, 20, 10, 1]
+    assert counts(store, "U266") == [2, 1, 1, 20, 10, 1]
+    assert store.connection.execute("SELECT DISTINCT lum FROM lum_well WHERE cell_line_str = 'MM1S'"
+                                    ).fetchall() == [(1500.0,)]
+
+    # Another experimenter's experiment of the same cell line is kept
+    add_plate(store, "MM1S", 1200.0, created_by="AB")
+    store.flush()
+    store.replace_experiments([("MM1S", "2019-10-17", "NB", "AMG-176")])
+    store.flush()
+    assert counts(store, "MM1S") == [2, 1, 1, 20, 10, 1]
+
+
+def test_plates_without_10_doses_have_null_dose_columns(store):
+    add_plate(store, "MM1S", 1000.0, doses=8)
+    store.flush()
+    # No raw_lum rows, but every dose in the long format tables
+    assert counts(store) == [0, 1, 1, 16, 8, 1]
+    row = store.connection.execute(f"SELECT ausc, {', '.join(DOSE_COLUMNS)} FROM lum_drug_sens"
+                                   ).fetchone()
+    assert row == (500.0,) + (None,) * len(DOSE_COLUMNS)
@@ -0,0 +1,74 @@
+# Tests for ctg_watch.py: a good and a corrupt workbook dropped into a
+# watched directory.  Run with python -m pytest from this directory.
+
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ctg_batch import init_worker, sheet_names
+from ctg_registry import load_registry
+from ctg_watch import WorkbookWatcher
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcl20191017_amg176.xls")
+
+
+def write_manifest(path, files):
+    registry = load_registry()
+    viability = {registry.cell_line(sheet, "AMG-176"): 90 for sheet in sheet_names(SAMPLE)
+                 if not sheet.startswith("Sheet")}
+    with open(path, "w") as manifest_file:
+        json.dump({"defaults": {"drug": "AMG-176", "date": "2019-10-17", "experimenter": "NB",
+                                "viability": viability},
+                   "files": {file: {} for file in files}}, manifest_file)
+
+
+def wait_for(watcher, finished, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with watcher.lock:
+            metrics = dict(watcher.metrics)
+        if metrics["files_analyzed_total"] + metrics["files_failed_total"] >= finished:
+            return metrics
+        time.sleep(0.1)
+    raise AssertionError(f"Only {metrics} after {timeout}s")
+
+
+def test_good_and_corrupt_workbooks(tmp_path):
+    exports = tmp_path / "exports"
+    exports.mkdir()
+    manifest = str(tmp_path / "manifest.json")
+    write_manifest(manifest, ["good.xls", "bad.xls"])
+    shutil.copy(SAMPLE, exports / "good.xls")
+    (exports / "bad.xls").write_bytes(b"not a workbook" * 100)
+
+    dsn = "sqlite:" + str(tmp_path / "results.db")
+    watcher = WorkbookWatcher(str(exports), manifest, dsn, workers=1, settle=0, plots="none")
+    with ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(dsn,)) as executor:
+        dispatcher = threading.Thread(target=watcher.dispatch, args=(executor,), daemon=True)
+        dispatcher.start()
+        try:
+            watcher.scan(now=0)
+            assert watcher.scan(now=1) == 2
+            metrics = wait_for(watcher, 2)
+            assert metrics["files_analyzed_total"] == 1
+            assert metrics["files_failed_total"] == 1
+
+            # The corrupt file is not retried while it stays the same
+            for now in range(2, 12):
+                assert watcher.scan(now=now) == 0
+            assert watcher.metrics["files_discovered_total"] == 2
+            assert watcher.metrics["files_queued_total"] == 2
+
+            # Written again, it is analyzed again
+            (exports / "bad.xls").write_bytes(b"still not a workbook" * 100)
+            watcher.scan(now=20)
+            assert watcher.scan(now=21) == 1
+            metrics = wait_for(watcher, 3)
+            assert metrics["files_failed_total"] == 2
+            assert watcher.scan(now=22) == 0
+        finally:
+            watcher.stop()
+            dispatcher.join()